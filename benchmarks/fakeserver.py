@@ -0,0 +1,396 @@
+#
+# fakeserver.py -- In-process XMPP server counting the received stanzas.
+#
+# Copyright (c) 2013  Horatiu Eugen Vlad
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+import base64
+import collections
+import hashlib
+import hmac
+import logging
+import os
+import socket
+import ssl
+import threading
+import time
+import xml.parsers.expat
+
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape, quoteattr
+
+STREAM_NS = "http://etherx.jabber.org/streams"
+CLIENT_NS = "jabber:client"
+TLS_NS = "urn:ietf:params:xml:ns:xmpp-tls"
+SASL_NS = "urn:ietf:params:xml:ns:xmpp-sasl"
+BIND_NS = "urn:ietf:params:xml:ns:xmpp-bind"
+SESSION_NS = "urn:ietf:params:xml:ns:xmpp-session"
+ROSTER_NS = "jabber:iq:roster"
+PING_NS = "urn:xmpp:ping"
+DISCO_INFO_NS = "http://jabber.org/protocol/disco#info"
+ADDRESS_NS = "http://jabber.org/protocol/address"
+SM_NS = "urn:xmpp:sm:3"
+
+SCRAM_ITERATIONS = 4096
+
+
+def get_tag(name):
+    if "}" in name:
+        return "{" + name
+    return name
+
+
+def parse_attrs(data):
+    return dict(item.split(b"=", 1) for item in data.split(b",") if b"=" in item)
+
+
+class FakeXmppServer(object):
+    """
+    A minimal XMPP server for the benchmarks. It accepts STARTTLS when a
+    certificate is given and SASL SCRAM-SHA-1 or PLAIN with any user name
+    and the given password, binds resources, answers the iq requests of the
+    clients and counts the messages it receives. The recipients of the last
+    messages are kept in ``received``, and the last presences sent to other
+    entities in ``presences``. XEP-0033
+    multicast is advertised when ``multicast`` is set, and XEP-0198 stream
+    management, with resumption, when ``stream_management`` is set.
+    """
+    def __init__(self, password, domain="example.com", certfile=None, keyfile=None,
+                 multicast=False, stream_management=False):
+        self.password = password
+        self.domain = domain
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.multicast = multicast
+        self.stream_management = stream_management
+        self.sessions = {}
+        self.clients = []
+        self.resumptions = 0
+        self.sock = None
+        self.port = None
+        self.thread = None
+        self.running = False
+        self.condition = threading.Condition()
+        self.connections = 0
+        self.stanzas = 0
+        self.messages = 0
+        self.received = collections.deque(maxlen=1000)
+        self.presences = collections.deque(maxlen=1000)
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="fakeserver")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.sock.close()
+
+    def run(self):
+        while self.running:
+            try:
+                sock, address = self.sock.accept()
+            except socket.error:
+                break
+            connection = FakeXmppConnection(self, sock)
+            with self.condition:
+                self.connections += 1
+                self.clients.append(connection)
+            connection.start()
+
+    def drop_connections(self):
+        """
+        Drops the client connections without closing their streams, as a
+        network failure would.
+        """
+        with self.condition:
+            clients, self.clients = self.clients, []
+        for connection in clients:
+            try:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def count(self, to, addresses):
+        """
+        Counts a message stanza sent to ``to``, delivered to each of its
+        XEP-0033 ``addresses``, as ``(type, jid)`` tuples, if any.
+        """
+        with self.condition:
+            self.stanzas += 1
+            self.messages += max(len(addresses), 1)
+            self.received.append((to, addresses))
+            self.condition.notify_all()
+
+    def add_presence(self, to, presence_type):
+        """
+        Records a directed presence stanza, as a ``(to, type)`` tuple.
+        """
+        with self.condition:
+            self.presences.append((to, presence_type))
+            self.condition.notify_all()
+
+    def wait_for(self, predicate, timeout):
+        """
+        Waits until ``predicate`` returns ``True``, checking it whenever a
+        stanza is counted. Returns ``False`` on timeout.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while not predicate():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def wait_messages(self, count, timeout):
+        """
+        Waits until ``count`` messages were received in total. Returns
+        ``False`` on timeout.
+        """
+        return self.wait_for(lambda: self.messages >= count, timeout)
+
+
+class FakeXmppConnection(threading.Thread):
+    """
+    The server side of a client connection.
+    """
+    def __init__(self, server, sock):
+        threading.Thread.__init__(self, name="fakeserver-connection")
+        self.daemon = True
+        self.server = server
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.parser = None
+        self.builder = None
+        self.depth = 0
+        self.tls = False
+        self.authenticated = False
+        self.scram = None
+        self.after_parse = None
+        self.closed = False
+        self.sm_id = None
+
+    def run(self):
+        self.reset_parser()
+        try:
+            while not self.closed:
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                self.parser.Parse(data, False)
+                after_parse, self.after_parse = self.after_parse, None
+                if after_parse is not None:
+                    after_parse()
+        except Exception, e:
+            logging.debug(u"Fake XMPP connection closed: %s", e)
+        finally:
+            self.sock.close()
+
+    def send(self, data):
+        with self.lock:
+            self.sock.sendall(data.encode("utf-8"))
+
+    def reset_parser(self):
+        self.parser = xml.parsers.expat.ParserCreate("UTF-8", "}")
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self.handle_start
+        self.parser.EndElementHandler = self.handle_end
+        self.parser.CharacterDataHandler = self.handle_data
+        self.builder = None
+        self.depth = 0
+
+    def handle_start(self, name, attrs):
+        self.depth += 1
+        if self.depth == 1:
+            self.start_stream()
+            return
+        if self.depth == 2:
+            self.builder = ElementTree.TreeBuilder()
+        self.builder.start(get_tag(name),
+                           dict((get_tag(key), value) for key, value in attrs.items()))
+
+    def handle_end(self, name):
+        self.depth -= 1
+        if self.depth == 0:
+            self.send(u"</stream:stream>")
+            self.closed = True
+            return
+        self.builder.end(get_tag(name))
+        if self.depth == 1:
+            element = self.builder.close()
+            self.builder = None
+            self.handle_element(element)
+
+    def handle_data(self, data):
+        if self.builder is not None:
+            self.builder.data(data)
+
+    def start_stream(self):
+        self.send(u"<?xml version='1.0'?><stream:stream xmlns='%s' xmlns:stream='%s'"
+                  u" from=%s id='%s' version='1.0'>"
+                  % (CLIENT_NS, STREAM_NS, quoteattr(self.server.domain),
+                     base64.b16encode(os.urandom(8)).decode("ascii")))
+        if not self.authenticated:
+            features = u""
+            if self.server.certfile and not self.tls:
+                features += u"<starttls xmlns='%s'/>" % TLS_NS
+            mechanisms = u"<mechanism>SCRAM-SHA-1</mechanism><mechanism>PLAIN</mechanism>"
+            features += u"<mechanisms xmlns='%s'>%s</mechanisms>" % (SASL_NS, mechanisms)
+        else:
+            features = (u"<bind xmlns='%s'/><session xmlns='%s'><optional/></session>"
+                        % (BIND_NS, SESSION_NS))
+            if self.server.stream_management:
+                features += u"<sm xmlns='%s'/>" % SM_NS
+        self.send(u"<stream:features>%s</stream:features>" % features)
+
+    def handle_element(self, element):
+        tag = element.tag
+        if self.sm_id is not None and tag in ("{%s}message" % CLIENT_NS,
+                                              "{%s}iq" % CLIENT_NS,
+                                              "{%s}presence" % CLIENT_NS):
+            with self.server.condition:
+                self.server.sessions[self.sm_id] += 1
+        if tag == "{%s}message" % CLIENT_NS:
+            addresses = element.findall("{%s}addresses/{%s}address" % (ADDRESS_NS, ADDRESS_NS))
+            self.server.count(element.get("to"), [(address.get("type"), address.get("jid"))
+                                                  for address in addresses])
+        elif tag == "{%s}iq" % CLIENT_NS:
+            self.handle_iq(element)
+        elif tag == "{%s}presence" % CLIENT_NS and element.get("to"):
+            self.server.add_presence(element.get("to"), element.get("type"))
+        elif tag == "{%s}starttls" % TLS_NS:
+            self.send(u"<proceed xmlns='%s'/>" % TLS_NS)
+            self.after_parse = self.start_tls
+        elif tag == "{%s}auth" % SASL_NS:
+            self.handle_auth(element)
+        elif tag == "{%s}response" % SASL_NS:
+            self.handle_response(element)
+        elif tag == "{%s}enable" % SM_NS:
+            self.sm_id = base64.b16encode(os.urandom(8)).decode("ascii")
+            with self.server.condition:
+                self.server.sessions[self.sm_id] = 0
+            self.send(u"<enabled xmlns='%s' id='%s' resume='true'/>" % (SM_NS, self.sm_id))
+        elif tag == "{%s}r" % SM_NS and self.sm_id is not None:
+            self.send(u"<a xmlns='%s' h='%d'/>" % (SM_NS, self.server.sessions[self.sm_id]))
+        elif tag == "{%s}resume" % SM_NS:
+            previd = element.get("previd")
+            with self.server.condition:
+                h = self.server.sessions.get(previd)
+                if h is not None:
+                    self.server.resumptions += 1
+            if h is None:
+                self.send(u"<failed xmlns='%s'><item-not-found"
+                          u" xmlns='urn:ietf:params:xml:ns:xmpp-stanzas'/></failed>" % SM_NS)
+            else:
+                self.sm_id = previd
+                self.send(u"<resumed xmlns='%s' previd='%s' h='%d'/>" % (SM_NS, previd, h))
+
+    def start_tls(self):
+        self.sock = ssl.wrap_socket(self.sock, server_side=True,
+                                    certfile=self.server.certfile,
+                                    keyfile=self.server.keyfile)
+        self.tls = True
+        self.reset_parser()
+
+    def handle_auth(self, element):
+        data = base64.b64decode(element.text or b"")
+        mechanism = element.get("mechanism")
+        if mechanism == "PLAIN":
+            password = data.split(b"\0")[-1]
+            self.authenticate(password == self.server.password.encode("utf-8"))
+        elif mechanism == "SCRAM-SHA-1":
+            client_first_bare = data.split(b",", 2)[2]
+            nonce = parse_attrs(client_first_bare)[b"r"] + base64.b64encode(os.urandom(18))
+            salt = os.urandom(16)
+            server_first = b"r=" + nonce + b",s=" + base64.b64encode(salt) + \
+                           b",i=" + str(SCRAM_ITERATIONS).encode("ascii")
+            self.scram = (client_first_bare, server_first, nonce, salt)
+            self.send(u"<challenge xmlns='%s'>%s</challenge>"
+                      % (SASL_NS, base64.b64encode(server_first).decode("ascii")))
+        else:
+            self.authenticate(False)
+
+    def handle_response(self, element):
+        if self.scram is None:
+            self.authenticate(False)
+            return
+        client_first_bare, server_first, nonce, salt = self.scram
+        self.scram = None
+        client_final = base64.b64decode(element.text or b"")
+        attrs = parse_attrs(client_final)
+        if attrs.get(b"r") != nonce:
+            self.authenticate(False)
+            return
+        salted = hashlib.pbkdf2_hmac("sha1", self.server.password.encode("utf-8"),
+                                     salt, SCRAM_ITERATIONS)
+        client_key = hmac.new(salted, b"Client Key", hashlib.sha1).digest()
+        stored_key = hashlib.sha1(client_key).digest()
+        auth_message = client_first_bare + b"," + server_first + b"," + \
+                       client_final[:client_final.rindex(b",p=")]
+        signature = hmac.new(stored_key, auth_message, hashlib.sha1).digest()
+        proof = bytearray(base64.b64decode(attrs.get(b"p", b"")))
+        key = bytes(bytearray(a ^ b for a, b in zip(proof, bytearray(signature))))
+        if hashlib.sha1(key).digest() != stored_key:
+            self.authenticate(False)
+            return
+        server_key = hmac.new(salted, b"Server Key", hashlib.sha1).digest()
+        server_signature = hmac.new(server_key, auth_message, hashlib.sha1).digest()
+        self.authenticate(True, b"v=" + base64.b64encode(server_signature))
+
+    def authenticate(self, success, data=None):
+        if not success:
+            self.send(u"<failure xmlns='%s'><not-authorized/></failure>" % SASL_NS)
+            return
+        data = data and base64.b64encode(data).decode("ascii") or u""
+        self.send(u"<success xmlns='%s'>%s</success>" % (SASL_NS, data))
+        self.authenticated = True
+        self.after_parse = self.reset_parser
+
+    def handle_iq(self, iq):
+        iq_type = iq.get("type")
+        if iq_type not in ("get", "set"):
+            return
+        payload = u""
+        bind = iq.find("{%s}bind" % BIND_NS)
+        if bind is not None:
+            resource = bind.findtext("{%s}resource" % BIND_NS) or u"benchmark"
+            payload = u"<bind xmlns='%s'><jid>user@%s/%s</jid></bind>" % (
+                BIND_NS, escape(self.server.domain), escape(resource))
+        elif iq.find("{%s}query" % DISCO_INFO_NS) is not None:
+            features = u"<feature var='%s'/>" % DISCO_INFO_NS
+            if self.server.multicast:
+                features += u"<feature var='%s'/>" % ADDRESS_NS
+            payload = (u"<query xmlns='%s'><identity category='server' type='im'/>%s"
+                       u"</query>" % (DISCO_INFO_NS, features))
+        elif iq.find("{%s}query" % ROSTER_NS) is not None:
+            payload = u"<query xmlns='%s'/>" % ROSTER_NS
+        self.send(u"<iq type='result' id=%s from=%s>%s</iq>"
+                  % (quoteattr(iq.get("id", u"")), quoteattr(self.server.domain), payload))
@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+#
+# run.py -- Benchmarks of the XMPP notification pipeline.
+#
+# Copyright (c) 2013  Horatiu Eugen Vlad
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+"""
+Measures the latency and throughput of the notification pipeline against an
+in-process fake XMPP server, on synthetic review requests stored in an
+in-memory database.
+
+Run it from the source tree, in a Python environment where Review Board and
+the extension requirements are installed::
+
+    python benchmarks/run.py --users 500 --group-size 100 --stars 50
+"""
+
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.dirname(BENCHMARKS_DIR)
+TESTS_DIR = os.path.join(SOURCE_DIR, "tests")
+
+# reviewboard.settings imports the settings_local module of the tests, which
+# the benchmarks share.
+sys.path.insert(0, TESTS_DIR)
+sys.path.insert(1, SOURCE_DIR)
+sys.path.insert(2, BENCHMARKS_DIR)
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "reviewboard.settings")
+
+from fakeserver import FakeXmppServer
+
+PASSWORD = "benchmark"
+
+# Imports the modules in a fresh interpreter, after Review Board, and prints
+# the import time, the growth of the resident memory in KB and whether
+# pyxmpp2 got loaded.
+IMPORT_SCRIPT = """
+import os, resource, sys, time
+sys.path[:0] = %r
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "reviewboard.settings")
+import reviewboard.reviews.models
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.time()
+for module in %r:
+    __import__(module)
+print("%%f %%d %%d" %% (time.time() - start,
+                      resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss,
+                      "pyxmpp2" in sys.modules))
+"""
+
+
+class BenchmarkExtension(object):
+    """
+    Stands in for the extension, holding its settings.
+    """
+    def __init__(self, settings):
+        self.settings = settings
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def report(name, durations, items=None):
+    """
+    Prints the p50 and p99 of the durations and the throughput in operations
+    per second, or in ``items`` per second when given.
+    """
+    total = sum(durations)
+    rate = (items if items is not None else len(durations)) / total if total else 0
+    print("%-44s %7d %10.3f %10.3f %12.1f" % (
+        name, len(durations),
+        percentile(durations, 0.5) * 1000,
+        percentile(durations, 0.99) * 1000,
+        rate))
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200,
+                        help="number of users")
+    parser.add_argument("--groups", type=int, default=10,
+                        help="number of review groups")
+    parser.add_argument("--group-size", type=int, default=50,
+                        help="number of members of each group")
+    parser.add_argument("--target-groups", type=int, default=2,
+                        help="number of target groups of each review request")
+    parser.add_argument("--target-people", type=int, default=3,
+                        help="number of target people of each review request")
+    parser.add_argument("--stars", type=int, default=20,
+                        help="number of users starring each review request")
+    parser.add_argument("--reviews", type=int, default=5,
+                        help="number of reviews of each review request")
+    parser.add_argument("--review-requests", type=int, default=20,
+                        help="number of review requests")
+    parser.add_argument("--iterations", type=int, default=200,
+                        help="number of operations measured per benchmark")
+    parser.add_argument("--backend", choices=("pyxmpp2", "asyncio"), default="pyxmpp2",
+                        help="XMPP client backend")
+    parser.add_argument("--tls", action="store_true",
+                        help="use STARTTLS, with a self-signed certificate made by openssl")
+    parser.add_argument("--multicast", action="store_true",
+                        help="advertise XEP-0033 multicast on the fake server")
+    parser.add_argument("--stream-management", action="store_true",
+                        help="advertise XEP-0198 stream management on the fake server")
+    parser.add_argument("--xhtml", action="store_true",
+                        help="send XHTML-IM messages")
+    parser.add_argument("--timeout", type=int, default=60,
+                        help="seconds to wait for the messages to reach the server")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="random seed of the synthetic data")
+    parser.add_argument("--import-runs", type=int, default=5,
+                        help="number of interpreters started to measure the import cost")
+    return parser.parse_args()
+
+
+def setup_django():
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.db.models.loading import load_app
+
+    # The extension is not enabled through the extension manager, so its
+    # models are added to the installed apps here and its templates are
+    # found through the template directories.
+    settings.INSTALLED_APPS = list(settings.INSTALLED_APPS) + ["rbxmppnotification"]
+    load_app("rbxmppnotification")
+    settings.TEMPLATE_DIRS = tuple(settings.TEMPLATE_DIRS) + (
+        os.path.join(SOURCE_DIR, "rbxmppnotification", "templates"),)
+    call_command("syncdb", interactive=False, verbosity=0)
+
+
+def create_review_requests(options):
+    """
+    Creates the users, groups and public review requests with their target
+    groups, target people, stars and reviews. Returns the review requests.
+    """
+    from django.contrib.auth.models import User
+    from reviewboard.accounts.models import Profile
+    from reviewboard.reviews.models import Group, Review, ReviewRequest
+
+    rng = random.Random(options.seed)
+
+    User.objects.bulk_create([User(username="user%d" % i,
+                                   email="user%d@example.com" % i)
+                              for i in range(options.users)])
+    users = list(User.objects.order_by("pk"))
+    Profile.objects.bulk_create([Profile(user=user) for user in users])
+    profiles = list(Profile.objects.all())
+
+    groups = []
+    for i in range(options.groups):
+        group = Group.objects.create(name="group%d" % i, display_name="Group %d" % i)
+        group.users.add(*rng.sample(users, min(options.group_size, len(users))))
+        groups.append(group)
+
+    review_requests = []
+    for i in range(options.review_requests):
+        review_request = ReviewRequest.objects.create(rng.choice(users), None)
+        review_request.summary = "Benchmark review request %d" % i
+        review_request.public = True
+        review_request.save()
+        review_request.target_groups.add(
+            *rng.sample(groups, min(options.target_groups, len(groups))))
+        review_request.target_people.add(
+            *rng.sample(users, min(options.target_people, len(users))))
+        for profile in rng.sample(profiles, min(options.stars, len(profiles))):
+            profile.starred_review_requests.add(review_request)
+        for user in rng.sample(users, min(options.reviews, len(users))):
+            Review.objects.create(review_request=review_request, user=user, public=True)
+        review_requests.append(review_request)
+    return review_requests
+
+
+def create_certificate(directory):
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+                           "-subj", "/CN=localhost", "-days", "1",
+                           "-keyout", keyfile, "-out", certfile],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return certfile, keyfile
+
+
+def bench_import(runs):
+    """
+    Measures what loading the extension costs a worker process, with the
+    XMPP client left for the first notification and with the pyxmpp2 client
+    loaded up front, as it used to be.
+    """
+    for name, modules in (
+            ("import extension", ["rbxmppnotification.extension"]),
+            ("import extension and pyxmpp2 client",
+             ["rbxmppnotification.extension", "rbxmppnotification.pyxmpp2client"])):
+        durations = []
+        memory = []
+        for i in range(runs):
+            output = subprocess.check_output(
+                [sys.executable, "-c",
+                 IMPORT_SCRIPT % ([TESTS_DIR, SOURCE_DIR], modules)])
+            duration, rss, pyxmpp2 = output.split()
+            durations.append(float(duration))
+            memory.append(int(rss))
+        report(name, durations)
+        print("%-44s %7s %10d KB resident, pyxmpp2 %s" % (
+            "", "", percentile(memory, 0.5),
+            int(pyxmpp2) and "loaded" or "not loaded"))
+
+
+def bench_recipients(review_requests, iterations):
+    from rbxmppnotification.recipients import get_users_review_request, \
+                                              get_users_review_requests, recipient_cache
+
+    durations = []
+    for i in range(iterations):
+        review_request = review_requests[i % len(review_requests)]
+        start = time.time()
+        get_users_review_request(review_request)
+        durations.append(time.time() - start)
+    report("get_users_review_request", durations)
+
+    durations = []
+    for i in range(iterations):
+        start = time.time()
+        get_users_review_requests(review_requests)
+        durations.append(time.time() - start)
+    report("get_users_review_requests (%d at once)" % len(review_requests), durations)
+
+    for review_request in review_requests:
+        recipient_cache.get_recipients(review_request)
+    durations = []
+    for i in range(iterations):
+        review_request = review_requests[i % len(review_requests)]
+        start = time.time()
+        recipient_cache.get_recipients(review_request)
+        durations.append(time.time() - start)
+    report("recipient_cache.get_recipients (cached)", durations)
+
+
+def bench_templates(sender, review_requests, iterations, xhtml):
+    from rbxmppnotification.coalesce import EVENT_PUBLISHED
+    from rbxmppnotification.xmpp import get_review_request_url
+
+    def render(review_request):
+        sender.templates.render(EVENT_PUBLISHED, {
+            'user': review_request.submitter,
+            'review_request': review_request,
+            'review_request_url': get_review_request_url(review_request),
+        }, xhtml)
+
+    # The first renders compile the templates and fetch the submitters,
+    # which is not what is measured.
+    for review_request in review_requests:
+        render(review_request)
+    durations = []
+    for i in range(iterations):
+        review_request = review_requests[i % len(review_requests)]
+        start = time.time()
+        render(review_request)
+        durations.append(time.time() - start)
+    report("XmppMessageTemplates.render", durations)
+
+
+def bench_send(name, send, server, events, iterations, timeout):
+    """
+    Measures the time spent in the ``send`` call, which runs on the request
+    thread, and the time until the messages reach the server, one event at a
+    time. Then measures the throughput of back to back events.
+    """
+    calls = []
+    latencies = []
+    messages = 0
+    for i in range(iterations):
+        args, count = events[i % len(events)]
+        expected = server.messages + count
+        start = time.time()
+        send(*args)
+        calls.append(time.time() - start)
+        if not server.wait_messages(expected, timeout):
+            print("%s: timeout waiting for the messages" % name)
+            return
+        latencies.append(time.time() - start)
+        messages += count
+    report("%s (call)" % name, calls)
+    report("%s (delivered, messages/s)" % name, latencies, messages)
+
+    expected = server.messages
+    start = time.time()
+    for i in range(iterations):
+        args, count = events[i % len(events)]
+        send(*args)
+        expected += count
+    if not server.wait_messages(expected, timeout):
+        print("%s: timeout waiting for the messages" % name)
+        return
+    elapsed = time.time() - start
+    print("%-44s %7d events %10.1f events/s %10.1f messages/s" % (
+        "%s (back to back)" % name, iterations,
+        iterations / elapsed, messages / elapsed))
+
+
+def bench_reconnect(send, server, events, iterations, timeout):
+    """
+    Measures the time until the messages of an event sent right after the
+    connections dropped reach the server. Without stream management, the
+    messages written to the dropped connections are lost.
+    """
+    latencies = []
+    lost = 0
+    for i in range(iterations):
+        args, count = events[i % len(events)]
+        expected = server.messages + count
+        server.drop_connections()
+        start = time.time()
+        send(*args)
+        if not server.wait_messages(expected, timeout):
+            lost += 1
+            continue
+        latencies.append(time.time() - start)
+    if latencies:
+        report("reconnect (delivered)", latencies)
+    print("%-44s %7d lost of %d" % ("reconnect", lost, iterations))
+
+
+def bench_priority(sender, server, closed, reviewed, iterations, timeout):
+    """
+    Measures the time the notifications wait in each priority lane while a
+    flood of closings is queued together with a few reviews.
+    """
+    from rbxmppnotification.metrics import QUEUE_WAIT
+
+    QUEUE_WAIT.values.clear()
+    expected = server.messages
+    for i in range(iterations * 10):
+        args, count = closed[i % len(closed)]
+        sender.send_review_request_closed(*args)
+        expected += count
+        if i % 10 == 0:
+            args, count = reviewed[i % len(reviewed)]
+            sender.send_review_published(*args)
+            expected += count
+    if not server.wait_messages(expected, timeout):
+        print("priority: timeout waiting for the messages")
+        return
+    for labels, count, mean, p50, p99 in QUEUE_WAIT.get_rows():
+        print("%-44s %7d %10.1f %10s" % ("queue wait %s (mean ms, p99 <= s)" % labels,
+                                         count, mean * 1000, p99))
+
+
+def main():
+    options = parse_options()
+    setup_django()
+
+    from rbxmppnotification.extension import RBXmppNotification
+    from rbxmppnotification.recipients import recipient_cache
+    from rbxmppnotification.siteurl import site_base_url
+    from rbxmppnotification.xmpp import XmppSender
+
+    print("Creating %d review requests..." % options.review_requests)
+    review_requests = create_review_requests(options)
+
+    certdir = tempfile.mkdtemp(prefix="rbxmppnotification-benchmarks-")
+    certfile = keyfile = None
+    if options.tls:
+        certfile, keyfile = create_certificate(certdir)
+    server = FakeXmppServer(PASSWORD, certfile=certfile, keyfile=keyfile,
+                            multicast=options.multicast,
+                            stream_management=options.stream_management)
+    server.start()
+
+    settings = dict(RBXmppNotification.default_settings)
+    settings.update({
+        'xmpp_backend': options.backend,
+        'xmpp_host': "127.0.0.1",
+        'xmpp_port': server.port,
+        'xmpp_timeout': 10,
+        'xmpp_sender_jid': "rb@example.com/benchmark",
+        'xmpp_sender_password': PASSWORD,
+        'xmpp_use_tls': options.tls,
+        'xmpp_tls_verify_peer': False,
+        'xmpp_use_xhtml_im': options.xhtml,
+        'xmpp_partychat': "",
+        'xmpp_partychat_only': False,
+        'xmpp_queue_size': 0,
+        'xmpp_coalesce_window': 0,
+    })
+    sender = XmppSender(BenchmarkExtension(settings))
+    site_base_url.url = u"http://localhost"
+
+    # Every event is sent to the recipients but the user who triggered it.
+    published = []
+    closed = []
+    reviewed = []
+    for review_request in review_requests:
+        recipients = recipient_cache.get_recipients(review_request)
+        user = review_request.submitter
+        published.append(((user, review_request, None),
+                          len([r for r in recipients if r.id != user.pk])))
+        closed.append(((user, review_request),
+                       len([r for r in recipients if r.id != user.pk])))
+        review = review_request.reviews.all()[0]
+        reviewed.append(((review.user, review),
+                         len([r for r in recipients if r.id != review.user_id])))
+
+    print("%-44s %7s %10s %10s %12s" % ("benchmark", "n", "p50 ms", "p99 ms", "per second"))
+    try:
+        bench_import(options.import_runs)
+        bench_recipients(review_requests, options.iterations)
+        bench_templates(sender, review_requests, options.iterations, options.xhtml)
+        bench_send("send_review_request_published", sender.send_review_request_published,
+                   server, published, options.iterations, options.timeout)
+        bench_send("send_review_published", sender.send_review_published,
+                   server, reviewed, options.iterations, options.timeout)
+        bench_priority(sender, server, closed, reviewed, options.iterations,
+                       options.timeout)
+        bench_reconnect(sender.send_review_request_published, server, published,
+                        min(options.iterations, 5), options.timeout)
+        print("%d connections, %d resumed, %d stanzas, %d messages received by the server" % (
+            server.connections, server.resumptions, server.stanzas, server.messages))
+    finally:
+        sender.shutdown()
+        server.stop()
+        shutil.rmtree(certdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -34,4 +34,6 @@ urlpatterns = patterns('',
      {'ext_class': RBXmppNotification,
       'form_class': RBXmppNotificationSettingsForm,
     }),
+    (r'^metrics/$', 'rbxmppnotification.views.metrics'),
+    (r'^metrics/prometheus/$', 'rbxmppnotification.views.metrics_text'),
 )
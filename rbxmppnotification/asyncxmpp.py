@@ -0,0 +1,860 @@
+#
+# asyncxmpp.py -- XMPP client backend running on an asyncio event loop.
+#
+# Copyright (c) 2013  Horatiu Eugen Vlad
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+import base64
+import collections
+import hashlib
+import hmac
+import itertools
+import logging
+import os
+import ssl
+import threading
+import time
+import uuid
+import xml.parsers.expat
+
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape, quoteattr
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+from rbxmppnotification.metrics import CONNECT_TIME
+from rbxmppnotification.presence import presence, get_bare_jid
+from rbxmppnotification.transport import XmppTransport, BACKEND_ASYNCIO, PING_NS, \
+                                         DISCO_INFO_NS, ADDRESS_NS, MUC_NS, SM_NS, \
+                                         XHTML_IM_BODY, get_jid_domain
+
+STREAM_NS = "http://etherx.jabber.org/streams"
+CLIENT_NS = "jabber:client"
+TLS_NS = "urn:ietf:params:xml:ns:xmpp-tls"
+SASL_NS = "urn:ietf:params:xml:ns:xmpp-sasl"
+BIND_NS = "urn:ietf:params:xml:ns:xmpp-bind"
+SESSION_NS = "urn:ietf:params:xml:ns:xmpp-session"
+STANZAS_NS = "urn:ietf:params:xml:ns:xmpp-stanzas"
+
+STREAM_HEADER = (u"<?xml version='1.0'?><stream:stream xmlns='%s'"
+                 u" xmlns:stream='%s' to=%%s version='1.0'>" % (CLIENT_NS, STREAM_NS))
+STREAM_END = u"</stream:stream>"
+
+
+def get_tag(name):
+    """
+    Returns the ElementTree tag of a name reported by the expat parser, which
+    separates the namespace from the local name with ``}``.
+    """
+    if "}" in name:
+        return "{" + name
+    return name
+
+
+class ScramSha1(object):
+    """
+    The client side of the SCRAM-SHA-1 SASL mechanism (RFC 5802), without
+    channel binding.
+    """
+    NAME = "SCRAM-SHA-1"
+
+    def __init__(self, username, password):
+        username = username.encode("utf-8").replace(b"=", b"=3D").replace(b",", b"=2C")
+        self.password = password.encode("utf-8")
+        self.nonce = base64.b64encode(os.urandom(18))
+        self.first_bare = b"n=" + username + b",r=" + self.nonce
+        self.server_signature = None
+
+    def get_initial_response(self):
+        return b"n,," + self.first_bare
+
+    def get_response(self, challenge):
+        """
+        Returns the response to a server challenge. Raises ``ValueError`` if
+        the challenge is not valid.
+        """
+        attrs = dict(item.split(b"=", 1) for item in challenge.split(b",") if b"=" in item)
+        if self.server_signature is not None:
+            # Some servers send the server signature as a last challenge.
+            if not self.verify(challenge):
+                raise ValueError("invalid SCRAM server signature")
+            return b""
+        nonce = attrs.get(b"r", b"")
+        if not nonce.startswith(self.nonce):
+            raise ValueError("invalid SCRAM nonce")
+        salt = base64.b64decode(attrs[b"s"])
+        iterations = int(attrs[b"i"])
+        salted = hashlib.pbkdf2_hmac("sha1", self.password, salt, iterations)
+        client_key = hmac.new(salted, b"Client Key", hashlib.sha1).digest()
+        stored_key = hashlib.sha1(client_key).digest()
+        final_bare = b"c=biws,r=" + nonce
+        auth_message = self.first_bare + b"," + challenge + b"," + final_bare
+        signature = hmac.new(stored_key, auth_message, hashlib.sha1).digest()
+        proof = bytes(bytearray(a ^ b for a, b in zip(bytearray(client_key),
+                                                      bytearray(signature))))
+        server_key = hmac.new(salted, b"Server Key", hashlib.sha1).digest()
+        self.server_signature = hmac.new(server_key, auth_message, hashlib.sha1).digest()
+        return final_bare + b",p=" + base64.b64encode(proof)
+
+    def verify(self, data):
+        """
+        Returns ``True`` if the additional data of the server proves that it
+        knows the password.
+        """
+        attrs = dict(item.split(b"=", 1) for item in data.split(b",") if b"=" in item)
+        signature = base64.b64decode(attrs.get(b"v", b""))
+        return (self.server_signature is not None and
+                hmac.compare_digest(signature, self.server_signature))
+
+
+class Plain(object):
+    """
+    The client side of the PLAIN SASL mechanism (RFC 4616). Only used over
+    encrypted streams.
+    """
+    NAME = "PLAIN"
+
+    def __init__(self, username, password):
+        self.username = username.encode("utf-8")
+        self.password = password.encode("utf-8")
+
+    def get_initial_response(self):
+        return b"\0" + self.username + b"\0" + self.password
+
+    def get_response(self, challenge):
+        raise ValueError("unexpected PLAIN challenge")
+
+    def verify(self, data):
+        return True
+
+
+class XmppEventLoop(object):
+    """
+    An asyncio event loop running in a background thread. The loop is shared
+    by all the asyncio sessions, so a single thread multiplexes them.
+    """
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def get_loop(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.run, args=(self.loop,),
+                                               name="rbxmppnotification-asyncio")
+                self.thread.daemon = True
+                self.thread.start()
+            return self.loop
+
+    def run(self, loop):
+        logging.debug(u"XmppEventLoop started")
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+        logging.debug(u"XmppEventLoop finished")
+
+event_loop = XmppEventLoop()
+
+
+class XmppStream(asyncio.Protocol):
+    """
+    A client-to-server XMPP stream (RFC 6120): STARTTLS, SASL authentication,
+    resource binding, XEP-0198 stream management and the iq request/response
+    tracking. Used only from the event loop thread.
+
+    The stanzas are written with ``send_stanzas``, which counts them once
+    stream management is enabled. The counters and the unacknowledged
+    stanzas are kept by the client, so they outlive the stream.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.transport = None
+        self.parser = None
+        self.builder = None
+        self.depth = 0
+        self.features = None
+        self.tls = False
+        self.tls_pending = False
+        self.mechanism = None
+        self.authenticated = False
+        self.after_parse = None
+        self.jid = None
+        self.id_prefix = uuid.uuid4().hex
+        self.ids = itertools.count()
+        self.handlers = {}
+        self.sm_enabled = False
+        self.sm_resuming = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if not self.tls_pending:
+            self.start_stream()
+
+    def connection_lost(self, exc):
+        if self.tls_pending:
+            # The plain transport handed its socket over to the TLS one.
+            return
+        logging.debug(u"XmppStream connection lost: %s", exc)
+        self.transport = None
+        self.client.handle_disconnected(self)
+
+    def data_received(self, data):
+        try:
+            self.parser.Parse(data, False)
+        except Exception, e:
+            logging.error("XMPP stream error: %s", e, exc_info=1)
+            self.abort()
+            return
+        # Restarting the stream replaces the parser, which cannot be done
+        # while it is parsing.
+        after_parse, self.after_parse = self.after_parse, None
+        if after_parse is not None:
+            after_parse()
+
+    def write(self, data):
+        self.transport.write(data.encode("utf-8"))
+
+    def send_stanzas(self, stanzas, request_ack=False):
+        """
+        Writes the stanzas. With stream management, they are kept until the
+        server acknowledges them, which is requested if ``request_ack``.
+        """
+        self.write(u"".join(stanzas))
+        if self.sm_enabled:
+            self.client.track_stanzas(stanzas)
+            if request_ack:
+                self.write(u"<r xmlns='%s'/>" % SM_NS)
+
+    def send_stanza(self, stanza):
+        self.send_stanzas([stanza])
+
+    def abort(self):
+        if self.transport is not None:
+            self.transport.abort()
+
+    def close(self):
+        """
+        Closes the stream gracefully.
+        """
+        if self.transport is not None:
+            self.write(STREAM_END)
+            self.transport.close()
+
+    def start_stream(self):
+        self.parser = xml.parsers.expat.ParserCreate("UTF-8", "}")
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self.handle_start
+        self.parser.EndElementHandler = self.handle_end
+        self.parser.CharacterDataHandler = self.handle_data
+        self.builder = None
+        self.depth = 0
+        self.write(STREAM_HEADER % quoteattr(self.client.domain))
+
+    def handle_start(self, name, attrs):
+        self.depth += 1
+        if self.depth == 1:
+            return
+        if self.depth == 2:
+            self.builder = ElementTree.TreeBuilder()
+        self.builder.start(get_tag(name),
+                           dict((get_tag(key), value) for key, value in attrs.items()))
+
+    def handle_end(self, name):
+        self.depth -= 1
+        if self.depth == 0:
+            logging.debug(u"XmppStream closed by the server")
+            self.close()
+            return
+        self.builder.end(get_tag(name))
+        if self.depth == 1:
+            element = self.builder.close()
+            self.builder = None
+            self.handle_element(element)
+
+    def handle_data(self, data):
+        if self.builder is not None:
+            self.builder.data(data)
+
+    def handle_element(self, element):
+        tag = element.tag
+        if self.sm_enabled and tag in ("{%s}iq" % CLIENT_NS, "{%s}presence" % CLIENT_NS,
+                                       "{%s}message" % CLIENT_NS):
+            self.client.sm_inbound += 1
+        if tag == "{%s}iq" % CLIENT_NS:
+            self.handle_iq(element)
+        elif tag == "{%s}presence" % CLIENT_NS:
+            self.client.handle_presence(element)
+        elif tag == "{%s}r" % SM_NS:
+            self.write(u"<a xmlns='%s' h='%d'/>" % (SM_NS, self.client.sm_inbound))
+        elif tag == "{%s}a" % SM_NS:
+            self.client.handle_ack(int(element.get("h")))
+        elif tag == "{%s}enabled" % SM_NS:
+            self.handle_enabled(element)
+        elif tag == "{%s}resumed" % SM_NS:
+            self.handle_resumed(element)
+        elif tag == "{%s}failed" % SM_NS:
+            self.handle_sm_failed(element)
+        elif tag == "{%s}features" % STREAM_NS:
+            self.handle_features(element)
+        elif tag == "{%s}proceed" % TLS_NS:
+            self.after_parse = self.start_tls
+        elif tag == "{%s}challenge" % SASL_NS:
+            self.handle_challenge(element)
+        elif tag == "{%s}success" % SASL_NS:
+            self.handle_success(element)
+        elif tag in ("{%s}failure" % TLS_NS, "{%s}failure" % SASL_NS):
+            logging.error("XMPP authentication as %s failed: %s",
+                          self.client.from_jid, ElementTree.tostring(element))
+            self.abort()
+        elif tag == "{%s}error" % STREAM_NS:
+            logging.error("XMPP stream error: %s", ElementTree.tostring(element))
+            self.abort()
+
+    def handle_features(self, features):
+        self.features = features
+        if (not self.tls and self.client.use_tls and
+                features.find("{%s}starttls" % TLS_NS) is not None):
+            self.write(u"<starttls xmlns='%s'/>" % TLS_NS)
+        elif not self.authenticated:
+            self.authenticate(features)
+        elif self.client.sm_id and features.find("{%s}sm" % SM_NS) is not None:
+            logging.debug(u"XmppStream resuming stream %s", self.client.sm_id)
+            self.sm_resuming = True
+            self.write(u"<resume xmlns='%s' h='%d' previd=%s/>" % (
+                SM_NS, self.client.sm_inbound, quoteattr(self.client.sm_id)))
+        else:
+            self.bind()
+
+    def bind(self):
+        if self.features.find("{%s}bind" % BIND_NS) is not None:
+            resource = u""
+            if self.client.resource:
+                resource = u"<resource>%s</resource>" % escape(self.client.resource)
+            self.send_iq("set", None, u"<bind xmlns='%s'>%s</bind>" % (BIND_NS, resource),
+                         self.handle_bind)
+        else:
+            logging.error("XMPP server does not offer resource binding")
+            self.abort()
+
+    def start_tls(self):
+        self.tls_pending = True
+        context = ssl.create_default_context()
+        if not self.client.tls_verify_peer:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        loop = self.client.loop
+        if hasattr(loop, "start_tls"):
+            task = loop.create_task(loop.start_tls(self.transport, self, context,
+                                                   server_hostname=self.client.domain))
+        else:
+            # Older event loops cannot upgrade a transport, so its socket is
+            # handed over to a new TLS transport.
+            sock = self.transport.get_extra_info("socket").dup()
+            self.transport.abort()
+            task = loop.create_task(loop.create_connection(
+                lambda: self, sock=sock, ssl=context,
+                server_hostname=self.client.domain))
+        task.add_done_callback(self.handle_tls)
+
+    def handle_tls(self, task):
+        self.tls_pending = False
+        if task.cancelled() or task.exception() is not None:
+            logging.error("XMPP TLS negotiation with %s failed: %s",
+                          self.client.domain,
+                          None if task.cancelled() else task.exception())
+            self.abort()
+            self.transport = None
+            self.client.handle_disconnected(self)
+            return
+        transport = task.result()
+        if isinstance(transport, tuple):
+            transport = transport[0]
+        self.transport = transport
+        self.tls = True
+        self.start_stream()
+
+    def authenticate(self, features):
+        mechanisms = [mechanism.text for mechanism in
+                      features.iter("{%s}mechanism" % SASL_NS)]
+        if ScramSha1.NAME in mechanisms:
+            self.mechanism = ScramSha1(self.client.username, self.client.password)
+        elif Plain.NAME in mechanisms and self.tls:
+            self.mechanism = Plain(self.client.username, self.client.password)
+        else:
+            logging.error("XMPP server offers no supported authentication mechanism: %s",
+                          mechanisms)
+            self.abort()
+            return
+        self.write(u"<auth xmlns='%s' mechanism='%s'>%s</auth>" % (
+            SASL_NS, self.mechanism.NAME,
+            base64.b64encode(self.mechanism.get_initial_response()).decode("ascii")))
+
+    def handle_challenge(self, element):
+        try:
+            response = self.mechanism.get_response(base64.b64decode(element.text or b""))
+        except Exception, e:
+            logging.error("XMPP authentication as %s failed: %s",
+                          self.client.from_jid, e)
+            self.abort()
+            return
+        self.write(u"<response xmlns='%s'>%s</response>" % (
+            SASL_NS, base64.b64encode(response).decode("ascii")))
+
+    def handle_success(self, element):
+        if element.text and not self.mechanism.verify(base64.b64decode(element.text)):
+            logging.error("XMPP server %s could not be authenticated", self.client.domain)
+            self.abort()
+            return
+        self.authenticated = True
+        self.after_parse = self.start_stream
+
+    def handle_bind(self, iq):
+        jid = iq.find("{%s}bind/{%s}jid" % (BIND_NS, BIND_NS))
+        if iq.get("type") != "result" or jid is None:
+            logging.error("XMPP resource binding failed: %s", ElementTree.tostring(iq))
+            self.abort()
+            return
+        self.jid = jid.text
+        session = self.features.find("{%s}session" % SESSION_NS)
+        if session is not None and session.find("{%s}optional" % SESSION_NS) is None:
+            self.send_iq("set", None, u"<session xmlns='%s'/>" % SESSION_NS,
+                         self.handle_session)
+        else:
+            self.handle_session(None)
+
+    def handle_session(self, iq):
+        if iq is not None and iq.get("type") != "result":
+            logging.error("XMPP session establishment failed: %s", ElementTree.tostring(iq))
+            self.abort()
+            return
+        if self.features.find("{%s}sm" % SM_NS) is not None:
+            self.write(u"<enable xmlns='%s' resume='true'/>" % SM_NS)
+        else:
+            self.start_session()
+
+    def start_session(self, sm_id=None):
+        """
+        Sends the initial presence once the stream is set up. The stanzas
+        left unacknowledged by a stream that could not be resumed are sent
+        again on this one.
+        """
+        unacked = self.client.reset_stream_management(sm_id)
+        self.send_stanza(u"<presence/>")
+        if unacked:
+            logging.debug(u"XmppStream sending %d unacknowledged stanzas again", len(unacked))
+            self.send_stanzas(unacked, True)
+        self.client.handle_authorized(self, False)
+
+    def handle_enabled(self, element):
+        logging.debug(u"XmppStream stream management enabled, resumable %s",
+                      element.get("resume"))
+        self.sm_enabled = True
+        if element.get("resume") in ("true", "1"):
+            self.start_session(element.get("id"))
+        else:
+            self.start_session()
+
+    def handle_resumed(self, element):
+        """
+        The previous stream is resumed without binding a new resource: only
+        the stanzas the server did not acknowledge are sent again.
+        """
+        self.sm_resuming = False
+        self.sm_enabled = True
+        unacked = self.client.handle_resumed(int(element.get("h")))
+        logging.debug(u"XmppStream stream %s resumed, sending %d stanzas again",
+                      self.client.sm_id, len(unacked))
+        if unacked:
+            self.send_stanzas(unacked, True)
+        self.client.handle_authorized(self, True)
+
+    def handle_sm_failed(self, element):
+        if self.sm_resuming:
+            logging.debug(u"XmppStream stream %s could not be resumed", self.client.sm_id)
+            self.sm_resuming = False
+            self.client.sm_id = None
+            if element.get("h") is not None:
+                self.client.handle_ack(int(element.get("h")))
+            self.bind()
+        else:
+            logging.debug(u"XmppStream stream management not enabled")
+            self.start_session()
+
+    def send_iq(self, iq_type, to_jid, payload, handler=None):
+        """
+        Sends an iq request. The ``handler`` is called with the response.
+        """
+        stanza_id = u"%s-%d" % (self.id_prefix, next(self.ids))
+        to = u""
+        if to_jid:
+            to = u" to=%s" % quoteattr(to_jid)
+        self.send_stanza(u"<iq type='%s' id='%s'%s>%s</iq>" % (iq_type, stanza_id, to, payload))
+        if handler is not None:
+            self.handlers[stanza_id] = handler
+
+    def handle_iq(self, iq):
+        iq_type = iq.get("type")
+        if iq_type in ("result", "error"):
+            handler = self.handlers.pop(iq.get("id"), None)
+            if handler is not None:
+                handler(iq)
+            return
+        reply = u"<iq type='%%s' id=%s to=%s>%%s</iq>" % (
+            quoteattr(iq.get("id", u"")), quoteattr(iq.get("from", self.client.domain)))
+        if iq_type == "get" and iq.find("{%s}ping" % PING_NS) is not None:
+            self.send_stanza(reply % ("result", u""))
+        else:
+            self.send_stanza(reply % ("error", u"<error type='cancel'><service-unavailable"
+                                               u" xmlns='%s'/></error>" % STANZAS_NS))
+
+
+class AsyncXmppClient(XmppTransport):
+    """
+    A long-lived client that keeps an authenticated XMPP session open on the
+    shared asyncio event loop.
+
+    The stanzas are serialized on the calling thread and written to the
+    stream from the event loop. The session is re-established with an
+    exponential backoff when the connection drops and kept alive with
+    XEP-0199 pings while idle.
+
+    When the server supports XEP-0198 stream management, the stanzas are
+    kept in a ring buffer until the server acknowledges them, which is
+    requested after every message batch. A dropped stream is resumed on
+    reconnect, skipping the resource binding and the initial presence, and
+    only the unacknowledged stanzas are sent again.
+    """
+    KEEPALIVE_INTERVAL = 60
+    UNACKED_MAX = 1000
+    MULTICAST_MIN_RECEIVERS = 3
+    MULTICAST_BATCH_SIZE = 50
+    RECONNECT_MIN_DELAY = 1
+    RECONNECT_MAX_DELAY = 300
+
+    def __init__(self, host, port, timeout, from_jid, password, use_tls, tls_verify_peer):
+        self.host = host
+        self.port = port
+        self.timeout = timeout or 5
+        self.from_jid = from_jid
+        self.password = password
+        self.use_tls = use_tls
+        self.tls_verify_peer = tls_verify_peer
+
+        bare_jid, _, self.resource = from_jid.partition("/")
+        self.username = bare_jid.split("@")[0]
+        self.domain = get_jid_domain(from_jid)
+
+        self.loop = None
+        self.stream = None
+        self.lock = threading.Lock()
+        self.authorized = threading.Event()
+        self.disconnected = threading.Event()
+        self.multicast_jid = None
+        self.rooms = {}
+        self.joined_rooms = set()
+        self.running = False
+        self.reconnect_delay = self.RECONNECT_MIN_DELAY
+        self.reconnect_handle = None
+        self.timeout_handle = None
+        self.keepalive_handle = None
+        self.connect_started = 0
+        self.sm_id = None
+        self.sm_inbound = 0
+        self.sm_outbound = 0
+        self.unacked = collections.deque(maxlen=self.UNACKED_MAX)
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+            self.disconnected.clear()
+            self.loop = event_loop.get_loop()
+            self.loop.call_soon_threadsafe(self.connect)
+
+    def stop(self):
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+            self.loop.call_soon_threadsafe(self.disconnect)
+        self.disconnected.wait(self.timeout + 1)
+
+    def connect(self):
+        self.reconnect_handle = None
+        if not self.running:
+            return
+        logging.debug(u"AsyncXmppClient connecting to %s:%s as %s",
+                      self.host, self.port, self.from_jid)
+        stream = self.stream = XmppStream(self)
+        self.connect_started = time.time()
+        task = self.loop.create_task(self.loop.create_connection(
+            lambda: stream, self.host or self.domain, self.port or 5222))
+        task.add_done_callback(lambda task: self.handle_connected(stream, task))
+        self.timeout_handle = self.loop.call_later(
+            self.timeout, self.handle_timeout, stream, task)
+
+    def handle_connected(self, stream, task):
+        if task.cancelled() or task.exception() is not None:
+            logging.error("Error connecting to XMPP server %s:%s: %s",
+                          self.host, self.port,
+                          "timeout" if task.cancelled() else task.exception())
+            self.handle_disconnected(stream)
+        elif stream is not self.stream:
+            # The session was stopped while connecting.
+            stream.abort()
+
+    def handle_timeout(self, stream, task):
+        self.timeout_handle = None
+        if stream is self.stream and not self.authorized.is_set():
+            logging.error("XMPP session with %s:%s not established within %s seconds",
+                          self.host, self.port, self.timeout)
+            if task.done():
+                stream.abort()
+            else:
+                task.cancel()
+
+    def disconnect(self):
+        for handle in (self.reconnect_handle, self.keepalive_handle):
+            if handle is not None:
+                handle.cancel()
+        self.reconnect_handle = self.keepalive_handle = None
+        # A stream closed gracefully cannot be resumed.
+        self.reset_stream_management(None)
+        if self.stream is not None and self.stream.transport is not None:
+            logging.debug(u"AsyncXmppClient disconnecting stream")
+            self.stream.close()
+            self.loop.call_later(self.timeout, self.stream.abort)
+        else:
+            self.handle_disconnected(self.stream)
+
+    def handle_authorized(self, stream, resumed):
+        logging.debug(u"AsyncXmppClient authorized as %s", stream.jid)
+        if self.timeout_handle is not None:
+            self.timeout_handle.cancel()
+            self.timeout_handle = None
+        self.authorized.set()
+        CONNECT_TIME.observe(time.time() - self.connect_started, backend=BACKEND_ASYNCIO)
+        self.reconnect_delay = self.RECONNECT_MIN_DELAY
+        if not resumed:
+            self.joined_rooms = set()
+        self.update_rooms()
+        self.multicast_jid = None
+        stream.send_iq("get", self.domain, u"<query xmlns='%s'/>" % DISCO_INFO_NS,
+                       self.handle_disco_info)
+        self.keepalive_handle = self.loop.call_later(self.KEEPALIVE_INTERVAL,
+                                                     self.keepalive)
+
+    def track_stanzas(self, stanzas):
+        """
+        Keeps the stanzas written to a managed stream until they are
+        acknowledged. The oldest ones are dropped once the buffer is full.
+        """
+        for stanza in stanzas:
+            if len(self.unacked) == self.UNACKED_MAX:
+                logging.error("XMPP stream management buffer full, stanza %d will not be "
+                              "sent again", self.unacked[0][0])
+            self.sm_outbound += 1
+            self.unacked.append((self.sm_outbound, stanza))
+
+    def handle_ack(self, h):
+        while self.unacked and self.unacked[0][0] <= h:
+            self.unacked.popleft()
+
+    def handle_resumed(self, h):
+        """
+        Returns the stanzas the server did not receive before the stream
+        dropped, which are counted again when sent on the resumed stream.
+        """
+        self.handle_ack(h)
+        unacked = [stanza for seq, stanza in self.unacked]
+        self.unacked.clear()
+        self.sm_outbound = h
+        return unacked
+
+    def reset_stream_management(self, sm_id):
+        """
+        Starts counting the stanzas of a new stream, resumable with
+        ``sm_id``, and returns the stanzas left unacknowledged by the
+        previous one.
+        """
+        unacked = [stanza for seq, stanza in self.unacked]
+        self.unacked.clear()
+        self.sm_id = sm_id
+        self.sm_inbound = self.sm_outbound = 0
+        return unacked
+
+    def handle_disconnected(self, stream):
+        if stream is not self.stream:
+            return
+        logging.debug(u"AsyncXmppClient disconnected")
+        self.stream = None
+        self.authorized.clear()
+        self.multicast_jid = None
+        for handle in (self.timeout_handle, self.keepalive_handle):
+            if handle is not None:
+                handle.cancel()
+        self.timeout_handle = self.keepalive_handle = None
+        if self.running:
+            logging.debug(u"AsyncXmppClient reconnecting in %s seconds",
+                          self.reconnect_delay)
+            self.reconnect_handle = self.loop.call_later(self.reconnect_delay,
+                                                         self.connect)
+            self.reconnect_delay = min(self.reconnect_delay * 2,
+                                       self.RECONNECT_MAX_DELAY)
+        else:
+            self.disconnected.set()
+
+    def handle_presence(self, element):
+        """
+        Reports the presence of the contacts and approves their presence
+        subscription requests, subscribing back to their presence.
+        """
+        jid = element.get("from")
+        presence_type = element.get("type")
+        logging.debug(u"AsyncXmppClient presence %s from %s", presence_type, jid)
+        if not jid:
+            return
+        if presence_type is None:
+            presence.update(jid, True)
+        elif presence_type == "unavailable":
+            presence.update(jid, False)
+        elif presence_type == "subscribe" and self.stream is not None:
+            bare = quoteattr(get_bare_jid(jid))
+            self.stream.send_stanzas([u"<presence to=%s type='subscribed'/>" % bare,
+                                      u"<presence to=%s type='subscribe'/>" % bare])
+
+    def handle_disco_info(self, iq):
+        features = [feature.get("var") for feature in
+                    iq.iter("{%s}feature" % DISCO_INFO_NS)]
+        if iq.get("type") == "result" and ADDRESS_NS in features:
+            logging.debug(u"AsyncXmppClient server %s supports multicast", iq.get("from"))
+            self.multicast_jid = iq.get("from", self.domain)
+
+    def keepalive(self):
+        """
+        Sends a XEP-0199 ping to the server so idle connections are not
+        dropped by the server or by NAT devices along the way. The stream is
+        closed if the server does not answer within the connection timeout.
+        """
+        self.keepalive_handle = None
+        stream = self.stream
+        if stream is None or not self.authorized.is_set():
+            return
+        handle = self.loop.call_later(self.timeout, stream.abort)
+        stream.send_iq("get", self.domain, u"<ping xmlns='%s'/>" % PING_NS,
+                       lambda iq: handle.cancel())
+        self.keepalive_handle = self.loop.call_later(self.KEEPALIVE_INTERVAL,
+                                                     self.keepalive)
+
+    def set_rooms(self, rooms, nickname):
+        rooms = dict((room, u"%s/%s" % (room, nickname)) for room in rooms)
+        with self.lock:
+            if rooms == self.rooms:
+                return
+            self.rooms = rooms
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self.update_rooms)
+
+    def update_rooms(self):
+        """
+        Joins the configured rooms the session is not present in yet and
+        leaves the ones that are not configured anymore.
+        """
+        if self.stream is None or not self.authorized.is_set():
+            return
+        with self.lock:
+            rooms = set(self.rooms.items())
+        for room, occupant in self.joined_rooms - rooms:
+            logging.debug(u"AsyncXmppClient leaving room %s", occupant)
+            self.stream.send_stanza(u"<presence to=%s type='unavailable'/>" % quoteattr(occupant))
+        for room, occupant in rooms - self.joined_rooms:
+            logging.debug(u"AsyncXmppClient joining room %s", occupant)
+            self.stream.send_stanza(u"<presence to=%s><x xmlns='%s'><history maxchars='0'/>"
+                                    u"</x></presence>" % (quoteattr(occupant), MUC_NS))
+        self.joined_rooms = rooms
+
+    def build_stanzas(self, receivers, rooms, message, html):
+        """
+        Returns the list of serialized stanzas of a message. The payload is serialized
+        once and only the addressing differs between the stanzas. Large
+        receiver sets are sent through the XEP-0033 multicast service when
+        the server offers one.
+        """
+        stanza_id = uuid.uuid4().hex
+        payload = u"<body>%s</body>" % escape(message)
+        if html:
+            xhtml = XHTML_IM_BODY % html
+            # Invalid markup would make the server close the stream.
+            ElementTree.fromstring(xhtml.encode("utf-8"))
+            payload += xhtml
+
+        stanzas = [u"<message type='groupchat' to=%s id='%s-room-%d'>%s</message>"
+                   % (quoteattr(room), stanza_id, i, payload)
+                   for i, room in enumerate(rooms)]
+        multicast_jid = self.multicast_jid
+        if multicast_jid is not None and len(receivers) >= self.MULTICAST_MIN_RECEIVERS:
+            batch_size = self.MULTICAST_BATCH_SIZE
+            for i in range(0, len(receivers), batch_size):
+                addresses = u"".join(u"<address type='bcc' jid=%s/>" % quoteattr(receiver)
+                                     for receiver in receivers[i:i + batch_size])
+                stanzas.append(u"<message type='chat' to=%s id='%s-%d'>%s"
+                               u"<addresses xmlns='%s'>%s</addresses></message>"
+                               % (quoteattr(multicast_jid), stanza_id, i, payload,
+                                  ADDRESS_NS, addresses))
+        else:
+            stanzas.extend(u"<message type='chat' to=%s id='%s-%d'>%s</message>"
+                           % (quoteattr(receiver), stanza_id, i, payload)
+                           for i, receiver in enumerate(receivers))
+        return stanzas
+
+    def send(self, req_id, receivers, rooms, message, html=None):
+        logging.debug(u"AsyncXmppClient start sending messages for request #%s", req_id)
+        self.start()
+        if not self.authorized.wait(self.timeout):
+            logging.error("XMPP session not available, notification for request #%s deferred",
+                          req_id)
+            return False
+        stanzas = self.build_stanzas(receivers, rooms, message, html)
+        written = threading.Event()
+        result = []
+
+        def write():
+            if self.stream is not None and self.authorized.is_set():
+                self.stream.send_stanzas(stanzas, True)
+                result.append(True)
+            written.set()
+
+        self.loop.call_soon_threadsafe(write)
+        if not written.wait(self.timeout):
+            logging.error("XMPP event loop busy, notification for request #%s deferred",
+                          req_id)
+            return False
+        return bool(result)
@@ -0,0 +1,129 @@
+#
+# batch.py -- Batching of the review request events per transaction.
+#
+# Copyright (c) 2013  Horatiu Eugen Vlad
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+import logging
+import threading
+import weakref
+
+from django.core.signals import got_request_exception, request_finished, \
+                                request_started
+from django.db import transaction
+
+
+class XmppEventBatch(object):
+    """
+    Collects the review request events raised by a thread and sends them
+    together, so the recipients of all the review requests are resolved at
+    once and the notifications are queued in one go.
+
+    With Django commit hooks, the events are sent when the transaction that
+    raised them commits and discarded when it rolls back. Outside of a
+    transaction they are sent right away. Without commit hooks, the events
+    are sent at the end of the request, or right away outside of a request,
+    and discarded when the request fails.
+    """
+    def __init__(self, send):
+        self.send = send
+        self.local = threading.local()
+
+    def add(self, event):
+        if hasattr(transaction, "on_commit"):
+            self.add_on_commit(event)
+        elif getattr(self.local, "in_request", False):
+            self.local.events.append(event)
+        else:
+            self.flush([event])
+
+    def add_on_commit(self, event):
+        """
+        Adds the event to the batch of the current atomic block, keyed by its
+        savepoints. Only weak references to the commit hooks are kept, so the
+        hook of a batch that was rolled back is gone once Django drops it,
+        and a new batch is started.
+        """
+        connection = transaction.get_connection()
+        if not connection.in_atomic_block:
+            self.local.pending = {}
+            self.flush([event])
+            return
+        pending = getattr(self.local, "pending", None)
+        if pending is None:
+            pending = self.local.pending = {}
+        for key in [key for key, batch in pending.items() if batch[0]() is None]:
+            del pending[key]
+        key = tuple(connection.savepoint_ids)
+        if key in pending:
+            pending[key][1].append(event)
+            return
+        events = [event]
+
+        def commit():
+            batch = pending.get(key)
+            if batch is not None and batch[1] is events:
+                del pending[key]
+            self.flush(events)
+
+        pending[key] = (weakref.ref(commit), events)
+        transaction.on_commit(commit)
+
+    def flush(self, events):
+        try:
+            self.send(events)
+        except Exception, e:
+            logging.error("Error sending XMPP notifications for %d events: %s",
+                          len(events), e, exc_info=1)
+
+    def request_started_cb(self, sender, **kwargs):
+        self.local.in_request = True
+        self.local.events = []
+
+    def request_finished_cb(self, sender, **kwargs):
+        events = getattr(self.local, "events", None)
+        self.local.in_request = False
+        self.local.events = []
+        if events:
+            self.flush(events)
+
+    def request_exception_cb(self, sender, **kwargs):
+        # The transaction of the failed request was rolled back.
+        events = getattr(self.local, "events", None)
+        self.local.events = []
+        if events:
+            logging.debug(u"XMPP notifications of %d events discarded after a request error",
+                          len(events))
+
+    def register_signals(self):
+        if not hasattr(transaction, "on_commit"):
+            request_started.connect(self.request_started_cb, dispatch_uid="rbxmppnotification")
+            request_finished.connect(self.request_finished_cb, dispatch_uid="rbxmppnotification")
+            got_request_exception.connect(self.request_exception_cb,
+                                          dispatch_uid="rbxmppnotification")
+
+    def unregister_signals(self):
+        request_started.disconnect(self.request_started_cb, dispatch_uid="rbxmppnotification")
+        request_finished.disconnect(self.request_finished_cb, dispatch_uid="rbxmppnotification")
+        got_request_exception.disconnect(self.request_exception_cb,
+                                         dispatch_uid="rbxmppnotification")
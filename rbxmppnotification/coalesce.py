@@ -0,0 +1,227 @@
+#
+# coalesce.py -- Merging of bursts of XMPP notifications into digests.
+#
+# Copyright (c) 2013  Horatiu Eugen Vlad
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+import heapq
+import logging
+import threading
+import time
+from collections import namedtuple
+
+EVENT_PUBLISHED = "review_request_published"
+EVENT_REOPENED = "review_request_reopened"
+EVENT_CLOSED = "review_request_closed"
+EVENT_REVIEW = "review_published"
+EVENT_REPLY = "reply_published"
+
+# Singular and plural nouns used for each event type in the digests, in the
+# order they are listed.
+EVENT_NOUNS = (
+    (EVENT_PUBLISHED, u"update", u"updates"),
+    (EVENT_REOPENED, u"reopening", u"reopenings"),
+    (EVENT_CLOSED, u"closing", u"closings"),
+    (EVENT_REVIEW, u"review", u"reviews"),
+    (EVENT_REPLY, u"reply", u"replies"),
+)
+
+EVENT_DIGEST = "digest"
+EVENT_NEW_USERS = "new_users"
+
+# An event on a review request and its rendered single-event message, with
+# the optional XHTML-IM body and the time of the event.
+XmppEvent = namedtuple('XmppEvent', ['kind', 'req_id', 'summary', 'url', 'message', 'html',
+                                     'created'])
+
+def format_digest(events):
+    """
+    Returns the message summarizing the events of one review request, e.g.
+    ``3 replies and 1 review on review request #1234``. A single event keeps
+    its own message.
+    """
+    if len(events) == 1:
+        return events[0].message
+    counts = []
+    for kind, singular, plural in EVENT_NOUNS:
+        count = len([e for e in events if e.kind == kind])
+        if count:
+            counts.append(u"%d %s" % (count, count == 1 and singular or plural))
+    if len(counts) > 1:
+        counts = [u", ".join(counts[:-1]), counts[-1]]
+    last = events[-1]
+    return u"%s on review request #%d: \"%s\"\n%s" % (
+        u" and ".join(counts), last.req_id, last.summary, last.url)
+
+
+class XmppScheduler(object):
+    """
+    Calls the functions scheduled after a delay, from a single thread
+    draining a heap of deadlines, however many windows are open.
+
+    The thread is started with the first scheduled call and waits for the
+    earliest deadline.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.heap = []
+        self.count = 0
+        self.thread = None
+        self.running = False
+
+    def schedule(self, delay, function, *args):
+        with self.condition:
+            # The counter orders the calls due at the same time and keeps
+            # the functions from being compared.
+            self.count += 1
+            heapq.heappush(self.heap, (time.time() + delay, self.count, function, args))
+            if self.thread is None:
+                self.running = True
+                self.thread = threading.Thread(target=self.run,
+                                               name="rbxmppnotification-scheduler")
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and (not self.heap or self.heap[0][0] > time.time()):
+                    if self.heap:
+                        self.condition.wait(self.heap[0][0] - time.time())
+                    else:
+                        self.condition.wait()
+                if not self.running:
+                    return
+                deadline, count, function, args = heapq.heappop(self.heap)
+            try:
+                function(*args)
+            except Exception:
+                logging.exception(u"Error running the scheduled %s", function)
+
+    def stop(self):
+        """
+        Drops the scheduled calls and stops the thread. Called on shutdown,
+        once the pending windows are flushed.
+        """
+        with self.condition:
+            self.running = False
+            self.heap = []
+            thread, self.thread = self.thread, None
+            self.condition.notify()
+        if thread is not None:
+            thread.join()
+
+
+class XmppCoalescer(object):
+    """
+    Collects the events on the same review request for the coalescing
+    window, then sends each recipient a single digest message.
+
+    The window starts with the first event on a review request. Recipients
+    that got the same events share one notification. The windows are closed
+    by the ``scheduler``.
+    """
+    def __init__(self, send, scheduler):
+        self.send = send
+        self.scheduler = scheduler
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.windows = set()
+
+    def add(self, event, receivers, window):
+        with self.lock:
+            for receiver in receivers:
+                self.pending.setdefault((event.req_id, receiver), []).append(event)
+            if event.req_id not in self.windows:
+                self.windows.add(event.req_id)
+                self.scheduler.schedule(window, self.flush, event.req_id)
+
+    def flush(self, req_id):
+        """
+        Sends the digests of the events collected for the review request.
+        """
+        with self.lock:
+            self.windows.discard(req_id)
+            digests = {}
+            for key in [key for key in self.pending if key[0] == req_id]:
+                events = tuple(self.pending.pop(key))
+                digests.setdefault(events, set()).add(key[1])
+        for events, receivers in digests.items():
+            logging.debug(u"XMPP notification digest of %d events for request #%s",
+                          len(events), req_id)
+            html = len(events) == 1 and events[0].html or None
+            kind = len(events) == 1 and events[0].kind or EVENT_DIGEST
+            self.send(receivers, req_id, format_digest(events), html, kind,
+                      min(event.created for event in events))
+
+    def flush_all(self):
+        """
+        Sends all the pending digests right away. Called on shutdown.
+        """
+        with self.lock:
+            windows, self.windows = self.windows, set()
+        for req_id in windows:
+            self.flush(req_id)
+
+
+class XmppRegistrations(object):
+    """
+    Collects the users registered within the window, then sends the
+    administrators a single notification about all of them.
+
+    The window starts with the first registration. ``admins`` are resolved
+    on the request thread, and the latest ones get the notification. The
+    window is closed by the ``scheduler``.
+    """
+    def __init__(self, send, scheduler):
+        self.send = send
+        self.scheduler = scheduler
+        self.lock = threading.Lock()
+        self.users = []
+        self.admins = ()
+        self.window = False
+
+    def add(self, user, admins, window):
+        with self.lock:
+            self.users.append(user)
+            self.admins = admins
+            if window and not self.window:
+                self.window = True
+                self.scheduler.schedule(window, self.flush)
+        if not window:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            self.window = False
+            users, self.users = self.users, []
+            admins = self.admins
+        if users:
+            logging.debug(u"XMPP notification of %d registered users", len(users))
+            self.send(users, admins)
+
+    def flush_all(self):
+        """
+        Sends the pending notification right away. Called on shutdown.
+        """
+        self.flush()
@@ -0,0 +1,449 @@
+#
+# dispatch.py -- Background delivery of the XMPP notifications.
+#
+# Copyright (c) 2013  Horatiu Eugen Vlad
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+import logging
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from django.db import close_old_connections
+
+from rbxmppnotification.lanes import XmppLanes, LANE_HIGH, get_lane
+from rbxmppnotification.metrics import DELIVERY_LATENCY, QUEUE_WAIT
+from rbxmppnotification.presence import presence, get_deferred_digest
+from rbxmppnotification.ratelimit import XmppRateLimiter, OVERFLOW_SUMMARY
+
+QUEUE_FULL_DROP = "drop"
+QUEUE_FULL_BLOCK = "block"
+
+
+class XmppNotification(object):
+    """
+    A rendered notification waiting to be delivered. ``kind`` is the type of
+    the event it notifies and ``created`` the time of that event. ``lane`` is
+    the priority lane it is queued in, by default the one of its ``kind``.
+    ``deferred`` are the JIDs the delivery found offline, to be notified
+    once they are available again.
+    """
+    def __init__(self, req_id, receivers, message, html=None, kind=None, created=None,
+                 lane=None):
+        self.req_id = req_id
+        self.receivers = receivers
+        self.message = message
+        self.html = html
+        self.kind = kind
+        self.lane = lane or get_lane(kind)
+        self.created = created or time.time()
+        self.queued = time.time()
+        self.id = None
+        self.attempts = 0
+        self.deferred = []
+
+
+class XmppDispatcher(object):
+    """
+    Delivers notifications from a bounded in-process queue on a dedicated
+    worker thread, so the XMPP I/O never runs on the request thread.
+
+    The queue has one lane per priority, and the batches are picked from the
+    lanes by weight. A high priority notification queued while a batch is
+    being delivered is sent before the rest of the batch, so the reviews and
+    replies are not held up by a flood of closings.
+
+    Every notification is journaled in the outbox before delivery, so the
+    ones that cannot be delivered are replayed later, also across restarts.
+    The ones held back by the global rate limit are replayed from the
+    outbox too, so the worker never sleeps and keeps picking up the high
+    priority notifications.
+
+    With ``xmpp_cluster_spool``, the notifications are appended to the spool
+    shared by the processes instead, and only the process holding the
+    dispatcher lease delivers them. ``release`` is called when the process
+    loses the lease, to close its sessions. The notifications it was about
+    to deliver, and the ones of its outbox due for a new attempt, are handed
+    over to the new leader through the spool.
+
+    ``get_settings`` returns the current snapshot of the settings.
+    """
+    BATCH_SIZE = 100
+    IDLE_INTERVAL = 5
+    SPOOL_INTERVAL = 1
+
+    def __init__(self, get_settings, deliver, outbox, spool=None, release=None):
+        self.get_settings = get_settings
+        self.deliver = deliver
+        self.outbox = outbox
+        self.spool = spool
+        self.release = release
+        self.limiter = XmppRateLimiter()
+        self.queue = XmppLanes()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.leader = False
+        self.wakeup = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.queue.open()
+            self.thread = threading.Thread(target=self.run,
+                                           name="rbxmppnotification-dispatch")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def enqueue(self, notification):
+        """
+        Queues the notification for delivery and returns immediately, unless
+        its lane is full and the ``block`` policy is configured, in which
+        case it waits for up to ``xmpp_timeout`` seconds for a free slot.
+        Returns ``False`` if the notification was dropped.
+        """
+        self.start()
+        settings = self.get_settings()
+        if self.is_clustered(settings):
+            try:
+                self.spool.append([notification])
+            except Exception, e:
+                logging.error("Error spooling XMPP notification for request #%s: %s",
+                              notification.req_id, e, exc_info=1)
+                return False
+            return True
+        self.queue.maxsize = settings.queue_size
+        try:
+            if settings.queue_full_policy == QUEUE_FULL_BLOCK:
+                self.queue.put(notification, True, settings.timeout)
+            else:
+                self.queue.put(notification, False)
+        except queue.Full:
+            logging.error("XMPP notification queue is full (%d), dropping "
+                          "%s priority notification for request #%s",
+                          self.queue.maxsize, notification.lane, notification.req_id)
+            return False
+        return True
+
+    def run(self):
+        logging.debug(u"XmppDispatcher worker started")
+        try:
+            self.outbox.open()
+        except Exception, e:
+            logging.error("Error opening the XMPP outbox %s: %s",
+                          self.outbox.path, e, exc_info=1)
+            self.outbox = None
+        running = True
+        while running:
+            clustered = self.is_clustered(self.get_settings())
+            timeout = clustered and self.SPOOL_INTERVAL or self.IDLE_INTERVAL
+            if self.wakeup is not None:
+                timeout = max(0, min(timeout, self.wakeup - time.time()))
+            batch, running = self.get_batch(timeout)
+            if self.wakeup is not None and time.time() >= self.wakeup:
+                self.wakeup = None
+            try:
+                notifications = batch
+                if clustered:
+                    close_old_connections()
+                    if not self.spool.is_leader():
+                        # Notifications queued before the spool was enabled,
+                        # and the ones of the outbox due for a new attempt,
+                        # are left to the leader.
+                        if batch:
+                            self.spool.append(batch)
+                        if self.outbox is not None:
+                            self.hand_over(self.outbox.get_due(self.BATCH_SIZE))
+                        self.release_sessions()
+                        continue
+                    self.leader = True
+                    notifications = batch + self.spool.take(self.BATCH_SIZE)
+                else:
+                    self.release_sessions()
+                if notifications:
+                    self.deliver_queued(notifications)
+                self.deliver_due()
+                self.deliver_summaries()
+                self.deliver_deferred()
+            except Exception, e:
+                logging.error("Error delivering XMPP notifications: %s", e, exc_info=1)
+        if self.outbox is not None:
+            self.outbox.close()
+        if self.spool is not None and self.spool.leader:
+            self.spool.release()
+        logging.debug(u"XmppDispatcher worker finished")
+
+    def is_clustered(self, settings):
+        return self.spool is not None and settings.cluster_spool
+
+    def release_sessions(self):
+        """
+        Closes the sessions once the process no longer delivers the spooled
+        notifications, having lost the lease.
+        """
+        if self.leader:
+            self.leader = False
+            if self.spool.leader:
+                self.spool.release()
+            if self.release is not None:
+                self.release()
+
+    def get_batch(self, timeout):
+        """
+        Waits up to ``timeout`` seconds for the next notifications in the
+        queue and returns up to ``BATCH_SIZE`` of them, picked from the lanes
+        by weight, together with a flag telling whether the worker should keep
+        running.
+        """
+        return self.queue.get(self.BATCH_SIZE, timeout)
+
+    def deliver_queued(self, notifications):
+        """
+        Journals the notifications taken from the queue or the spool and
+        delivers them.
+        """
+        now = time.time()
+        for notification in notifications:
+            QUEUE_WAIT.observe(now - notification.queued, lane=notification.lane)
+        self.journal(notifications)
+        self.deliver_batch(notifications)
+
+    def deliver_due(self):
+        """
+        Delivers the notifications of the outbox due for a new attempt, then
+        compacts the outbox when due. Runs on every turn of the worker, so
+        the retries are not held up by a busy queue.
+        """
+        if self.outbox is not None:
+            self.deliver_batch(self.outbox.get_due(self.BATCH_SIZE))
+            self.outbox.compact()
+
+    def journal(self, notifications, delay=None, deferred=False):
+        """
+        Records the notifications in the outbox. When the outbox cannot be
+        written, e.g. while another process holds its lock, they are still
+        delivered but not retried.
+        """
+        if self.outbox is None:
+            return
+        try:
+            self.outbox.record(notifications, delay, deferred)
+        except Exception, e:
+            logging.error("Error recording %d XMPP notifications in the outbox: %s",
+                          len(notifications), e, exc_info=1)
+
+    def deliver_batch(self, batch):
+        """
+        Delivers the notifications and records the outcome in the outbox.
+        Once a delivery fails, the rest of the batch is postponed as well,
+        since the XMPP server is most likely unavailable.
+        """
+        settings = self.get_settings()
+        self.limiter.configure(settings.rate_per_jid, settings.rate_burst,
+                               settings.rate_global)
+        clustered = self.is_clustered(settings)
+        delivered = []
+        failed = []
+        postponed = []
+        spooled = []
+        for notification in batch:
+            if failed:
+                failed.append(notification)
+                continue
+            if postponed:
+                postponed.append(notification)
+                continue
+            # The rest of the batch is left to the process that took the
+            # lease over.
+            if spooled or (clustered and not self.spool.is_leader()):
+                spooled.append(notification)
+                continue
+            if notification.lane != LANE_HIGH and self.queue.has_waiting(LANE_HIGH):
+                self.deliver_queued(self.queue.take(LANE_HIGH, self.BATCH_SIZE))
+            # Once the global limit is reached, the rest of the batch waits
+            # for it as well.
+            delay = self.limiter.reserve(len(notification.receivers))
+            if delay:
+                postponed.append(notification)
+                continue
+            receivers, limited, delay = self.limiter.admit(notification.receivers)
+            if limited:
+                notification.receivers = receivers
+                self.overflow(notification, limited, delay, settings)
+            if receivers and not self.deliver(notification):
+                failed.append(notification)
+            else:
+                delivered.append(notification)
+            if notification.deferred:
+                self.defer(notification)
+        now = time.time()
+        for notification in delivered:
+            DELIVERY_LATENCY.observe(now - notification.created,
+                                     event=notification.kind or "other")
+        if self.outbox is not None:
+            if delivered:
+                self.outbox.mark_delivered(delivered)
+            if failed:
+                self.outbox.mark_failed(failed)
+        if postponed:
+            self.postpone(postponed, delay)
+        if spooled:
+            self.hand_over(spooled)
+
+    def hand_over(self, notifications):
+        """
+        Appends the notifications to the spool, for the process holding the
+        lease, and marks them delivered in the outbox. They are retried from
+        the outbox when the spool cannot be written.
+        """
+        if not notifications:
+            return
+        logging.debug(u"XMPP notifications handed over to the dispatcher lease holder: %d",
+                      len(notifications))
+        try:
+            self.spool.append(notifications)
+        except Exception, e:
+            logging.error("Error appending %d XMPP notifications to the spool: %s",
+                          len(notifications), e, exc_info=1)
+            if self.outbox is not None:
+                self.outbox.mark_failed(notifications)
+            return
+        if self.outbox is not None:
+            self.outbox.mark_delivered(notifications)
+
+    def postpone(self, notifications, delay):
+        """
+        Puts off the notifications held back by the global rate limit for
+        ``delay`` seconds, without blocking the worker. They are delivered
+        from the outbox, and dropped when there is no outbox.
+        """
+        if self.outbox is None:
+            logging.error("XMPP rate limit reached, dropping %d notifications",
+                          len(notifications))
+            return
+        logging.debug(u"XMPP rate limit reached, %d notifications delayed %.2f seconds",
+                      len(notifications), delay)
+        until = time.time() + delay
+        self.outbox.postpone(notifications, until)
+        self.wakeup = min(self.wakeup or until, until)
+
+    def overflow(self, notification, limited, delay, settings):
+        """
+        Handles the receivers of the notification that reached their rate
+        limit: the notification is either sent to them once the limit allows
+        it, or replaced by a summary of the suppressed notifications.
+        """
+        if self.outbox is not None:
+            self.outbox.update_receivers(notification)
+        if settings.rate_overflow == OVERFLOW_SUMMARY:
+            self.limiter.suppress(limited)
+        elif self.outbox is not None:
+            logging.debug(u"XMPP notification for request #%s delayed %.1f seconds for %s",
+                          notification.req_id, delay, limited)
+            self.journal([XmppNotification(notification.req_id, limited,
+                                           notification.message,
+                                           notification.html,
+                                           notification.kind,
+                                           notification.created,
+                                           notification.lane)],
+                         delay)
+        else:
+            logging.error("XMPP rate limit reached, dropping notification for "
+                          "request #%s to %s", notification.req_id, limited)
+
+    def deliver_summaries(self):
+        """
+        Delivers the summaries of the notifications suppressed by the rate
+        limit to the receivers whose limit allows it again.
+        """
+        summaries = [XmppNotification(None, [receiver],
+                        u"%d more Review Board notifications were not sent to "
+                        u"avoid flooding you." % count, kind="summary")
+                     for receiver, count in self.limiter.pop_summaries()]
+        if summaries:
+            self.journal(summaries)
+            self.deliver_batch(summaries)
+
+    def defer(self, notification):
+        """
+        Journals a copy of the notification for each of the JIDs it was
+        deferred for, and holds them until the JIDs are available again.
+        """
+        deferred = [XmppNotification(notification.req_id, [jid], notification.message,
+                                     notification.html, notification.kind,
+                                     notification.created, notification.lane)
+                    for jid in notification.deferred]
+        notification.deferred = []
+        self.journal(deferred, deferred=True)
+        for copy in deferred:
+            self.hold(copy)
+
+    def hold(self, notification):
+        dropped = presence.defer(notification.receivers[0], notification)
+        if dropped and self.outbox is not None:
+            self.outbox.mark_delivered(dropped)
+
+    def deliver_deferred(self):
+        """
+        Delivers a digest of the notifications deferred while their receivers
+        were offline to the receivers that are available again. The deferred
+        notifications are marked delivered once the digest is journaled, so
+        the digest is retried instead.
+
+        The deferred notifications of the outbox that no process holds
+        anymore, e.g. after a restart, are held again first.
+        """
+        if self.outbox is not None:
+            for notification in self.outbox.get_deferred():
+                self.hold(notification)
+        returned = presence.pop_returned()
+        digests = [XmppNotification(None, [jid], get_deferred_digest(notifications),
+                                    kind="deferred")
+                   for jid, notifications in returned]
+        if digests:
+            self.journal(digests)
+            if self.outbox is not None:
+                self.outbox.mark_delivered([notification
+                                            for digest, (jid, notifications)
+                                            in zip(digests, returned)
+                                            if digest.id is not None
+                                            for notification in notifications])
+            self.deliver_batch(digests)
+
+    def stop(self, timeout=None):
+        """
+        Flushes the queued notifications and stops the worker thread, waiting
+        at most ``timeout`` seconds for the queue to drain.
+        """
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is None:
+            return
+        self.queue.close()
+        thread.join(timeout)
+        if thread.is_alive():
+            logging.error("XMPP notification queue not flushed on shutdown, "
+                          "%d notifications not delivered", self.queue.qsize())
@@ -27,15 +27,55 @@ import logging
 
 from django.conf import settings
 from django.conf.urls import patterns, include
+from djblets.extensions.signals import extension_initialized
 from reviewboard.extensions.base import Extension
+from reviewboard.extensions.hooks import AccountPageFormsHook
 
+from rbxmppnotification.forms import XmppPreferencesForm
 from rbxmppnotification.register import XmppSignals
+from rbxmppnotification.siteurl import site_base_url
 
 
 class RBXmppNotification(Extension):
     is_configurable = True
+    default_settings = {
+        'xmpp_backend': 'pyxmpp2',
+        'xmpp_sender_accounts': '',
+        'xmpp_queue_size': 1000,
+        'xmpp_queue_full_policy': 'drop',
+        'xmpp_coalesce_window': 5,
+        'xmpp_new_user_window': 60,
+        'xmpp_rate_per_jid': 0,
+        'xmpp_rate_burst': 5,
+        'xmpp_rate_global': 0,
+        'xmpp_rate_overflow': 'delay',
+        'xmpp_use_xhtml_im': False,
+        'xmpp_partychat_muc': False,
+        'xmpp_muc_nickname': 'ReviewBoard',
+        'xmpp_metrics_token': '',
+        'xmpp_offline_policy': 'send',
+        'xmpp_cluster_spool': False,
+    }
+
     def __init__(self, *args, **kwargs):
         logging.debug(u"RBXmppNotification instantiated")
         super(RBXmppNotification, self).__init__(*args, **kwargs)
         self.signals = XmppSignals(self) 
         self.signals.register_signals()
+        site_base_url.refresh()
+        AccountPageFormsHook(self, 'settings', [XmppPreferencesForm])
+        extension_initialized.connect(self.initialized_cb, dispatch_uid="rbxmppnotification")
+
+    def initialized_cb(self, sender, ext_class, **kwargs):
+        """
+        Compiles the message templates once the extension templates can be
+        found, i.e. after the extension has been added to the installed apps.
+        """
+        if ext_class is self:
+            self.signals.sender.templates.load()
+
+    def shutdown(self):
+        logging.debug(u"RBXmppNotification shutting down")
+        extension_initialized.disconnect(self.initialized_cb, dispatch_uid="rbxmppnotification")
+        self.signals.shutdown()
+        super(RBXmppNotification, self).shutdown()
@@ -23,14 +23,43 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 #
 
+import importlib
 import sys
 
-from pyxmpp2.jid import JID
-from pyxmpp2.jid import JIDError
-
 from django import forms
+from django.contrib import messages
 from django.utils.translation import ugettext as _
 from djblets.extensions.forms import SettingsForm
+from reviewboard.accounts.forms.pages import AccountPageForm
+
+from rbxmppnotification.coalesce import EVENT_PUBLISHED, EVENT_REOPENED, \
+                                        EVENT_CLOSED, EVENT_REVIEW, EVENT_REPLY, \
+                                        EVENT_NEW_USERS
+from rbxmppnotification.models import EVENT_FLAGS, XmppPreferences
+from rbxmppnotification.snapshot import decode, parse_accounts
+
+def is_valid_jid(jid):
+    """
+    Returns whether the JID is valid. pyxmpp2 is only imported when the form
+    is validated, not when the extension is loaded.
+    """
+    from pyxmpp2.jid import JID, JIDError
+
+    try:
+        JID(jid)
+    except JIDError:
+        return False
+    return True
+
+class AccountsTextarea(forms.Textarea):
+    """
+    A text area of sender accounts, which only renders their JIDs, the way
+    ``PasswordInput`` does not render the passwords.
+    """
+    def render(self, name, value, attrs=None):
+        if value:
+            value = u"\n".join(jid for jid, password in parse_accounts(decode(value)))
+        return super(AccountsTextarea, self).render(name, value, attrs)
 
 class RBXmppNotificationSettingsForm(SettingsForm):
     """
@@ -45,6 +74,15 @@ class RBXmppNotificationSettingsForm(SettingsForm):
     xmpp_send_new_user_notify = forms.BooleanField(
         label="Send notification when new users register an account",
         required=False)
+    xmpp_backend = forms.ChoiceField(
+        label="XMPP Client",
+        help_text="The library handling the connection to the XMPP server. The"
+                  " asyncio client requires asyncio or trollius.",
+        choices=(
+            ('pyxmpp2', "pyxmpp2"),
+            ('asyncio', "asyncio"),
+        ),
+        required=True)
     xmpp_host = forms.CharField(
         label="Server Hostname",
         required=True,
@@ -73,23 +111,146 @@ class RBXmppNotificationSettingsForm(SettingsForm):
         widget=forms.PasswordInput(attrs={'size': '30'}),
         label="Sender XMPP Password",
         required=False)
+    xmpp_sender_accounts = forms.CharField(
+        label="Additional Sender Accounts",
+        help_text="More sender accounts to spread the notifications across,"
+                  " one JID and password separated by a space per line. Each"
+                  " user always gets the notifications from the same account."
+                  " The passwords are not shown: leave them out to keep the"
+                  " saved ones.",
+        required=False,
+        widget=AccountsTextarea(attrs={'rows': '4', 'cols': '50'}))
     xmpp_use_tls = forms.BooleanField(
         label="Use TLS for XMPP authentication",
         required=False)
     xmpp_tls_verify_peer = forms.BooleanField(
         label="Verify peer self signed certificate",
         required=False)
+    xmpp_use_xhtml_im = forms.BooleanField(
+        label="Send formatted messages",
+        help_text="Include an XHTML-IM (XEP-0071) version of the messages, with"
+                  " links to the review requests.",
+        required=False)
     xmpp_partychat = forms.CharField(
         label="Partychat room JID",
         help_text="Send notifications to a partychat room. Multiple rooms can"
                   " be separated with spaces.",
         required=False,
         widget=forms.TextInput(attrs={'size': '50'}))
+    xmpp_partychat_muc = forms.BooleanField(
+        label="Partychat rooms are multi-user chat rooms",
+        help_text="Join the rooms as a multi-user chat (XEP-0045) occupant and"
+                  " send them groupchat messages.",
+        required=False)
+    xmpp_muc_nickname = forms.CharField(
+        label="Multi-user chat nickname",
+        help_text="The nickname used in the multi-user chat rooms.",
+        required=False,
+        widget=forms.TextInput(attrs={'size': '30'}))
     xmpp_partychat_only = forms.BooleanField(
         label="Send partychat notifications only.",
         help_text="Do not send notifications to individual users.",
         required=False)
 
+    xmpp_queue_size = forms.IntegerField(
+        label="Notification Queue Size",
+        help_text="The maximum number of notifications waiting to be sent."
+                  " Use 0 for an unbounded queue.",
+        required=False,
+        min_value=0,
+        widget=forms.TextInput(attrs={'size': '5'}))
+    xmpp_queue_full_policy = forms.ChoiceField(
+        label="When the queue is full",
+        choices=(
+            ('drop', "Drop the new notification"),
+            ('block', "Wait up to the connection timeout for a free slot"),
+        ),
+        required=True)
+
+    xmpp_cluster_spool = forms.BooleanField(
+        label="Share the queue across the Review Board processes",
+        help_text="The notifications are stored in the database and sent by"
+                  " a single process at a time, which holds the XMPP sessions."
+                  " Another process takes over within a minute if it stops.",
+        required=False)
+
+    xmpp_coalesce_window = forms.IntegerField(
+        label="Coalescing Window",
+        help_text="The number of seconds during which the events on the same"
+                  " review request are merged into one message per recipient."
+                  " Use 0 to send every event right away.",
+        required=False,
+        min_value=0,
+        max_value=60,
+        widget=forms.TextInput(attrs={'size': '3'}))
+
+    xmpp_new_user_window = forms.IntegerField(
+        label="Registration Digest Window",
+        help_text="The number of seconds during which the new user"
+                  " registrations are merged into one message per"
+                  " administrator. Use 0 to send every registration right away.",
+        required=False,
+        min_value=0,
+        max_value=3600,
+        widget=forms.TextInput(attrs={'size': '5'}))
+
+    xmpp_rate_per_jid = forms.IntegerField(
+        label="Messages per Minute per Recipient",
+        help_text="The maximum number of messages sent to the same user or"
+                  " room in a minute. Use 0 for no limit.",
+        required=False,
+        min_value=0,
+        widget=forms.TextInput(attrs={'size': '5'}))
+    xmpp_rate_burst = forms.IntegerField(
+        label="Message Burst per Recipient",
+        help_text="The number of messages that can be sent to the same user or"
+                  " room at once before the limit above applies.",
+        required=False,
+        min_value=1,
+        widget=forms.TextInput(attrs={'size': '5'}))
+    xmpp_rate_global = forms.IntegerField(
+        label="Stanzas per Second",
+        help_text="The maximum number of stanzas sent to the XMPP server per"
+                  " second. Use 0 for no limit.",
+        required=False,
+        min_value=0,
+        widget=forms.TextInput(attrs={'size': '5'}))
+    xmpp_rate_overflow = forms.ChoiceField(
+        label="When a recipient reaches the limit",
+        choices=(
+            ('delay', "Delay the messages"),
+            ('summary', "Send a summary of the suppressed messages"),
+        ),
+        required=True)
+
+    xmpp_offline_policy = forms.ChoiceField(
+        label="When a recipient is offline",
+        help_text="Only the presence of the users who added a sender account"
+                  " to their roster is known. The others are considered online.",
+        choices=(
+            ('send', "Send the messages"),
+            ('drop', "Drop the messages"),
+            ('defer', "Send a digest of the messages when the recipient is back online"),
+        ),
+        required=True)
+
+    xmpp_metrics_token = forms.CharField(
+        label="Metrics Token",
+        help_text="Lets Prometheus scrape the metrics/prometheus/ page under"
+                  " this configuration page with this bearer token. The page"
+                  " is only available to administrators otherwise.",
+        required=False,
+        widget=forms.TextInput(attrs={'size': '50'}))
+
+    def clean_xmpp_backend(self):
+        backend = self.cleaned_data['xmpp_backend']
+        if backend == 'asyncio':
+            try:
+                importlib.import_module("rbxmppnotification.asyncxmpp")
+            except ImportError:
+                raise forms.ValidationError('The asyncio client requires asyncio or trollius.')
+        return backend
+
     def clean_xmpp_host(self):
         # Strip whitespaces from the Server address.
         h = self.cleaned_data['xmpp_host'].strip()
@@ -101,21 +262,31 @@ class RBXmppNotificationSettingsForm(SettingsForm):
         j = self.cleaned_data['xmpp_sender_jid'].strip()
         if sys.version_info[0] < 3:
             j = j.decode("utf-8")
-        try:
-            JID(j)
-        except JIDError:
+        if not is_valid_jid(j):
             raise forms.ValidationError('Enter a valid JID.')
         return j
 
+    def clean_xmpp_sender_accounts(self):
+        xmpp_sender_accounts = self.cleaned_data['xmpp_sender_accounts']
+        lines = xmpp_sender_accounts.splitlines()
+        if sys.version_info[0] < 3:
+            lines = [line.decode("utf-8") for line in lines]
+        saved = dict(parse_accounts(decode(self.settings.get('xmpp_sender_accounts') or u"")))
+        accounts = []
+        for jid, password in parse_accounts(u"\n".join(lines)):
+            if not is_valid_jid(jid):
+                raise forms.ValidationError('Enter a valid JID on each line.')
+            # The accounts given without a password keep the saved one.
+            accounts.append(u"%s %s" % (jid, password or saved.get(jid, u"")))
+        return u"\n".join(accounts)
+
     def clean_xmpp_partychat(self):
         xmpp_partychat = self.cleaned_data['xmpp_partychat']
         rooms = xmpp_partychat.split()
         if sys.version_info[0] < 3:
             rooms = [room.decode("utf-8") for room in rooms]
         for room in rooms:
-            try:
-                JID(room)
-            except JIDError:
+            if not is_valid_jid(room):
                 raise forms.ValidationError('Enter a valid room JID.')
         return xmpp_partychat
 
@@ -124,3 +295,80 @@ class RBXmppNotificationSettingsForm(SettingsForm):
 
     class Meta:
         title = "XMPP Notify Settings"
+
+
+class XmppPreferencesForm(AccountPageForm):
+    """
+    XMPP notification preferences on the My Account settings page.
+    """
+    form_id = 'rbxmppnotification_preferences'
+    form_title = "XMPP Notifications"
+    save_label = "Save XMPP Notifications"
+
+    events = forms.MultipleChoiceField(
+        label="Notify me of",
+        choices=(
+            (EVENT_PUBLISHED, "Published review requests"),
+            (EVENT_REVIEW, "Reviews"),
+            (EVENT_REPLY, "Replies"),
+            (EVENT_CLOSED, "Closed review requests"),
+            (EVENT_REOPENED, "Reopened review requests"),
+            (EVENT_NEW_USERS, "New user registrations (administrators only)"),
+        ),
+        widget=forms.CheckboxSelectMultiple,
+        required=False)
+    target_only = forms.BooleanField(
+        label="Only when I am a target reviewer, directly or through a group",
+        required=False)
+    quiet_start = forms.TimeField(
+        label="Quiet hours start",
+        help_text="No notification is sent during the quiet hours, in your time zone (HH:MM).",
+        required=False,
+        widget=forms.TextInput(attrs={'size': '5'}))
+    quiet_end = forms.TimeField(
+        label="Quiet hours end",
+        required=False,
+        widget=forms.TextInput(attrs={'size': '5'}))
+    jid = forms.CharField(
+        label="JID",
+        help_text="The JID to notify instead of your username.",
+        required=False,
+        widget=forms.TextInput(attrs={'size': '50'}))
+
+    def load(self):
+        try:
+            preferences = XmppPreferences.objects.get(user=self.user)
+        except XmppPreferences.DoesNotExist:
+            preferences = XmppPreferences(user=self.user)
+        self.set_initial({
+            'events': [kind for kind, flag in EVENT_FLAGS.items()
+                       if preferences.events & flag],
+            'target_only': preferences.target_only,
+            'quiet_start': preferences.quiet_start,
+            'quiet_end': preferences.quiet_end,
+            'jid': preferences.jid,
+        })
+
+    def clean_jid(self):
+        j = self.cleaned_data['jid'].strip()
+        if j and not is_valid_jid(j):
+            raise forms.ValidationError('Enter a valid JID.')
+        return j
+
+    def clean(self):
+        cleaned_data = super(XmppPreferencesForm, self).clean()
+        if (cleaned_data.get('quiet_start') is None) != (cleaned_data.get('quiet_end') is None):
+            raise forms.ValidationError('Enter both the start and the end of the quiet hours.')
+        return cleaned_data
+
+    def save(self):
+        preferences, created = XmppPreferences.objects.get_or_create(user=self.user)
+        preferences.events = sum(EVENT_FLAGS[kind] for kind in self.cleaned_data['events'])
+        preferences.target_only = self.cleaned_data['target_only']
+        preferences.quiet_start = self.cleaned_data['quiet_start']
+        preferences.quiet_end = self.cleaned_data['quiet_end']
+        preferences.jid = self.cleaned_data['jid']
+        preferences.save()
+
+        messages.add_message(self.request, messages.INFO,
+                             "Your XMPP notification preferences have been saved.")
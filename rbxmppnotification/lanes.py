@@ -0,0 +1,172 @@
+#
+# lanes.py -- Priority lanes of the XMPP notification queue.
+#
+# Copyright (c) 2013  Horatiu Eugen Vlad
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+import threading
+import time
+from collections import deque
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from rbxmppnotification.coalesce import EVENT_PUBLISHED, EVENT_REOPENED, \
+                                        EVENT_CLOSED, EVENT_REVIEW, EVENT_REPLY, \
+                                        EVENT_NEW_USERS
+from rbxmppnotification.metrics import QUEUE_DEPTH
+
+LANE_HIGH = "high"
+LANE_NORMAL = "normal"
+LANE_LOW = "low"
+
+# The lanes in priority order, with the number of notifications taken from
+# each of them in every scheduling round.
+LANES = (
+    (LANE_HIGH, 8),
+    (LANE_NORMAL, 3),
+    (LANE_LOW, 1),
+)
+
+# The reviews and replies are what people wait for, while the closings and
+# reopenings come in bulk from scripts, like the registrations from the
+# account provisioning. The other kinds, like the digests, are of normal
+# priority.
+EVENT_LANES = {
+    EVENT_REVIEW: LANE_HIGH,
+    EVENT_REPLY: LANE_HIGH,
+    EVENT_PUBLISHED: LANE_NORMAL,
+    EVENT_REOPENED: LANE_LOW,
+    EVENT_CLOSED: LANE_LOW,
+    EVENT_NEW_USERS: LANE_LOW,
+}
+
+
+def get_lane(kind):
+    return EVENT_LANES.get(kind, LANE_NORMAL)
+
+
+def pick_weighted(lanes, limit):
+    """
+    Removes up to ``limit`` items from the ``lanes`` deques and returns them.
+    Every round takes up to the weight of each lane, in priority order, and
+    the empty lanes leave their share to the others.
+    """
+    batch = []
+    while len(batch) < limit and any(lanes.values()):
+        for lane, weight in LANES:
+            items = lanes.get(lane) or ()
+            for i in range(min(weight, len(items), limit - len(batch))):
+                batch.append(items.popleft())
+    return batch
+
+
+class XmppLanes(object):
+    """
+    The notifications waiting for the dispatcher, in one FIFO lane per
+    priority. Each lane holds at most ``maxsize`` notifications, so a flood
+    of low priority notifications does not take the place of the others.
+    Like ``queue.Queue``, ``put`` raises ``queue.Full`` when the lane of the
+    notification stays full.
+    """
+    def __init__(self):
+        self.lanes = dict((lane, deque()) for lane, weight in LANES)
+        self.maxsize = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def put(self, notification, block=True, timeout=None):
+        items = self.lanes[notification.lane]
+        with self.cond:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while self.maxsize > 0 and len(items) >= self.maxsize:
+                if not block:
+                    raise queue.Full
+                if timeout is None:
+                    self.cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise queue.Full
+                self.cond.wait(remaining)
+            items.append(notification)
+            self.update_depths()
+            self.cond.notify_all()
+
+    def get(self, limit, timeout):
+        """
+        Waits up to ``timeout`` seconds for notifications and returns up to
+        ``limit`` of them, picked from the lanes by weight, together with a
+        flag telling whether the lanes are still open.
+        """
+        with self.cond:
+            deadline = time.time() + timeout
+            while not self.closed and not any(self.lanes.values()):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            batch = pick_weighted(self.lanes, limit)
+            if batch:
+                self.update_depths()
+                self.cond.notify_all()
+            return batch, not (self.closed and not any(self.lanes.values()))
+
+    def take(self, lane, limit):
+        """
+        Removes up to ``limit`` notifications from ``lane`` without waiting.
+        """
+        with self.cond:
+            items = self.lanes[lane]
+            batch = [items.popleft() for i in range(min(limit, len(items)))]
+            if batch:
+                self.update_depths()
+                self.cond.notify_all()
+            return batch
+
+    def has_waiting(self, lane):
+        return bool(self.lanes[lane])
+
+    def open(self):
+        with self.cond:
+            self.closed = False
+
+    def close(self):
+        """
+        Lifts the size limit and lets the consumer finish once the lanes are
+        drained.
+        """
+        with self.cond:
+            self.closed = True
+            self.maxsize = 0
+            self.cond.notify_all()
+
+    def qsize(self):
+        with self.cond:
+            return sum(len(items) for items in self.lanes.values())
+
+    def update_depths(self):
+        for lane, items in self.lanes.items():
+            QUEUE_DEPTH.set(len(items), lane=lane)
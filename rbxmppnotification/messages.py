@@ -0,0 +1,78 @@
+#
+# messages.py -- Templates of the XMPP notification messages.
+#
+# Copyright (c) 2013  Horatiu Eugen Vlad
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+import logging
+import threading
+
+from django.template import Context, TemplateDoesNotExist
+from django.template.loader import get_template
+
+from rbxmppnotification.coalesce import EVENT_NOUNS, EVENT_NEW_USERS
+
+
+class XmppMessageTemplates(object):
+    """
+    The compiled templates of the notification messages.
+
+    Each event type has a plain text template,
+    ``rbxmppnotification/<event>.txt``, and an optional XHTML-IM template,
+    ``rbxmppnotification/<event>.html``. The registrations of new users are
+    the ``new_users`` event. Administrators can override them
+    with templates of the same name in the site templates directory.
+
+    The templates are compiled once, when the extension is initialized, and
+    reused for every message.
+    """
+    def __init__(self):
+        self.templates = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        templates = {}
+        kinds = [kind for kind, singular, plural in EVENT_NOUNS] + [EVENT_NEW_USERS]
+        for kind in kinds:
+            text = get_template("rbxmppnotification/%s.txt" % kind)
+            try:
+                html = get_template("rbxmppnotification/%s.html" % kind)
+            except TemplateDoesNotExist:
+                html = None
+            templates[kind] = (text, html)
+        logging.debug(u"XMPP notification templates loaded: %s", templates.keys())
+        with self.lock:
+            self.templates = templates
+
+    def render(self, kind, context, xhtml=False):
+        """
+        Renders the message of the event type. Returns the plain text body and
+        the XHTML-IM body, or ``None`` if ``xhtml`` is not set or the event
+        type has no XHTML-IM template.
+        """
+        if self.templates is None:
+            self.load()
+        text, html = self.templates[kind]
+        message = text.render(Context(context, autoescape=False)).strip()
+        if xhtml and html is not None:
+            return message, html.render(Context(context)).strip()
+        return message, None
@@ -0,0 +1,219 @@
+#
+# metrics.py -- Counters and histograms of the notification pipeline.
+#
+# Copyright (c) 2013  Horatiu Eugen Vlad
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+import threading
+
+registry = []
+
+
+def format_labels(names, values):
+    if not names:
+        return u""
+    return u"{%s}" % u",".join(
+        u'%s="%s"' % (name, (u"%s" % value).replace(u"\\", u"\\\\")
+                                           .replace(u'"', u'\\"')
+                                           .replace(u"\n", u"\\n"))
+        for name, value in zip(names, values))
+
+
+class Counter(object):
+    """
+    A monotonically increasing count, per combination of label values.
+    """
+    TYPE = "counter"
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(label) for label in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get_samples(self):
+        """
+        Returns the ``(name, labels, value)`` samples in the Prometheus text
+        format.
+        """
+        with self.lock:
+            values = sorted(self.values.items())
+        return [(self.name, format_labels(self.labels, key), value)
+                for key, value in values]
+
+    def get_rows(self):
+        """
+        Returns the ``(labels, value)`` rows shown on the metrics page.
+        """
+        with self.lock:
+            values = sorted(self.values.items())
+        return [(format_labels(self.labels, key), value) for key, value in values]
+
+
+class Gauge(Counter):
+    """
+    A value that goes up and down, per combination of label values.
+    """
+    TYPE = "gauge"
+
+    def set(self, value, **labels):
+        key = tuple(labels.get(label) for label in self.labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(object):
+    """
+    The distribution of observed values in cumulative buckets, per
+    combination of label values, along with their count and sum.
+    """
+    TYPE = "histogram"
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self, name, description, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(label) for label in self.labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self.values[key] = (counts, total + value)
+
+    def get_samples(self):
+        with self.lock:
+            values = sorted((key, (list(counts), total))
+                            for key, (counts, total) in self.values.items())
+        samples = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (u"+Inf",), counts):
+                cumulative += count
+                samples.append((self.name + "_bucket",
+                                format_labels(self.labels + ("le",), key + (bound,)),
+                                cumulative))
+            labels = format_labels(self.labels, key)
+            samples.append((self.name + "_sum", labels, total))
+            samples.append((self.name + "_count", labels, cumulative))
+        return samples
+
+    def get_quantile(self, counts, quantile):
+        """
+        Returns the upper bound of the bucket holding the ``quantile``.
+        """
+        rank = quantile * sum(counts)
+        cumulative = 0
+        for bound, count in zip(self.buckets + (None,), counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return None
+
+    def get_rows(self):
+        """
+        Returns the ``(labels, count, mean, p50, p99)`` rows shown on the
+        metrics page. The quantiles are the upper bounds of their buckets.
+        """
+        with self.lock:
+            values = sorted((key, (list(counts), total))
+                            for key, (counts, total) in self.values.items())
+        rows = []
+        for key, (counts, total) in values:
+            count = sum(counts)
+            rows.append((format_labels(self.labels, key), count,
+                         count and float(total) / count or 0,
+                         self.get_quantile(counts, 0.5),
+                         self.get_quantile(counts, 0.99)))
+        return rows
+
+
+def render_text():
+    """
+    Returns all the metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in registry:
+        lines.append(u"# HELP %s %s" % (metric.name, metric.description))
+        lines.append(u"# TYPE %s %s" % (metric.name, metric.TYPE))
+        for name, labels, value in metric.get_samples():
+            lines.append(u"%s%s %s" % (name, labels, repr(float(value))))
+    return u"\n".join(lines) + u"\n"
+
+
+RECIPIENT_RESOLUTION = Histogram(
+    "rbxmppnotification_recipient_resolution_seconds",
+    "Time spent resolving the recipients of a review request from the database.")
+RECIPIENT_QUERIES = Histogram(
+    "rbxmppnotification_recipient_queries",
+    "Database queries run to resolve the recipients of one or more review requests.",
+    buckets=(1, 2, 3, 5, 10, 20, 50))
+RECIPIENT_CACHE = Counter(
+    "rbxmppnotification_recipient_cache_total",
+    "Recipient cache lookups.",
+    ["result"])
+QUEUE_WAIT = Histogram(
+    "rbxmppnotification_queue_wait_seconds",
+    "Time the notifications spent in the queue before delivery.",
+    ["lane"])
+QUEUE_DEPTH = Gauge(
+    "rbxmppnotification_queue_depth",
+    "Notifications waiting in the queue of the process.",
+    ["lane"])
+CONNECT_TIME = Histogram(
+    "rbxmppnotification_connect_seconds",
+    "Time from opening the connection to an authorized XMPP session.",
+    ["backend"])
+MESSAGES_SENT = Counter(
+    "rbxmppnotification_messages_sent_total",
+    "Messages written to the XMPP stream, per recipient.",
+    ["event"])
+MESSAGES_FAILED = Counter(
+    "rbxmppnotification_messages_failed_total",
+    "Messages that could not be sent and were deferred, per recipient.",
+    ["event"])
+MESSAGES_OFFLINE = Counter(
+    "rbxmppnotification_messages_offline_total",
+    "Messages not sent because the recipient was offline, per recipient.",
+    ["policy"])
+DELIVERY_LATENCY = Histogram(
+    "rbxmppnotification_delivery_latency_seconds",
+    "Time from the review request event to the delivery of its notification.",
+    ["event"])
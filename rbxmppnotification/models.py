@@ -0,0 +1,91 @@
+#
+# models.py -- Per-user XMPP notification preferences.
+#
+# Copyright (c) 2013  Horatiu Eugen Vlad
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+from django.contrib.auth.models import User
+from django.db import models
+
+from rbxmppnotification.coalesce import EVENT_PUBLISHED, EVENT_REOPENED, \
+                                        EVENT_CLOSED, EVENT_REVIEW, EVENT_REPLY, \
+                                        EVENT_NEW_USERS
+from rbxmppnotification.lanes import LANE_NORMAL
+
+# The bits of the event types in ``XmppPreferences.events``.
+EVENT_FLAGS = {
+    EVENT_PUBLISHED: 1,
+    EVENT_REOPENED: 2,
+    EVENT_CLOSED: 4,
+    EVENT_REVIEW: 8,
+    EVENT_REPLY: 16,
+    EVENT_NEW_USERS: 32,
+}
+EVENTS_ALL = sum(EVENT_FLAGS.values())
+
+
+class XmppPreferences(models.Model):
+    """
+    The XMPP notification preferences of a user: the event types to be
+    notified of, whether only as a target reviewer, the quiet hours, in the
+    time zone of the user, and the JID to notify instead of the username.
+
+    Users without preferences get every notification on their username.
+    """
+    user = models.OneToOneField(User, primary_key=True,
+                                related_name='xmpp_preferences')
+    events = models.PositiveIntegerField(default=EVENTS_ALL)
+    target_only = models.BooleanField(default=False)
+    quiet_start = models.TimeField(blank=True, null=True)
+    quiet_end = models.TimeField(blank=True, null=True)
+    jid = models.CharField(max_length=255, blank=True)
+
+    def __unicode__(self):
+        return u"XMPP preferences of %s" % self.user_id
+
+
+class XmppSpoolEntry(models.Model):
+    """
+    A notification appended to the spool shared by the Review Board
+    processes, waiting for the dispatcher holding the lease.
+    """
+    req_id = models.CharField(max_length=64, blank=True)
+    receivers = models.TextField()
+    message = models.TextField()
+    html = models.TextField(blank=True)
+    kind = models.CharField(max_length=64, blank=True)
+    lane = models.CharField(max_length=16, default=LANE_NORMAL, db_index=True)
+    created = models.FloatField()
+    queued = models.FloatField()
+
+
+class XmppLease(models.Model):
+    """
+    A lease held by one process at a time, until ``expires`` unless renewed.
+    """
+    name = models.CharField(max_length=64, primary_key=True)
+    owner = models.CharField(max_length=255)
+    expires = models.FloatField()
+
+    def __unicode__(self):
+        return u"%s held by %s" % (self.name, self.owner)
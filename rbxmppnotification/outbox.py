@@ -0,0 +1,280 @@
+#
+# outbox.py -- Persistent outbox for the XMPP notifications.
+#
+# Copyright (c) 2013  Horatiu Eugen Vlad
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+import uuid
+
+from django.conf import settings
+from django.utils import six
+
+from rbxmppnotification.dispatch import XmppNotification
+
+
+def get_outbox_path():
+    """
+    Returns the location of the outbox database in the site data directory.
+    """
+    data_dir = getattr(settings, 'SITE_DATA_DIR', None) or tempfile.gettempdir()
+    return os.path.join(data_dir, 'rbxmppnotification-outbox.db')
+
+
+class XmppOutbox(object):
+    """
+    A SQLite journal of the notifications that were not delivered yet.
+
+    Notifications are recorded before delivery and marked delivered once
+    they are written to the XMPP stream. Failed notifications are retried
+    with an exponential backoff until they expire. The outbox is used only
+    from the dispatcher thread.
+
+    All the Review Board processes share the outbox. The notifications
+    being delivered are due only after ``IN_FLIGHT_TIMEOUT``, and the due
+    ones are claimed by a single process, so no notification is sent twice
+    by two processes. The ones left in flight by a process that died are
+    replayed once the timeout expires.
+
+    The notifications deferred for offline receivers are kept in the
+    ``deferred`` state (``delivered = 2``), one per receiver, until the
+    digest replacing them is sent. They are held by the process that
+    deferred them, which renews its hold every ``DEFERRED_RENEW_INTERVAL``,
+    and are taken over by another process once the hold expires.
+    """
+    IN_FLIGHT_TIMEOUT = 600
+    DEFERRED_HOLD = 600
+    DEFERRED_RENEW_INTERVAL = 60
+    RETRY_MIN_DELAY = 5
+    RETRY_MAX_DELAY = 3600
+    RETRY_MAX_AGE = 24 * 3600
+    COMPACT_INTERVAL = 3600
+
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.compacted = 0
+        self.claim = uuid.uuid4().hex
+        self.renewed = 0
+
+    def open(self):
+        if self.db is not None:
+            return
+        logging.debug(u"XmppOutbox opening %s", self.path)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS notification (
+                               id INTEGER PRIMARY KEY AUTOINCREMENT,
+                               req_id TEXT,
+                               receivers TEXT,
+                               message TEXT,
+                               html TEXT,
+                               kind TEXT,
+                               created REAL,
+                               attempts INTEGER DEFAULT 0,
+                               next_attempt REAL,
+                               delivered INTEGER DEFAULT 0)""")
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(notification)")]
+        if "kind" not in columns:
+            self.db.execute("ALTER TABLE notification ADD COLUMN kind TEXT")
+        if "claim" not in columns:
+            self.db.execute("ALTER TABLE notification ADD COLUMN claim TEXT")
+        if "lane" not in columns:
+            self.db.execute("ALTER TABLE notification ADD COLUMN lane TEXT")
+        # The notifications without a review request were recorded as "None".
+        self.db.execute("UPDATE notification SET req_id = NULL WHERE req_id = 'None'")
+        self.db.execute("""CREATE INDEX IF NOT EXISTS notification_pending
+                           ON notification (delivered, next_attempt)""")
+        self.db.commit()
+        self.compacted = time.time()
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def record(self, notifications, delay=None, deferred=False):
+        """
+        Writes a batch of new notifications in a single transaction. They are
+        due for delivery after ``delay`` seconds, or are in flight if no
+        ``delay`` is given. ``deferred`` notifications are held by the
+        process instead.
+        """
+        if deferred:
+            state, claim, delay = 2, self.claim, self.DEFERRED_HOLD
+        else:
+            state, claim = 0, None
+        if delay is None:
+            delay = self.IN_FLIGHT_TIMEOUT
+        ids = []
+        with self.db:
+            for notification in notifications:
+                cursor = self.db.execute(
+                    "INSERT INTO notification (req_id, receivers, message, html, kind, lane,"
+                    " created, next_attempt, delivered, claim)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (notification.req_id is not None and six.text_type(notification.req_id)
+                     or None,
+                     json.dumps([six.text_type(r) for r in notification.receivers]),
+                     notification.message,
+                     notification.html,
+                     notification.kind,
+                     notification.lane,
+                     notification.created,
+                     time.time() + delay,
+                     state,
+                     claim))
+                ids.append(cursor.lastrowid)
+        # Set once committed, so a failed batch is left unrecorded.
+        for notification, id in zip(notifications, ids):
+            notification.id = id
+
+    def update_receivers(self, notification):
+        if notification.id is None:
+            return
+        with self.db:
+            self.db.execute(
+                "UPDATE notification SET receivers = ? WHERE id = ?",
+                (json.dumps([six.text_type(r) for r in notification.receivers]),
+                 notification.id))
+
+    def mark_delivered(self, notifications):
+        with self.db:
+            self.db.executemany(
+                "UPDATE notification SET delivered = 1 WHERE id = ?",
+                [(n.id,) for n in notifications if n.id is not None])
+
+    def mark_failed(self, notifications):
+        """
+        Schedules the next delivery attempt of the notifications, to the
+        receivers they were not delivered to.
+        """
+        lost = [n for n in notifications if n.id is None]
+        if lost:
+            logging.error("XMPP outbox could not record %d failed notifications, "
+                          "they are not retried", len(lost))
+        now = time.time()
+        with self.db:
+            for notification in notifications:
+                if notification.id is None:
+                    continue
+                notification.attempts += 1
+                delay = min(self.RETRY_MIN_DELAY * 2 ** (notification.attempts - 1),
+                            self.RETRY_MAX_DELAY)
+                self.db.execute(
+                    "UPDATE notification SET attempts = ?, next_attempt = ?, receivers = ?"
+                    " WHERE id = ?",
+                    (notification.attempts, now + delay,
+                     json.dumps([six.text_type(r) for r in notification.receivers]),
+                     notification.id))
+
+    def postpone(self, notifications, until):
+        """
+        Schedules the delivery of the notifications at the ``until`` time, to
+        the receivers they were not delivered to, without counting a failed
+        attempt.
+        """
+        lost = [n for n in notifications if n.id is None]
+        if lost:
+            logging.error("XMPP outbox could not record %d postponed notifications, "
+                          "they are not sent", len(lost))
+        with self.db:
+            self.db.executemany(
+                "UPDATE notification SET next_attempt = ?, receivers = ? WHERE id = ?",
+                [(until, json.dumps([six.text_type(r) for r in n.receivers]), n.id)
+                 for n in notifications if n.id is not None])
+
+    def get_due(self, limit):
+        """
+        Claims the undelivered notifications due for a new attempt and returns
+        them. They are in flight until delivered or failed again.
+        """
+        now = time.time()
+        claim = uuid.uuid4().hex
+        with self.db:
+            self.db.execute(
+                "UPDATE notification SET claim = ?, next_attempt = ? WHERE id IN"
+                " (SELECT id FROM notification WHERE delivered = 0 AND next_attempt <= ?"
+                "  ORDER BY next_attempt LIMIT ?)",
+                (claim, now + self.IN_FLIGHT_TIMEOUT, now, limit))
+        return self.get_claimed(claim, 0)
+
+    def get_deferred(self, force=False):
+        """
+        Renews the hold of the process on its deferred notifications, takes
+        over the ones whose hold expired and returns them. Runs at most once
+        per ``DEFERRED_RENEW_INTERVAL`` unless forced.
+        """
+        now = time.time()
+        if not force and now - self.renewed < self.DEFERRED_RENEW_INTERVAL:
+            return []
+        self.renewed = now
+        claim = uuid.uuid4().hex
+        with self.db:
+            self.db.execute(
+                "UPDATE notification SET next_attempt = ? WHERE delivered = 2 AND claim = ?",
+                (now + self.DEFERRED_HOLD, self.claim))
+            self.db.execute(
+                "UPDATE notification SET claim = ?, next_attempt = ?"
+                " WHERE delivered = 2 AND next_attempt <= ?",
+                (claim, now + self.DEFERRED_HOLD, now))
+            notifications = self.get_claimed(claim, 2)
+            self.db.execute("UPDATE notification SET claim = ? WHERE claim = ?",
+                            (self.claim, claim))
+        return notifications
+
+    def get_claimed(self, claim, state):
+        rows = self.db.execute(
+            "SELECT id, req_id, receivers, message, html, kind, lane, created, attempts"
+            " FROM notification WHERE claim = ? AND delivered = ?", (claim, state))
+        notifications = []
+        for id, req_id, receivers, message, html, kind, lane, created, attempts in rows:
+            notification = XmppNotification(req_id or None, json.loads(receivers), message,
+                                            html, kind, created, lane)
+            notification.id = id
+            notification.attempts = attempts
+            notifications.append(notification)
+        return notifications
+
+    def compact(self, force=False):
+        """
+        Drops the delivered and expired notifications and reclaims the space
+        they used. The deferred notifications do not expire. Runs at most once
+        per ``COMPACT_INTERVAL`` unless forced.
+        """
+        now = time.time()
+        if not force and now - self.compacted < self.COMPACT_INTERVAL:
+            return
+        self.compacted = now
+        with self.db:
+            self.db.execute("DELETE FROM notification WHERE delivered = 1")
+            expired = self.db.execute(
+                "DELETE FROM notification WHERE delivered = 0 AND created < ?",
+                (now - self.RETRY_MAX_AGE,)).rowcount
+        if expired:
+            logging.error("XMPP outbox dropped %d notifications older than %d seconds",
+                          expired, self.RETRY_MAX_AGE)
+        self.db.execute("VACUUM")
@@ -0,0 +1,190 @@
+#
+# pool.py -- Pool of the XMPP sender accounts.
+#
+# Copyright (c) 2013  Horatiu Eugen Vlad
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+import bisect
+import hashlib
+import logging
+import threading
+import time
+
+
+def get_hash(key):
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
+
+
+class XmppAccount(object):
+    """
+    A sender account of the pool. An account whose session fails is taken
+    out of the rotation for a period growing exponentially with the number
+    of consecutive failures.
+    """
+    RETRY_MIN_DELAY = 5
+    RETRY_MAX_DELAY = 600
+
+    def __init__(self, jid, password):
+        self.jid = jid
+        self.password = password
+        self.failures = 0
+        self.down_until = 0
+
+    def is_healthy(self, now):
+        return now >= self.down_until
+
+    def succeeded(self):
+        self.failures = 0
+        self.down_until = 0
+
+    def failed(self):
+        self.failures += 1
+        delay = min(self.RETRY_MIN_DELAY * 2 ** (self.failures - 1),
+                    self.RETRY_MAX_DELAY)
+        self.down_until = time.time() + delay
+        logging.error("XMPP sender account %s failed, out of rotation for %d seconds",
+                      self.jid, delay)
+
+
+class HashRing(object):
+    """
+    A consistent hash ring of the account JIDs, so that a recipient always
+    hears from the same account and only the recipients of an account that
+    is added or removed move to another one.
+    """
+    REPLICAS = 100
+
+    def __init__(self, keys):
+        self.ring = sorted((get_hash(u"%s#%d" % (key, i)), key)
+                           for key in keys for i in range(self.REPLICAS))
+        self.hashes = [h for h, key in self.ring]
+        self.size = len(set(keys))
+
+    def get_nodes(self, key):
+        """
+        Yields the distinct keys in ring order, starting at the position of
+        ``key``.
+        """
+        if not self.ring:
+            return
+        seen = set()
+        start = bisect.bisect(self.hashes, get_hash(key))
+        for i in range(len(self.ring)):
+            node = self.ring[(start + i) % len(self.ring)][1]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == self.size:
+                    return
+
+
+class XmppSenderPool(object):
+    """
+    The sessions of the sender accounts. The recipients are spread across
+    the healthy accounts with consistent hashing. The sessions are created
+    with ``create_client(jid, password, *args)``.
+
+    Once closed, the pool has no accounts and ignores the settings, so a
+    dispatcher worker still draining its queue cannot open new sessions.
+    """
+    def __init__(self, create_client):
+        self.create_client = create_client
+        self.accounts = {}
+        self.ring = HashRing([])
+        self.clients = {}
+        self.configured = None
+        self.args = None
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def configure(self, accounts, *args):
+        """
+        Sets the ``(jid, password)`` of the accounts and the connection
+        arguments shared by their sessions. The sessions of the accounts that
+        were removed or changed are closed.
+        """
+        with self.lock:
+            if self.closed or (accounts, args) == self.configured:
+                return
+            self.configured = (accounts, args)
+            accounts = dict((jid, password) for jid, password in accounts)
+            current = dict((jid, account.password)
+                           for jid, account in self.accounts.items())
+            if accounts == current and args == self.args:
+                return
+            logging.debug(u"XmppSenderPool settings changed, reopening sessions")
+            for jid, client in list(self.clients.items()):
+                if args != self.args or current.get(jid) != accounts.get(jid):
+                    client.stop()
+                    del self.clients[jid]
+            self.accounts = dict(
+                (jid, self.accounts[jid] if current.get(jid) == password
+                      else XmppAccount(jid, password))
+                for jid, password in accounts.items())
+            self.ring = HashRing(list(self.accounts))
+            self.args = args
+
+    def get_account(self, key):
+        """
+        Returns the healthy account serving ``key``, or ``None`` if all the
+        accounts are out of rotation.
+        """
+        now = time.time()
+        for jid in self.ring.get_nodes(key):
+            account = self.accounts[jid]
+            if account.is_healthy(now):
+                return account
+        return None
+
+    def get_client(self, account):
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("XMPP sender pool closed")
+            client = self.clients.get(account.jid)
+            if client is None:
+                client = self.clients[account.jid] = self.create_client(
+                    account.jid, account.password, *self.args)
+            return client
+
+    def get_clients(self):
+        with self.lock:
+            return [(self.accounts[jid], client)
+                    for jid, client in self.clients.items()]
+
+    def stop(self):
+        with self.lock:
+            for client in self.clients.values():
+                client.stop()
+            self.clients = {}
+            self.accounts = {}
+            self.ring = HashRing([])
+            self.configured = None
+            self.args = None
+
+    def close(self):
+        """
+        Stops the sessions for good. Called when the extension is disabled.
+        """
+        with self.lock:
+            self.closed = True
+        self.stop()
@@ -0,0 +1,120 @@
+#
+# presence.py -- Presence of the notification recipients.
+#
+# Copyright (c) 2013  Horatiu Eugen Vlad
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+import logging
+import threading
+
+OFFLINE_SEND = "send"
+OFFLINE_DROP = "drop"
+OFFLINE_DEFER = "defer"
+
+
+def get_bare_jid(jid):
+    """
+    Returns the bare JID of a JID string, which is compared case insensitively.
+    """
+    return jid.split("/", 1)[0].lower()
+
+
+def get_deferred_digest(notifications):
+    """
+    Returns the message that replaces the notifications deferred while the
+    recipient was offline.
+    """
+    return u"\n\n".join([u"While you were away:"] +
+                         [notification.message for notification in notifications])
+
+
+class XmppPresence(object):
+    """
+    Tracks the presence of the contacts of the sender accounts and holds the
+    notifications deferred while the recipients are unavailable.
+
+    The sessions report the presence stanzas of the contacts that share
+    their presence with a sender account. A JID is offline only when its
+    presence is known and none of its resources is available, so the
+    recipients that did not add a sender account to their roster are always
+    considered online.
+    """
+    MAX_DEFERRED = 50
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.resources = {}
+        self.deferred = {}
+        self.returned = set()
+
+    def update(self, jid, available):
+        """
+        Records an available or unavailable presence of a full JID.
+        """
+        bare = get_bare_jid(jid)
+        resource = jid.partition("/")[2]
+        with self.lock:
+            resources = self.resources.setdefault(bare, set())
+            if available:
+                if not resources and bare in self.deferred:
+                    self.returned.add(bare)
+                resources.add(resource)
+            else:
+                resources.discard(resource)
+        logging.debug(u"XmppPresence %s %s", jid, available and "available" or "unavailable")
+
+    def is_offline(self, jid):
+        with self.lock:
+            resources = self.resources.get(get_bare_jid(jid))
+            return resources is not None and not resources
+
+    def defer(self, jid, notification):
+        """
+        Holds a notification for an offline JID until it is available again.
+        Only the latest ``MAX_DEFERRED`` notifications are held per JID, the
+        older ones are returned.
+        """
+        bare = get_bare_jid(jid)
+        with self.lock:
+            deferred = self.deferred.setdefault(bare, [])
+            deferred.append(notification)
+            dropped = deferred[:-self.MAX_DEFERRED]
+            del deferred[:-self.MAX_DEFERRED]
+            # The JID may have become available since it was found offline.
+            if self.resources.get(bare):
+                self.returned.add(bare)
+        return dropped
+
+    def pop_returned(self):
+        """
+        Returns the JIDs that are available again, with the notifications
+        deferred for them.
+        """
+        with self.lock:
+            returned = [(jid, self.deferred.pop(jid)) for jid in self.returned
+                        if jid in self.deferred]
+            self.returned = set()
+        return returned
+
+
+presence = XmppPresence()
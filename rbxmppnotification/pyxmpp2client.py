@@ -0,0 +1,687 @@
+#
+# pyxmpp2client.py -- XMPP client backend running the pyxmpp2 main loop.
+#
+# Copyright (c) 2013  Horatiu Eugen Vlad
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+import collections
+import logging
+import socket
+import threading
+import time
+
+from rbxmppnotification.metrics import CONNECT_TIME
+from rbxmppnotification.presence import presence
+from rbxmppnotification.transport import XmppTransport, BACKEND_PYXMPP2, \
+                                         PING_NS, DISCO_INFO_NS, ADDRESS_NS, \
+                                         MUC_NS, SM_NS, XHTML_IM_BODY
+
+from pyxmpp2.etree import ElementTree
+from pyxmpp2.jid import JID
+from pyxmpp2.iq import Iq
+from pyxmpp2.message import Message
+from pyxmpp2.presence import Presence
+from pyxmpp2.binding import ResourceBindingHandler
+from pyxmpp2.client import Client
+from pyxmpp2.clientstream import ClientStream
+from pyxmpp2.session import SessionHandler
+from pyxmpp2.settings import XMPPSettings
+from pyxmpp2.stanzapayload import XMLPayload
+from pyxmpp2.streamsasl import StreamSASLHandler
+from pyxmpp2.streamtls import StreamTLSHandler
+from pyxmpp2.transport import TCPTransport
+from pyxmpp2.interfaces import EventHandler, XMPPFeatureHandler, event_handler, \
+                               presence_stanza_handler, StreamFeatureHandler, \
+                               StreamFeatureHandled, stream_element_handler
+from pyxmpp2.mainloop.interfaces import TimeoutHandler, timeout_handler
+from pyxmpp2.streamevents import AuthorizedEvent, DisconnectedEvent, StreamEvent
+from pyxmpp2 import xmppserializer
+
+STANZA_TAGS = frozenset("{jabber:client}%s" % name for name in ("message", "presence", "iq"))
+
+def address_stanza(element, to_jid, stanza_id):
+    """
+    Returns a copy of the stanza element sent to ``to_jid``. The children of
+    the element are shared with the copy, not copied.
+    """
+    stanza = ElementTree.Element(element.tag, element.attrib)
+    stanza.set("to", to_jid.as_unicode())
+    stanza.set("id", stanza_id)
+    stanza.text = element.text
+    stanza.extend(element)
+    return stanza
+
+def address_multicast_stanza(element, service_jid, to_jids, stanza_id):
+    """
+    Returns a copy of the stanza element sent to the XEP-0033 multicast
+    service, which delivers it to the ``to_jids`` as blind copies.
+    """
+    stanza = address_stanza(element, service_jid, stanza_id)
+    addresses = ElementTree.SubElement(stanza, "{%s}addresses" % ADDRESS_NS)
+    for to_jid in to_jids:
+        ElementTree.SubElement(addresses, "{%s}address" % ADDRESS_NS,
+                               type="bcc", jid=to_jid.as_unicode())
+    return stanza
+
+class ResumedEvent(StreamEvent):
+    """
+    Event raised when the previous stream is resumed with XEP-0198 stream
+    management, instead of binding a resource and authorizing the stream.
+    """
+    def __init__(self, resumed_jid):
+        self.resumed_jid = resumed_jid
+
+    def __unicode__(self):
+        return u"Resumed: {0}".format(self.resumed_jid)
+
+class ManagedClientStream(ClientStream):
+    """
+    A client stream counting its stanzas for XEP-0198 stream management. The
+    counters and the unacknowledged stanzas are kept by the ``manager``, so
+    they outlive the stream.
+    """
+    def __init__(self, jid, stanza_route, handlers, settings, manager):
+        ClientStream.__init__(self, jid, stanza_route, handlers, settings)
+        self.manager = manager
+        self.sm_tracking = False
+        self.sm_enabled = False
+        self.sm_resuming = False
+
+    def initiate(self, transport, to=None):
+        # pyxmpp2 passes the received elements to the stream with the lock
+        # of the transport held, while the stream writes with its own lock
+        # held before the lock of the transport. Sharing the lock avoids the
+        # deadlock when writing while the acknowledgements are read.
+        self.lock = transport.lock
+        ClientStream.initiate(self, transport, to)
+
+    def transport_connected(self):
+        # The acknowledgement requests are small writes following the
+        # stanzas, which Nagle's algorithm would hold back until the server
+        # acknowledges the previous segment.
+        self.transport._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        ClientStream.transport_connected(self)
+
+    def _write_element(self, element):
+        # The stanza is kept before it is written, so that it is sent again
+        # if the stream drops while writing it.
+        if self.sm_tracking and element.tag in STANZA_TAGS:
+            self.manager.track_stanza(element)
+        ClientStream._write_element(self, element)
+
+    def _process_element(self, element):
+        if self.sm_enabled and element.tag in STANZA_TAGS:
+            self.manager.sm_inbound += 1
+        ClientStream._process_element(self, element)
+
+class ManagedClient(Client):
+    """
+    A client whose stream is handled by ``manager`` for stream management
+    before the resource binding, which a resumption replaces.
+    """
+    def __init__(self, jid, manager, settings):
+        self.manager = manager
+        self.binding_handler = None
+        Client.__init__(self, jid, [], settings)
+
+    def base_handlers_factory(self):
+        self.binding_handler = ResourceBindingHandler(self.settings)
+        return [StreamTLSHandler(self.settings), StreamSASLHandler(self.settings),
+                self.manager, self.binding_handler, SessionHandler()]
+
+    def connect(self):
+        """
+        Same as ``Client.connect``, with a ``ManagedClientStream``.
+        """
+        with self.lock:
+            if self.stream:
+                self._close_stream()
+            transport = TCPTransport(self.settings)
+            addr = self.settings["server"]
+            if addr:
+                service = None
+            else:
+                addr = self.jid.domain
+                service = self.settings["c2s_service"]
+            transport.connect(addr, self.settings["c2s_port"], service)
+            handlers = self._base_handlers + self.handlers + [self]
+            self.clear_response_handlers()
+            self.setup_stanza_handlers(handlers, "pre-auth")
+            stream = ManagedClientStream(self.jid, self, handlers, self.settings,
+                                         self.manager)
+            stream.initiate(transport)
+            self.main_loop.add_handler(transport)
+            self.main_loop.add_handler(stream)
+            self._ml_handlers += [transport, stream]
+            self.stream = stream
+            self.uplink = stream
+
+class XmppClient(EventHandler, TimeoutHandler, XMPPFeatureHandler, StreamFeatureHandler,
+                 XmppTransport):
+    """
+    A long-lived client that keeps an authenticated XMPP session open and
+    dispatches messages over it.
+
+    The pyxmpp2 main loop runs in a background thread. The session is
+    re-established with an exponential backoff when the connection drops and
+    kept alive with XEP-0199 pings while idle.
+
+    When the server supports XEP-0198 stream management, the stanzas are
+    kept in a ring buffer until the server acknowledges them, which is
+    requested after every message batch. A dropped stream is resumed on
+    reconnect instead of binding a new resource, and only the
+    unacknowledged stanzas are sent again. The stream management state is
+    only changed with the lock of the stream held.
+    """
+    NAME = "Review Board XMPP Notification Client"
+    VERSION = 0.1
+
+    KEEPALIVE_INTERVAL = 60
+    UNACKED_MAX = 1000
+    MULTICAST_MIN_RECEIVERS = 3
+    MULTICAST_BATCH_SIZE = 50
+    RECONNECT_MIN_DELAY = 1
+    RECONNECT_MAX_DELAY = 300
+    JID_CACHE_SIZE = 10000
+
+    def __init__(self, host, port, timeout, from_jid, password, use_tls, tls_verify_peer):
+        self.host = host
+        self.port = port
+        self.timeout = timeout or 5
+        self.from_jid = JID(from_jid)
+        self.password = password
+        self.use_tls = use_tls
+        self.tls_verify_peer = tls_verify_peer
+
+        self.client = None
+        self.client_settings = None
+        self.jids = {}
+        self.lock = threading.RLock()
+        self.authorized = threading.Event()
+        self.multicast_jid = None
+        self.rooms = {}
+        self.joined_rooms = set()
+        self.running = False
+        self.thread = None
+        self.reconnect_delay = self.RECONNECT_MIN_DELAY
+        self.reconnect_at = 0
+        self.stop_deadline = 0
+        self.connect_started = 0
+        self.sm_id = None
+        self.sm_jid = None
+        self.sm_inbound = 0
+        self.sm_outbound = 0
+        self.unacked = collections.deque(maxlen=self.UNACKED_MAX)
+
+    def start(self):
+        """
+        Starts the main loop thread. The connection is opened from there.
+        """
+        with self.lock:
+            if self.running:
+                return
+            self.client_settings = XMPPSettings({
+                            u"password": self.password,
+                            u"starttls": self.use_tls,
+                            u"tls_verify_peer": self.tls_verify_peer,
+                            u"server" : self.host,
+                            u"c2s_port": self.port,
+                            u"default_stanza_timeout": self.timeout,
+                        })
+            self.client = ManagedClient(self.from_jid, self, self.client_settings)
+            self.running = True
+            self.reconnect_at = 0
+            self.thread = threading.Thread(target=self.run,
+                                           name="rbxmppnotification-client")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        """
+        Disconnects gracefully and waits for the main loop thread to finish.
+        """
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+            self.stop_deadline = time.time() + self.timeout
+            stream = self.client.stream
+            if stream:
+                logging.debug(u"XmppClient disconnecting stream")
+                # A stream closed gracefully cannot be resumed.
+                with stream.lock:
+                    stream.sm_tracking = stream.sm_enabled = False
+                    self.reset_stream_management(None)
+                self.client.disconnect()
+        self.thread.join(self.timeout + 1)
+        self.thread = None
+
+    def run(self):
+        logging.debug(u"XmppClient main loop started for %s", self.from_jid)
+        # pyxmpp2 only initializes its thread-local serializer in the thread
+        # importing it, and serializes the stream elements it logs.
+        if not hasattr(xmppserializer._THREAD, "serializer"):
+            xmppserializer._THREAD.serializer = None
+        while self.running or self.client.stream:
+            if self.running:
+                if not self.client.stream and time.time() >= self.reconnect_at:
+                    self.connect()
+            elif time.time() >= self.stop_deadline:
+                logging.debug(u"XmppClient closing stream after disconnect timeout")
+                with self.lock:
+                    if self.client.stream:
+                        self.client.close_stream()
+                break
+            try:
+                self.client.main_loop.loop_iteration(1)
+            except Exception, e:
+                logging.error("XmppClient main loop error: %s", e, exc_info=1)
+                with self.lock:
+                    if self.client.stream:
+                        self.client.close_stream()
+                if self.running:
+                    self.schedule_reconnect()
+        logging.debug(u"XmppClient main loop finished for %s", self.from_jid)
+
+    def connect(self):
+        logging.debug(u"XmppClient connecting to %s:%s as %s",
+                      self.host, self.port, self.from_jid)
+        with self.lock:
+            self.authorized.clear()
+            self.multicast_jid = None
+            self.connect_started = time.time()
+            try:
+                # The stream feature handlers of a client serve a single
+                # stream, so every connection gets a new client.
+                self.client = ManagedClient(self.from_jid, self, self.client_settings)
+                self.client.connect()
+            except Exception, e:
+                logging.error("Error connecting to XMPP server %s:%s: %s",
+                              self.host, self.port, e)
+                self.schedule_reconnect()
+
+    def schedule_reconnect(self):
+        with self.lock:
+            self.authorized.clear()
+            self.multicast_jid = None
+            self.reconnect_at = time.time() + self.reconnect_delay
+            logging.debug(u"XmppClient reconnecting in %s seconds",
+                          self.reconnect_delay)
+            self.reconnect_delay = min(self.reconnect_delay * 2,
+                                       self.RECONNECT_MAX_DELAY)
+
+    @event_handler(AuthorizedEvent)
+    def handle_authorized(self, event):
+        """
+        Enables stream management on a new stream when the server supports
+        it. The stanzas left unacknowledged by a stream that could not be
+        resumed are sent again on this one.
+        """
+        logging.debug(u"XmppClient event handler authorized: %s", event)
+        with self.lock:
+            stream = self.client.stream
+            if stream != event.stream:
+                logging.debug(u"XmppClient event handler ignore event")
+                return
+            with stream.lock:
+                unacked = self.reset_stream_management(None)
+                if stream.features.find("{%s}sm" % SM_NS) is not None:
+                    stream.sm_tracking = True
+                    stream.write_element(ElementTree.Element("{%s}enable" % SM_NS,
+                                                             resume="true"))
+                if unacked:
+                    logging.debug(u"XmppClient sending %d unacknowledged stanzas again",
+                                  len(unacked))
+                    self.send_unacked(stream, unacked)
+            self.start_session(False)
+
+    @event_handler(ResumedEvent)
+    def handle_resumed_event(self, event):
+        logging.debug(u"XmppClient event handler resumed: %s", event)
+        with self.lock:
+            if self.client.stream != event.stream:
+                logging.debug(u"XmppClient event handler ignore event")
+                return
+            self.start_session(True)
+
+    def start_session(self, resumed):
+        """
+        Marks the session available once the stream is authorized or
+        resumed. The rooms joined on a resumed stream are kept.
+        """
+        self.authorized.set()
+        CONNECT_TIME.observe(time.time() - self.connect_started, backend=BACKEND_PYXMPP2)
+        self.reconnect_delay = self.RECONNECT_MIN_DELAY
+        if not resumed:
+            self.joined_rooms = set()
+        self.update_rooms()
+        self.discover_multicast()
+
+    def handle_stream_features(self, stream, features):
+        """
+        Resumes the previous stream instead of binding a resource, when it
+        was resumable and the server supports stream management.
+        """
+        if (not stream.authenticated or self.sm_id is None or
+                features.find("{%s}sm" % SM_NS) is None):
+            return None
+        logging.debug(u"XmppClient resuming stream %s", self.sm_id)
+        stream.sm_resuming = True
+        stream.write_element(ElementTree.Element("{%s}resume" % SM_NS,
+                                                 h=unicode(self.sm_inbound),
+                                                 previd=self.sm_id))
+        return StreamFeatureHandled("Stream management", mandatory=True)
+
+    def make_stream_features(self, stream, features):
+        return None
+
+    @stream_element_handler("{%s}enabled" % SM_NS, "initiator")
+    def handle_sm_enabled(self, stream, element):
+        logging.debug(u"XmppClient stream management enabled, resumable %s",
+                      element.get("resume"))
+        stream.sm_enabled = True
+        if element.get("resume") in ("true", "1"):
+            self.sm_id = element.get("id")
+            self.sm_jid = stream.me
+        return True
+
+    @stream_element_handler("{%s}resumed" % SM_NS, "initiator")
+    def handle_sm_resumed(self, stream, element):
+        """
+        The previous stream is resumed: only the stanzas the server did not
+        acknowledge are sent again.
+        """
+        stream.sm_resuming = False
+        stream.sm_tracking = stream.sm_enabled = True
+        stream.me = self.sm_jid
+        unacked = self.handle_resumed(int(element.get("h")))
+        logging.debug(u"XmppClient stream %s resumed, sending %d stanzas again",
+                      self.sm_id, len(unacked))
+        self.send_unacked(stream, unacked)
+        stream.event(ResumedEvent(stream.me))
+        return True
+
+    @stream_element_handler("{%s}failed" % SM_NS, "initiator")
+    def handle_sm_failed(self, stream, element):
+        if stream.sm_resuming:
+            logging.debug(u"XmppClient stream %s could not be resumed", self.sm_id)
+            stream.sm_resuming = False
+            self.sm_id = None
+            if element.get("h") is not None:
+                self.handle_ack(int(element.get("h")))
+            self.client.binding_handler.bind(stream, stream.settings["resource"])
+        else:
+            logging.debug(u"XmppClient stream management not enabled")
+            stream.sm_tracking = False
+            self.reset_stream_management(None)
+        return True
+
+    @stream_element_handler("{%s}r" % SM_NS, "initiator")
+    def handle_sm_request(self, stream, element):
+        stream.write_element(ElementTree.Element("{%s}a" % SM_NS,
+                                                 h=unicode(self.sm_inbound)))
+        return True
+
+    @stream_element_handler("{%s}a" % SM_NS, "initiator")
+    def handle_sm_ack(self, stream, element):
+        self.handle_ack(int(element.get("h")))
+        return True
+
+    def send_unacked(self, stream, stanzas):
+        """
+        Writes the stanzas again and requests their acknowledgement.
+        """
+        for stanza in stanzas:
+            stream.write_element(stanza)
+        self.request_ack(stream)
+
+    def request_ack(self, stream):
+        if stream.sm_tracking:
+            stream.write_element(ElementTree.Element("{%s}r" % SM_NS))
+
+    def track_stanza(self, stanza):
+        """
+        Keeps a stanza written to a managed stream until it is acknowledged.
+        The oldest ones are dropped once the buffer is full.
+        """
+        if len(self.unacked) == self.UNACKED_MAX:
+            logging.error("XMPP stream management buffer full, stanza %d will not be "
+                          "sent again", self.unacked[0][0])
+        self.sm_outbound += 1
+        self.unacked.append((self.sm_outbound, stanza))
+
+    def handle_ack(self, h):
+        while self.unacked and self.unacked[0][0] <= h:
+            self.unacked.popleft()
+
+    def handle_resumed(self, h):
+        """
+        Returns the stanzas the server did not receive before the stream
+        dropped, which are counted again when sent on the resumed stream.
+        """
+        self.handle_ack(h)
+        unacked = [stanza for seq, stanza in self.unacked]
+        self.unacked.clear()
+        self.sm_outbound = h
+        return unacked
+
+    def reset_stream_management(self, sm_id):
+        """
+        Starts counting the stanzas of a new stream, resumable with
+        ``sm_id``, and returns the stanzas left unacknowledged by the
+        previous one.
+        """
+        unacked = [stanza for seq, stanza in self.unacked]
+        self.unacked.clear()
+        self.sm_id = sm_id
+        self.sm_inbound = self.sm_outbound = 0
+        return unacked
+
+    @presence_stanza_handler()
+    def handle_presence_available(self, stanza):
+        if stanza.from_jid:
+            presence.update(stanza.from_jid.as_unicode(), True)
+        return True
+
+    @presence_stanza_handler("unavailable")
+    def handle_presence_unavailable(self, stanza):
+        if stanza.from_jid:
+            presence.update(stanza.from_jid.as_unicode(), False)
+        return True
+
+    @presence_stanza_handler("subscribe")
+    def handle_presence_subscribe(self, stanza):
+        """
+        Approves the presence subscription requests of the contacts and
+        subscribes back to their presence.
+        """
+        logging.debug(u"XmppClient presence subscription from %s", stanza.from_jid)
+        return [stanza.make_accept_response(),
+                Presence(to_jid=stanza.from_jid.bare(), stanza_type="subscribe")]
+
+    def get_jid(self, jid):
+        """
+        Returns the parsed JID of a JID string. Parsed JIDs are cached.
+        """
+        parsed = self.jids.get(jid)
+        if parsed is None:
+            if len(self.jids) >= self.JID_CACHE_SIZE:
+                self.jids.clear()
+            parsed = self.jids[jid] = JID(jid)
+        return parsed
+
+    def set_rooms(self, rooms, nickname):
+        with self.lock:
+            rooms = [self.get_jid(room) for room in rooms]
+            rooms = dict((room, JID(room.local, room.domain, nickname))
+                         for room in rooms)
+            if rooms != self.rooms:
+                self.rooms = rooms
+                if self.authorized.is_set() and self.client.stream:
+                    self.update_rooms()
+
+    def update_rooms(self):
+        """
+        Joins the configured rooms the session is not present in yet and
+        leaves the ones that are not configured anymore.
+        """
+        for room, occupant in self.joined_rooms - set(self.rooms.items()):
+            logging.debug(u"XmppClient leaving room %s", occupant)
+            self.client.stream.send(Presence(to_jid=occupant, stanza_type="unavailable"))
+        for room, occupant in set(self.rooms.items()) - self.joined_rooms:
+            logging.debug(u"XmppClient joining room %s", occupant)
+            presence = Presence(to_jid=occupant)
+            muc = ElementTree.Element("{%s}x" % MUC_NS)
+            ElementTree.SubElement(muc, "{%s}history" % MUC_NS, maxchars="0")
+            presence.add_payload(XMLPayload(muc))
+            self.client.stream.send(presence)
+        self.joined_rooms = set(self.rooms.items())
+
+    def discover_multicast(self):
+        """
+        Asks the server whether it supports Extended Stanza Addressing
+        (XEP-0033), so large recipient sets can be sent as one stanza per
+        batch of recipients.
+        """
+        self.multicast_jid = None
+        server_jid = JID(self.from_jid.domain)
+        query = Iq(to_jid=server_jid, stanza_type="get")
+        query.add_payload(XMLPayload(ElementTree.Element("{%s}query" % DISCO_INFO_NS)))
+        self.client.set_response_handlers(query, self.handle_disco_info,
+                                          self.handle_disco_error)
+        self.client.stream.send(query)
+
+    def handle_disco_info(self, stanza):
+        features = [feature.get("var") for feature in
+                    stanza.as_xml().iter("{%s}feature" % DISCO_INFO_NS)]
+        if ADDRESS_NS in features:
+            logging.debug(u"XmppClient server %s supports multicast", stanza.from_jid)
+            self.multicast_jid = stanza.from_jid
+
+    def handle_disco_error(self, stanza):
+        logging.debug(u"XmppClient service discovery failed: %s", stanza.as_xml())
+
+    @event_handler(DisconnectedEvent)
+    def handle_disconnected(self, event):
+        logging.debug("XmppClient event handler disconnected: %s", event)
+        with self.lock:
+            if self.client.stream and self.client.stream != event.stream:
+                logging.debug(u"XmppClient event handler ignore event")
+                return
+            self.authorized.clear()
+            self.multicast_jid = None
+            if self.running:
+                self.schedule_reconnect()
+
+    @event_handler()
+    def handle_all(self, event):
+        logging.debug(u"XmppClient event handler: %s", event)
+
+    @timeout_handler(KEEPALIVE_INTERVAL, True)
+    def keepalive(self):
+        """
+        Sends a XEP-0199 ping to the server so idle connections are not
+        dropped by the server or by NAT devices along the way.
+        """
+        with self.lock:
+            if self.authorized.is_set() and self.client.stream:
+                ping = Iq(to_jid=JID(self.from_jid.domain), stanza_type="get")
+                ping.add_payload(XMLPayload(ElementTree.Element("{%s}ping" % PING_NS)))
+                try:
+                    self.client.stream.send(ping)
+                except Exception, e:
+                    logging.debug(u"XmppClient keepalive failed: %s", e)
+                    self.client.close_stream()
+                    self.schedule_reconnect()
+        return self.KEEPALIVE_INTERVAL
+
+    def build_stanzas(self, receivers, rooms, message, html):
+        """
+        Returns the stanza elements of a message. The message is built once
+        and only the addressing differs between the stanzas. Large receiver
+        sets are sent through the XEP-0033 multicast service when the server
+        offers one.
+        """
+        template = Message(body = message, stanza_type = "chat")
+        if html:
+            xhtml = ElementTree.fromstring((XHTML_IM_BODY % html).encode("utf-8"))
+            template.add_payload(XMLPayload(xhtml))
+        element = template.as_xml()
+
+        # Multi-user chat rooms get a single groupchat message.
+        stanzas = []
+        for i, room in enumerate(rooms):
+            stanza = address_stanza(element, self.get_jid(room),
+                                    u"%s-room-%d" % (template.stanza_id, i))
+            stanza.set("type", "groupchat")
+            stanzas.append(stanza)
+
+        to_jids = [self.get_jid(receiver) for receiver in receivers]
+        multicast_jid = self.multicast_jid
+        if multicast_jid is not None and len(to_jids) >= self.MULTICAST_MIN_RECEIVERS:
+            batch_size = self.MULTICAST_BATCH_SIZE
+            stanzas.extend(address_multicast_stanza(element, multicast_jid,
+                                                    to_jids[i:i + batch_size],
+                                                    u"%s-%d" % (template.stanza_id, i))
+                           for i in range(0, len(to_jids), batch_size))
+        else:
+            stanzas.extend(address_stanza(element, to_jid,
+                                          u"%s-%d" % (template.stanza_id, i))
+                           for i, to_jid in enumerate(to_jids))
+        return stanzas
+
+    def send(self, req_id, receivers, rooms, message, html=None):
+        logging.debug(u"XmppClient start sending messages for request #%s", req_id)
+        self.start()
+        if not self.authorized.wait(self.timeout):
+            logging.error("XMPP session not available, notification for request #%s deferred",
+                          req_id)
+            return False
+        stanzas = self.build_stanzas(receivers, rooms, message, html)
+        with self.lock:
+            stream = self.client.stream
+            if not stream:
+                return False
+            written = 0
+            try:
+                for stanza in stanzas:
+                    logging.debug("XmppHandler for request #%s send message to %s", req_id, stanza.get("to"))
+                    stream.write_element(stanza)
+                    written += 1
+                self.request_ack(stream)
+                return True
+            except Exception, e:
+                with stream.lock:
+                    if stream.sm_tracking:
+                        # The stanza being written is already kept, and the
+                        # next ones are sent again with it once the stream
+                        # is resumed or replaced.
+                        for stanza in stanzas[written + 1:]:
+                            self.track_stanza(stanza)
+                        logging.warning("XMPP stream lost while sending the notification for"
+                                        " request #%s, it will be sent again: %s", req_id, e)
+                        return True
+                logging.error("Error sending XMPP notification for request #%s: %s",
+                          req_id,
+                          e,
+                          exc_info=1)
+                return False
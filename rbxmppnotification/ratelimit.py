@@ -0,0 +1,173 @@
+#
+# ratelimit.py -- Flood protection for the outgoing XMPP stanzas.
+#
+# Copyright (c) 2013  Horatiu Eugen Vlad
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+import logging
+import time
+
+OVERFLOW_DELAY = "delay"
+OVERFLOW_SUMMARY = "summary"
+
+
+class TokenBucket(object):
+    """
+    A token bucket refilled with ``rate`` tokens per second, holding at most
+    ``burst`` tokens.
+    """
+    def __init__(self, rate, burst, now):
+        self.rate = float(rate)
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, now):
+        """
+        Takes one token if available. Returns ``False`` otherwise.
+        """
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def reserve(self, count, now):
+        """
+        Takes ``count`` tokens if available and returns 0, otherwise returns
+        the number of seconds until they are. A count larger than the burst
+        is taken from a full bucket, which then stays in debt for a while.
+        """
+        self.refill(now)
+        needed = min(count, self.burst)
+        if self.tokens >= needed:
+            self.tokens -= count
+            return 0
+        return (needed - self.tokens) / self.rate
+
+    def get_delay(self, now):
+        """
+        Returns the number of seconds until the next token is available.
+        """
+        self.refill(now)
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def is_full(self, now):
+        self.refill(now)
+        return self.tokens >= self.burst
+
+
+class XmppRateLimiter(object):
+    """
+    Limits the messages sent to each destination JID with a token bucket per
+    JID, and the stanzas sent over the session with a global token bucket.
+
+    The limiter is used only from the dispatcher thread, which it never
+    blocks: the messages over the limits are postponed by the dispatcher.
+    ``clock`` returns the current time, ``time.time`` by default.
+    """
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.per_jid = None
+        self.global_bucket = None
+        self.buckets = {}
+        self.suppressed = {}
+
+    def configure(self, per_jid_rate, burst, global_rate):
+        """
+        Applies the settings: ``per_jid_rate`` messages per minute for each
+        JID with bursts of up to ``burst`` messages, and ``global_rate``
+        stanzas per second overall. A rate of 0 disables the limit.
+        """
+        per_jid = per_jid_rate and (per_jid_rate / 60.0, burst or 1) or None
+        if per_jid != self.per_jid:
+            self.per_jid = per_jid
+            self.buckets = {}
+        if not global_rate:
+            self.global_bucket = None
+        elif self.global_bucket is None or self.global_bucket.rate != global_rate:
+            self.global_bucket = TokenBucket(global_rate, global_rate, self.clock())
+
+    def admit(self, receivers):
+        """
+        Splits the receivers into the ones that can be sent a message now and
+        the limited ones. Returns both lists and the number of seconds until
+        all the limited receivers can be sent a message again.
+        """
+        if self.per_jid is None:
+            return list(receivers), [], 0
+        now = self.clock()
+        allowed = []
+        limited = []
+        delay = 0
+        for receiver in receivers:
+            bucket = self.buckets.get(receiver)
+            if bucket is None:
+                bucket = self.buckets[receiver] = TokenBucket(self.per_jid[0],
+                                                              self.per_jid[1], now)
+            if bucket.consume(now):
+                allowed.append(receiver)
+            else:
+                limited.append(receiver)
+                delay = max(delay, bucket.get_delay(now))
+        if limited:
+            logging.debug(u"XMPP rate limit reached for %s", limited)
+        return allowed, limited, delay
+
+    def suppress(self, receivers):
+        """
+        Counts a message that was not sent to the receivers, to be reported
+        in a summary once their rate limit allows it.
+        """
+        for receiver in receivers:
+            self.suppressed[receiver] = self.suppressed.get(receiver, 0) + 1
+
+    def pop_summaries(self):
+        """
+        Returns the ``(receiver, count)`` summaries that can be sent now and
+        forgets the buckets that are full again.
+        """
+        now = self.clock()
+        summaries = []
+        for receiver, count in list(self.suppressed.items()):
+            bucket = self.buckets.get(receiver)
+            if bucket is None or bucket.get_delay(now) == 0:
+                del self.suppressed[receiver]
+                summaries.append((receiver, count))
+        for receiver, bucket in list(self.buckets.items()):
+            if receiver not in self.suppressed and bucket.is_full(now):
+                del self.buckets[receiver]
+        return summaries
+
+    def reserve(self, count):
+        """
+        Takes ``count`` stanzas from the global limit if it allows them now
+        and returns 0, otherwise returns the number of seconds to wait.
+        """
+        if self.global_bucket is None:
+            return 0
+        return self.global_bucket.reserve(count, self.clock())
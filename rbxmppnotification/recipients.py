@@ -0,0 +1,459 @@
+#
+# recipients.py -- Resolution of the XMPP notification recipients.
+#
+# Copyright (c) 2013  Horatiu Eugen Vlad
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+import logging
+import time
+from collections import namedtuple
+
+import pytz
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.utils import timezone
+from reviewboard.accounts.models import Profile
+from reviewboard.reviews.models import Group, Review, ReviewRequest
+
+from rbxmppnotification.coalesce import EVENT_NEW_USERS
+from rbxmppnotification.metrics import RECIPIENT_CACHE, RECIPIENT_QUERIES, \
+                                       RECIPIENT_RESOLUTION
+from rbxmppnotification.models import EVENT_FLAGS, EVENTS_ALL, XmppPreferences
+
+
+class Recipient(namedtuple('Recipient', [
+        'id', 'jid', 'events', 'target_only', 'target', 'quiet_start',
+        'quiet_end', 'timezone'])):
+    """
+    A notification recipient: the user id and the JID, or the JID local part
+    when the user is on the sender's domain, with the preferences of the
+    user. ``target`` tells whether the user is a target reviewer of the
+    review request, and is only resolved when ``target_only`` is set.
+    """
+    __slots__ = ()
+
+    def wants(self, kind, now):
+        """
+        Returns whether the user wants to be notified of an event of the
+        given kind at the ``now`` time. The new users have no target
+        reviewers, so their notifications are sent whatever ``target_only``.
+        """
+        if not self.events & EVENT_FLAGS.get(kind, EVENTS_ALL):
+            return False
+        if self.target_only and not self.target and kind != EVENT_NEW_USERS:
+            return False
+        if self.quiet_start is not None and self.quiet_end is not None:
+            local = timezone.localtime(now, pytz.timezone(self.timezone or 'UTC')).time()
+            if self.quiet_start <= self.quiet_end:
+                quiet = self.quiet_start <= local < self.quiet_end
+            else:
+                quiet = local >= self.quiet_start or local < self.quiet_end
+            if quiet:
+                return False
+        return True
+
+
+# The columns of the users, their preferences and time zone, fetched to
+# build the recipients.
+RECIPIENT_FIELDS = ('pk', 'username',
+                    'xmpp_preferences__jid',
+                    'xmpp_preferences__events',
+                    'xmpp_preferences__target_only',
+                    'xmpp_preferences__quiet_start',
+                    'xmpp_preferences__quiet_end',
+                    'profile__timezone')
+
+def make_recipient(row, target):
+    """
+    Returns the ``Recipient`` of a row of ``RECIPIENT_FIELDS``.
+    """
+    pk, username, jid, events, target_only, quiet_start, quiet_end, tz = row
+    if events is None:
+        events = EVENTS_ALL
+    return Recipient(pk, jid or username, events, bool(target_only), target,
+                     quiet_start, quiet_end, tz)
+
+def get_users_review_request(review_request):
+    """
+    Returns the set of active users that are interested in the review request,
+    as ``Recipient`` tuples.
+
+    The submitter, the participants, the target people, the members of the
+    target groups and the users who starred the review request are all
+    resolved with a single query, whatever the number and size of the groups.
+    The preferences and the time zone of the users are joined in the same
+    query. Only when some users want to be notified as target reviewers
+    only, a second query tells which of them are.
+    """
+    start = time.time()
+    targeted = (
+        Q(pk__in=review_request.target_people.values('pk')) |
+        Q(pk__in=Group.users.through.objects
+                       .filter(group__review_requests=review_request)
+                       .values('user')))
+    interested = (
+        targeted |
+        Q(pk=review_request.submitter_id) |
+        Q(pk__in=Review.objects.filter(review_request=review_request)
+                               .values('user')) |
+        Q(pk__in=Profile.objects.filter(starred_review_requests=review_request)
+                                .values('user')))
+
+    rows = list(User.objects.filter(interested, is_active=True)
+                            .values_list(*RECIPIENT_FIELDS))
+    queries = 1
+
+    restricted = [row[0] for row in rows if row[4]]
+    targets = set()
+    if restricted:
+        targets = set(User.objects.filter(targeted, pk__in=restricted)
+                                  .values_list('pk', flat=True))
+        queries += 1
+
+    users = set(make_recipient(row, row[0] in targets) for row in rows)
+
+    RECIPIENT_RESOLUTION.observe(time.time() - start)
+    RECIPIENT_QUERIES.observe(queries)
+    logging.debug("XMPP notification for review request #%s will be sent to: %s",review_request.get_display_id(), users)
+    return users
+
+
+def get_users_review_requests(review_requests):
+    """
+    Returns the active users that are interested in each of the review
+    requests, as sets of ``Recipient`` tuples keyed by the review request id.
+
+    The target people, target groups and their members, participants and
+    stars of all the review requests are fetched with one query each, then
+    the users with one more query, whatever the number of review requests.
+    """
+    start = time.time()
+    ids = [review_request.pk for review_request in review_requests]
+    targeted = dict((pk, set()) for pk in ids)
+    interested = dict((review_request.pk, set([review_request.submitter_id]))
+                      for review_request in review_requests)
+
+    for pk, user_id in (ReviewRequest.target_people.through.objects
+                        .filter(reviewrequest__in=ids)
+                        .values_list('reviewrequest', 'user')):
+        targeted[pk].add(user_id)
+    groups = {}
+    for pk, group_id in (ReviewRequest.target_groups.through.objects
+                         .filter(reviewrequest__in=ids)
+                         .values_list('reviewrequest', 'group')):
+        groups.setdefault(group_id, []).append(pk)
+    queries = 2
+    if groups:
+        for group_id, user_id in (Group.users.through.objects
+                                  .filter(group__in=list(groups))
+                                  .values_list('group', 'user')):
+            for pk in groups[group_id]:
+                targeted[pk].add(user_id)
+        queries += 1
+    for pk, user_id in (Review.objects.filter(review_request__in=ids)
+                        .values_list('review_request', 'user')):
+        interested[pk].add(user_id)
+    for pk, user_id in (Profile.starred_review_requests.through.objects
+                        .filter(reviewrequest__in=ids)
+                        .values_list('reviewrequest', 'profile__user')):
+        interested[pk].add(user_id)
+    queries += 2
+
+    user_ids = set()
+    for pk in ids:
+        interested[pk].update(targeted[pk])
+        user_ids.update(interested[pk])
+    rows = dict((row[0], row) for row in
+                User.objects.filter(pk__in=user_ids, is_active=True)
+                            .values_list(*RECIPIENT_FIELDS))
+    queries += 1
+
+    users = {}
+    for pk in ids:
+        users[pk] = set(make_recipient(rows[user_id], user_id in targeted[pk])
+                        for user_id in interested[pk] if user_id in rows)
+
+    RECIPIENT_RESOLUTION.observe(time.time() - start)
+    RECIPIENT_QUERIES.observe(queries)
+    logging.debug("XMPP notification recipients resolved for %d review requests",
+                  len(ids))
+    return users
+
+
+class RecipientCache(object):
+    """
+    Caches the recipients of the review requests in the Django cache.
+
+    The cache keys embed a version counter per review request, a global
+    version counter and the submitter id. The counters are bumped by signal
+    handlers whenever the target people, target groups, group membership,
+    stars, participants or user active state change, which invalidates the
+    affected entries without having to know their keys. The counters start
+    from the clock, so an evicted one never comes back to an old value.
+    """
+    KEY_PREFIX = "rbxmppnotification-recipients2"
+    TIMEOUT = 24 * 3600
+
+    def get_version_key(self, review_request_id=None):
+        if review_request_id is None:
+            return "%s-version" % self.KEY_PREFIX
+        return "%s-version-%s" % (self.KEY_PREFIX, review_request_id)
+
+    def make_keys(self, review_requests):
+        """
+        Returns the cache keys of the review requests, keyed by their id.
+        The version counters are all fetched in one cache lookup.
+        """
+        global_key = self.get_version_key()
+        request_keys = dict((review_request.pk, self.get_version_key(review_request.pk))
+                            for review_request in review_requests)
+        version_keys = [global_key] + list(request_keys.values())
+        versions = cache.get_many(version_keys)
+        missing = [key for key in version_keys if key not in versions]
+        if missing:
+            # An evicted counter would restart from its first value and make
+            # the entries cached with it valid again.
+            version = self.get_initial_version()
+            for key in missing:
+                cache.add(key, version, None)
+            versions.update(cache.get_many(missing))
+        return dict((review_request.pk,
+                     "%s-%s-%s-%s-%s" % (self.KEY_PREFIX, review_request.pk,
+                                         review_request.submitter_id,
+                                         versions.get(global_key, 0),
+                                         versions.get(request_keys[review_request.pk], 0)))
+                    for review_request in review_requests)
+
+    def get_initial_version(self):
+        """
+        Returns the first value of a version counter, taken from the clock
+        so that it differs from the values of an evicted counter.
+        """
+        return int(time.time() * 1000000)
+
+    def get_recipients(self, review_request):
+        """
+        Returns the recipients of the review request, resolving them only if
+        they are not cached yet.
+        """
+        return self.get_recipients_many([review_request])[review_request.pk]
+
+    def get_recipients_many(self, review_requests):
+        """
+        Returns the recipients of the review requests, keyed by their id. The
+        cache is looked up once for all of them and the recipients that are
+        not cached yet are resolved together.
+        """
+        review_requests = dict((review_request.pk, review_request)
+                               for review_request in review_requests)
+        keys = self.make_keys(review_requests.values())
+        cached = cache.get_many(list(keys.values()))
+        recipients = {}
+        missing = []
+        for pk, review_request in review_requests.items():
+            users = cached.get(keys[pk])
+            if users is None:
+                RECIPIENT_CACHE.inc(result="miss")
+                missing.append(review_request)
+            else:
+                RECIPIENT_CACHE.inc(result="hit")
+                logging.debug("XMPP notification recipients for review request #%s cached: %s",
+                              review_request.get_display_id(), users)
+                recipients[pk] = set(users)
+        if len(missing) == 1:
+            resolved = {missing[0].pk: get_users_review_request(missing[0])}
+        elif missing:
+            resolved = get_users_review_requests(missing)
+        else:
+            resolved = {}
+        if resolved:
+            cache.set_many(dict((keys[pk], users) for pk, users in resolved.items()),
+                           self.TIMEOUT)
+            for pk, users in resolved.items():
+                recipients[pk] = set(users)
+        return recipients
+
+    def invalidate(self, review_request_id=None):
+        """
+        Invalidates the recipients of one review request, or of all of them
+        when no review request is given.
+        """
+        key = self.get_version_key(review_request_id)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, self.get_initial_version(), None)
+
+    def review_request_m2m_changed_cb(self, sender, instance, action, reverse,
+                                      pk_set, **kwargs):
+        """
+        Listens to changes of the target people, target groups and stars of
+        the review requests.
+        """
+        if action not in ("post_add", "post_remove", "post_clear"):
+            return
+        if isinstance(instance, ReviewRequest):
+            self.invalidate(instance.pk)
+        elif pk_set:
+            for pk in pk_set:
+                self.invalidate(pk)
+        else:
+            self.invalidate()
+
+    def group_users_changed_cb(self, sender, action, **kwargs):
+        if action in ("post_add", "post_remove", "post_clear"):
+            self.invalidate()
+
+    def user_saved_cb(self, sender, instance, created, update_fields=None, **kwargs):
+        # Logins only update last_login, which does not affect the recipients.
+        # New users are not recipients of any review request yet, so a burst
+        # of registrations keeps the cache.
+        if not created and (update_fields is None or "is_active" in update_fields):
+            self.invalidate()
+
+    def review_saved_cb(self, sender, instance, created, **kwargs):
+        if created:
+            self.invalidate(instance.review_request_id)
+
+    def review_deleted_cb(self, sender, instance, **kwargs):
+        self.invalidate(instance.review_request_id)
+
+    def preferences_changed_cb(self, sender, instance, **kwargs):
+        # The preferences and the time zone are cached with the recipients.
+        self.invalidate()
+
+    def register_signals(self):
+        for through in (ReviewRequest.target_people.through,
+                        ReviewRequest.target_groups.through,
+                        Profile.starred_review_requests.through):
+            m2m_changed.connect(self.review_request_m2m_changed_cb, sender=through,
+                                dispatch_uid="rbxmppnotification")
+        m2m_changed.connect(self.group_users_changed_cb, sender=Group.users.through,
+                            dispatch_uid="rbxmppnotification")
+        post_save.connect(self.user_saved_cb, sender=User, dispatch_uid="rbxmppnotification")
+        post_save.connect(self.review_saved_cb, sender=Review, dispatch_uid="rbxmppnotification")
+        post_delete.connect(self.review_deleted_cb, sender=Review, dispatch_uid="rbxmppnotification")
+        post_save.connect(self.preferences_changed_cb, sender=XmppPreferences,
+                          dispatch_uid="rbxmppnotification")
+        post_delete.connect(self.preferences_changed_cb, sender=XmppPreferences,
+                            dispatch_uid="rbxmppnotification")
+        post_save.connect(self.preferences_changed_cb, sender=Profile,
+                          dispatch_uid="rbxmppnotification")
+
+    def unregister_signals(self):
+        for through in (ReviewRequest.target_people.through,
+                        ReviewRequest.target_groups.through,
+                        Profile.starred_review_requests.through):
+            m2m_changed.disconnect(self.review_request_m2m_changed_cb, sender=through,
+                                   dispatch_uid="rbxmppnotification")
+        m2m_changed.disconnect(self.group_users_changed_cb, sender=Group.users.through,
+                               dispatch_uid="rbxmppnotification")
+        post_save.disconnect(self.user_saved_cb, sender=User, dispatch_uid="rbxmppnotification")
+        post_save.disconnect(self.review_saved_cb, sender=Review, dispatch_uid="rbxmppnotification")
+        post_delete.disconnect(self.review_deleted_cb, sender=Review,
+                               dispatch_uid="rbxmppnotification")
+        post_save.disconnect(self.preferences_changed_cb, sender=XmppPreferences,
+                             dispatch_uid="rbxmppnotification")
+        post_delete.disconnect(self.preferences_changed_cb, sender=XmppPreferences,
+                               dispatch_uid="rbxmppnotification")
+        post_save.disconnect(self.preferences_changed_cb, sender=Profile,
+                             dispatch_uid="rbxmppnotification")
+
+
+recipient_cache = RecipientCache()
+
+
+class AdminCache(object):
+    """
+    Caches the recipients of the new user notifications, the active staff
+    members and superusers, in the Django cache.
+
+    The list is dropped when a user joins or leaves the administrators, or
+    when an administrator or their preferences change. The registrations of
+    other users keep it.
+    """
+    KEY = "rbxmppnotification-admins"
+    TIMEOUT = 24 * 3600
+
+    def get_admins(self):
+        """
+        Returns the administrators as ``Recipient`` tuples, resolving them
+        only if they are not cached.
+        """
+        admins = cache.get(self.KEY)
+        if admins is None:
+            rows = User.objects.filter(Q(is_staff=True) | Q(is_superuser=True),
+                                       is_active=True).values_list(*RECIPIENT_FIELDS)
+            admins = [make_recipient(row, False) for row in rows]
+            logging.debug("XMPP notification administrators resolved: %s", admins)
+            cache.set(self.KEY, admins, self.TIMEOUT)
+        return admins
+
+    def invalidate_user(self, user_id, admin=False):
+        """
+        Drops the cached administrators if the user is or was one of them.
+        """
+        admins = cache.get(self.KEY)
+        if admins is not None and (admin or user_id in [a.id for a in admins]):
+            cache.delete(self.KEY)
+
+    def user_saved_cb(self, sender, instance, update_fields=None, **kwargs):
+        if update_fields is not None and \
+           not set(update_fields) & set(["is_staff", "is_superuser", "is_active", "username"]):
+            return
+        self.invalidate_user(instance.pk, instance.is_active and
+                                          (instance.is_staff or instance.is_superuser))
+
+    def user_deleted_cb(self, sender, instance, **kwargs):
+        self.invalidate_user(instance.pk)
+
+    def preferences_changed_cb(self, sender, instance, **kwargs):
+        # The JID, the preferences and the time zone are cached with the
+        # administrators.
+        self.invalidate_user(instance.user_id)
+
+    def register_signals(self):
+        post_save.connect(self.user_saved_cb, sender=User,
+                          dispatch_uid="rbxmppnotification-admins")
+        post_delete.connect(self.user_deleted_cb, sender=User,
+                            dispatch_uid="rbxmppnotification-admins")
+        for model in (XmppPreferences, Profile):
+            post_save.connect(self.preferences_changed_cb, sender=model,
+                              dispatch_uid="rbxmppnotification-admins")
+        post_delete.connect(self.preferences_changed_cb, sender=XmppPreferences,
+                            dispatch_uid="rbxmppnotification-admins")
+
+    def unregister_signals(self):
+        post_save.disconnect(self.user_saved_cb, sender=User,
+                             dispatch_uid="rbxmppnotification-admins")
+        post_delete.disconnect(self.user_deleted_cb, sender=User,
+                               dispatch_uid="rbxmppnotification-admins")
+        for model in (XmppPreferences, Profile):
+            post_save.disconnect(self.preferences_changed_cb, sender=model,
+                                 dispatch_uid="rbxmppnotification-admins")
+        post_delete.disconnect(self.preferences_changed_cb, sender=XmppPreferences,
+                               dispatch_uid="rbxmppnotification-admins")
+
+
+admin_cache = AdminCache()
@@ -29,12 +29,15 @@ try:
     from reviewboard.accounts.signals import user_registered
 except ImportError:
     from djblets.auth.signals import user_registered
+from djblets.extensions.signals import settings_saved
 from reviewboard.reviews.models import ReviewRequest, Review
 from reviewboard.reviews.signals import review_request_published, \
                                         review_published, reply_published, \
                                         review_request_closed, \
                                         review_request_reopened
 
+from rbxmppnotification.recipients import admin_cache, recipient_cache
+from rbxmppnotification.siteurl import site_base_url
 from rbxmppnotification.xmpp import XmppSender
 
 class XmppSignals(object):
@@ -104,7 +107,22 @@ class XmppSignals(object):
         """
         logging.debug(u"XmppSignals user_registered_cb %s %s", user.first_name, user.last_name)
         if self.extension.settings['xmpp_send_new_user_notify']:
-            self.sender.send_xmpp_message(user, "Welcome to ReviewBoard")
+            self.sender.send_new_user(user)
+
+    def settings_saved_cb(self, sender, **kwargs):
+        """
+        Listens to the ``settings_saved`` signal of the extension and replaces
+        the snapshot of the settings used to send the notifications.
+        """
+        logging.debug(u"XmppSignals settings_saved_cb")
+        self.sender.reload_settings()
+
+    def shutdown(self):
+        """
+        Disconnects the signal handlers and closes the XMPP session.
+        """
+        self.unregister_signals()
+        self.sender.shutdown()
 
     def register_signals(self):
             review_request_published.connect(self.review_request_published_cb,
@@ -116,4 +134,26 @@ class XmppSignals(object):
             review_request_reopened.connect(self.review_request_reopened_cb,
                                           sender=ReviewRequest, dispatch_uid="rbxmppnotification")
             user_registered.connect(self.user_registered_cb, dispatch_uid="rbxmppnotification")
+            settings_saved.connect(self.settings_saved_cb, sender=self.extension,
+                                   dispatch_uid="rbxmppnotification")
+            recipient_cache.register_signals()
+            admin_cache.register_signals()
+            self.sender.batch.register_signals()
+            site_base_url.register_signals()
 
+    def unregister_signals(self):
+            review_request_published.disconnect(self.review_request_published_cb,
+                                                sender=ReviewRequest, dispatch_uid="rbxmppnotification")
+            review_published.disconnect(self.review_published_cb, sender=Review, dispatch_uid="rbxmppnotification")
+            reply_published.disconnect(self.reply_published_cb, sender=Review, dispatch_uid="rbxmppnotification")
+            review_request_closed.disconnect(self.review_request_closed_cb,
+                                             sender=ReviewRequest, dispatch_uid="rbxmppnotification")
+            review_request_reopened.disconnect(self.review_request_reopened_cb,
+                                               sender=ReviewRequest, dispatch_uid="rbxmppnotification")
+            user_registered.disconnect(self.user_registered_cb, dispatch_uid="rbxmppnotification")
+            settings_saved.disconnect(self.settings_saved_cb, sender=self.extension,
+                                      dispatch_uid="rbxmppnotification")
+            recipient_cache.unregister_signals()
+            admin_cache.unregister_signals()
+            self.sender.batch.unregister_signals()
+            site_base_url.unregister_signals()
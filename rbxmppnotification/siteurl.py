@@ -0,0 +1,79 @@
+#
+# siteurl.py -- Cached site base URL for the XMPP notifications.
+#
+# Copyright (c) 2013  Horatiu Eugen Vlad
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+import logging
+import sys
+
+from django.contrib.sites.models import Site
+from django.db.models.signals import post_save
+from djblets.siteconfig.models import SiteConfiguration
+
+
+class SiteBaseURL(object):
+    """
+    The site base URL, computed from the current ``Site`` domain and the
+    ``site_domain_method`` site configuration.
+
+    The URL is computed once and kept until the site or the site
+    configuration is saved again.
+    """
+    def __init__(self):
+        self.url = None
+
+    def get(self):
+        url = self.url
+        if url is None:
+            url = self.refresh()
+        return url
+
+    def refresh(self):
+        current_site = Site.objects.get_current()
+        siteconfig = current_site.config.get()
+        domain_method = siteconfig.get("site_domain_method")
+
+        url = u"%s://%s" % (domain_method, current_site.domain)
+        if sys.version_info[0] < 3:
+            url = url.decode("utf-8")
+        logging.debug(u"XMPP notification site base URL: %s", url)
+        self.url = url
+        return url
+
+    def site_saved_cb(self, sender, **kwargs):
+        """
+        Listens to the ``Site`` and ``SiteConfiguration`` saves and drops the
+        cached URL. It is computed again on first use.
+        """
+        self.url = None
+
+    def register_signals(self):
+        post_save.connect(self.site_saved_cb, sender=Site, dispatch_uid="rbxmppnotification")
+        post_save.connect(self.site_saved_cb, sender=SiteConfiguration, dispatch_uid="rbxmppnotification")
+
+    def unregister_signals(self):
+        post_save.disconnect(self.site_saved_cb, sender=Site, dispatch_uid="rbxmppnotification")
+        post_save.disconnect(self.site_saved_cb, sender=SiteConfiguration, dispatch_uid="rbxmppnotification")
+
+
+site_base_url = SiteBaseURL()
@@ -0,0 +1,102 @@
+#
+# snapshot.py -- Parsed snapshot of the extension settings.
+#
+# Copyright (c) 2013  Horatiu Eugen Vlad
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+import sys
+from collections import namedtuple
+
+from rbxmppnotification.transport import get_full_jid, get_jid_domain
+
+
+def decode(value):
+    if sys.version_info[0] < 3 and isinstance(value, bytes):
+        return value.decode("utf-8")
+    return value
+
+def parse_accounts(value):
+    """
+    Returns the ``(jid, password)`` tuples of the additional sender accounts
+    setting, one JID and password separated by a space per line.
+    """
+    accounts = []
+    for line in value.splitlines():
+        fields = line.split(None, 1)
+        if fields:
+            accounts.append((fields[0], fields[1].strip() if len(fields) > 1 else u""))
+    return accounts
+
+
+class XmppSettingsSnapshot(namedtuple('XmppSettingsSnapshot', [
+        'accounts', 'domain', 'connection', 'timeout', 'rooms', 'partychat_only',
+        'partychat_muc', 'muc_nickname', 'use_xhtml_im', 'coalesce_window',
+        'offline_policy', 'new_user_window', 'queue_size', 'queue_full_policy',
+        'cluster_spool', 'rate_per_jid', 'rate_burst', 'rate_global',
+        'rate_overflow'])):
+    """
+    The settings used to send the notifications, decoded and parsed once.
+
+    ``accounts`` are the ``(jid, password)`` of the sender accounts, the main
+    one first, and ``domain`` the domain of the main one. ``connection`` are
+    the backend and the connection arguments shared by the sessions.
+    ``rooms`` are the ``(room, jid)`` of the partychat rooms, as configured
+    and as JIDs.
+
+    Snapshots are immutable. A new one is built and swapped in whole when the
+    settings are saved, so a notification never sees half-updated settings.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_settings(cls, settings):
+        accounts = [(decode(settings["xmpp_sender_jid"]),
+                     decode(settings["xmpp_sender_password"]))]
+        accounts.extend(parse_accounts(decode(settings["xmpp_sender_accounts"])))
+        domain = get_jid_domain(accounts[0][0])
+        rooms = decode(settings["xmpp_partychat"]).split()
+        return cls(
+            accounts=tuple(accounts),
+            domain=domain,
+            connection=(settings['xmpp_backend'],
+                        settings['xmpp_host'],
+                        settings['xmpp_port'],
+                        settings['xmpp_timeout'],
+                        settings["xmpp_use_tls"],
+                        settings["xmpp_tls_verify_peer"]),
+            timeout=settings['xmpp_timeout'] or 5,
+            rooms=tuple((room, get_full_jid(room, domain)) for room in rooms),
+            partychat_only=settings["xmpp_partychat_only"],
+            partychat_muc=settings["xmpp_partychat_muc"],
+            muc_nickname=decode(settings["xmpp_muc_nickname"]) or u"ReviewBoard",
+            use_xhtml_im=settings['xmpp_use_xhtml_im'],
+            coalesce_window=settings['xmpp_coalesce_window'],
+            offline_policy=settings['xmpp_offline_policy'],
+            new_user_window=settings['xmpp_new_user_window'],
+            queue_size=settings['xmpp_queue_size'] or 0,
+            queue_full_policy=settings['xmpp_queue_full_policy'],
+            cluster_spool=settings['xmpp_cluster_spool'],
+            rate_per_jid=settings['xmpp_rate_per_jid'],
+            rate_burst=settings['xmpp_rate_burst'],
+            rate_global=settings['xmpp_rate_global'],
+            rate_overflow=settings['xmpp_rate_overflow'])
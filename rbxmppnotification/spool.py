@@ -0,0 +1,152 @@
+#
+# spool.py -- Notification spool shared by the Review Board processes.
+#
+# Copyright (c) 2013  Horatiu Eugen Vlad
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+import json
+import logging
+import os
+import socket
+import time
+from collections import deque
+
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import six
+
+from rbxmppnotification.dispatch import XmppNotification
+from rbxmppnotification.lanes import LANES, pick_weighted
+from rbxmppnotification.models import XmppLease, XmppSpoolEntry
+
+
+class XmppSpool(object):
+    """
+    A spool of notifications in the database, shared by all the processes
+    of a Review Board cluster, and the lease electing the process that
+    drains it.
+
+    Every process appends its notifications to the spool. Only the process
+    holding the dispatcher lease opens the XMPP sessions and delivers them,
+    so the server sees a single set of logins and the rate limits apply to
+    the whole cluster. The lease is renewed every ``LEASE_RENEW_INTERVAL``
+    seconds, also between the notifications of a batch, and taken over by
+    another process once it expires. The notifications are taken from the
+    spool with their rows locked, so two processes never take the same ones.
+    """
+    LEASE_NAME = "dispatcher"
+    LEASE_DURATION = 30
+    LEASE_RENEW_INTERVAL = 10
+
+    def __init__(self):
+        self.leader = False
+        self.renewed = 0
+
+    def get_owner(self):
+        # Computed on use, since the processes may be forked after the
+        # extension is loaded.
+        return u"%s:%d" % (socket.gethostname(), os.getpid())
+
+    def append(self, notifications):
+        now = time.time()
+        XmppSpoolEntry.objects.bulk_create([
+            XmppSpoolEntry(req_id=notification.req_id is not None
+                                  and six.text_type(notification.req_id) or u"",
+                           receivers=json.dumps([six.text_type(r) for r in notification.receivers]),
+                           message=notification.message,
+                           html=notification.html or u"",
+                           kind=notification.kind or u"",
+                           lane=notification.lane,
+                           created=notification.created,
+                           queued=now)
+            for notification in notifications])
+
+    def take(self, limit):
+        """
+        Removes up to ``limit`` of the oldest notifications from the spool and
+        returns them, picked from the priority lanes by weight.
+        """
+        with transaction.atomic():
+            entries = pick_weighted(
+                dict((lane, deque(XmppSpoolEntry.objects.select_for_update()
+                                                        .filter(lane=lane)
+                                                        .order_by('pk')[:limit]))
+                     for lane, weight in LANES),
+                limit)
+            if not entries:
+                return []
+            XmppSpoolEntry.objects.filter(pk__in=[entry.pk for entry in entries]).delete()
+        notifications = []
+        for entry in entries:
+            notification = XmppNotification(entry.req_id or None, json.loads(entry.receivers),
+                                            entry.message, entry.html or None,
+                                            entry.kind or None, entry.created, entry.lane)
+            notification.queued = entry.queued
+            notifications.append(notification)
+        return notifications
+
+    def is_leader(self):
+        """
+        Returns whether this process holds the dispatcher lease, acquiring or
+        renewing it when due.
+        """
+        now = time.time()
+        if now - self.renewed >= self.LEASE_RENEW_INTERVAL:
+            self.renewed = now
+            leader = self.acquire(now)
+            if leader != self.leader:
+                logging.info("XMPP dispatcher lease %s by %s",
+                             leader and "acquired" or "lost", self.get_owner())
+            self.leader = leader
+        return self.leader
+
+    def acquire(self, now):
+        owner = self.get_owner()
+        try:
+            if XmppLease.objects.filter(Q(owner=owner) | Q(expires__lt=now),
+                                        name=self.LEASE_NAME) \
+                                .update(owner=owner, expires=now + self.LEASE_DURATION):
+                return True
+            with transaction.atomic():
+                XmppLease.objects.create(name=self.LEASE_NAME, owner=owner,
+                                         expires=now + self.LEASE_DURATION)
+            return True
+        except IntegrityError:
+            return False
+        except Exception, e:
+            logging.error("Error acquiring the XMPP dispatcher lease: %s", e, exc_info=1)
+            return False
+
+    def release(self):
+        """
+        Gives the lease up, so another process takes over right away.
+        """
+        if not self.leader:
+            return
+        self.leader = False
+        self.renewed = 0
+        try:
+            XmppLease.objects.filter(name=self.LEASE_NAME, owner=self.get_owner()) \
+                             .update(expires=0)
+        except Exception, e:
+            logging.error("Error releasing the XMPP dispatcher lease: %s", e, exc_info=1)
@@ -0,0 +1,1404 @@
+#
+# tests.py -- Unit tests of the extension.
+#
+# Copyright (c) 2013  Horatiu Eugen Vlad
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+
+import datetime
+import os
+import shutil
+from collections import deque
+from contextlib import contextmanager
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.db import transaction
+from django.test import SimpleTestCase, TransactionTestCase
+from django.utils.timezone import utc
+from reviewboard.testing import TestCase
+
+from fakeserver import FakeXmppServer
+from rbxmppnotification.batch import XmppEventBatch
+from rbxmppnotification.coalesce import XmppCoalescer, XmppEvent, XmppRegistrations, \
+                                        XmppScheduler, EVENT_CLOSED, EVENT_DIGEST, \
+                                        EVENT_REVIEW, EVENT_REPLY, EVENT_NEW_USERS
+from rbxmppnotification.dispatch import XmppDispatcher, XmppNotification
+from rbxmppnotification.extension import RBXmppNotification
+from rbxmppnotification.forms import RBXmppNotificationSettingsForm
+from rbxmppnotification.lanes import XmppLanes, LANE_HIGH, LANE_NORMAL, LANE_LOW, \
+                                     pick_weighted
+from rbxmppnotification.metrics import RECIPIENT_CACHE, RECIPIENT_QUERIES
+from rbxmppnotification.messages import XmppMessageTemplates
+from rbxmppnotification.models import EVENT_FLAGS, EVENTS_ALL, XmppLease, \
+                                       XmppPreferences
+from rbxmppnotification.outbox import XmppOutbox
+from rbxmppnotification.presence import presence
+from rbxmppnotification.ratelimit import XmppRateLimiter
+from rbxmppnotification.siteurl import SiteBaseURL
+from rbxmppnotification.snapshot import XmppSettingsSnapshot
+from rbxmppnotification.spool import XmppSpool
+from rbxmppnotification.transport import BACKEND_ASYNCIO, BACKEND_PYXMPP2
+from rbxmppnotification.recipients import Recipient, get_users_review_request, \
+                                          get_users_review_requests, recipient_cache
+from rbxmppnotification.xmpp import XmppSender
+
+
+class TestExtensionSettings(dict):
+    def save(self):
+        pass
+
+
+class TestExtension(object):
+    """
+    Stands in for the extension, holding its settings.
+    """
+    def __init__(self, settings):
+        self.settings = TestExtensionSettings(settings)
+
+
+def get_test_settings(server=None, **settings):
+    """
+    Returns the defaults of the extension, the settings sending through the
+    fake ``server`` and the given ``settings``.
+    """
+    values = dict(RBXmppNotification.default_settings)
+    values.update({
+        'xmpp_host': u"127.0.0.1",
+        'xmpp_port': server and server.port or 5222,
+        'xmpp_timeout': 10,
+        'xmpp_sender_jid': u"rb@example.com/tests",
+        'xmpp_sender_password': server and server.password or u"",
+        'xmpp_use_tls': False,
+        'xmpp_tls_verify_peer': False,
+        'xmpp_partychat': u"",
+        'xmpp_partychat_only': False,
+    })
+    values.update(settings)
+    return values
+
+
+def create_sender(server, **settings):
+    """
+    Returns a sender whose settings are the defaults of the extension, sending
+    through the fake ``server``, and the given ``settings``.
+    """
+    return XmppSender(TestExtension(get_test_settings(server, **settings)))
+
+
+def get_snapshot(**settings):
+    """
+    Returns a function returning the snapshot of the defaults of the extension
+    and the given ``settings``, as ``XmppSender.get_settings`` does.
+    """
+    snapshot = XmppSettingsSnapshot.from_settings(get_test_settings(**settings))
+    return lambda: snapshot
+
+
+class RecipientQueryTests(TestCase):
+    """
+    Checks that the recipients are resolved with a constant number of
+    queries, whatever the number of target groups, stars, reviewers and
+    review requests.
+    """
+    fixtures = ['test_users']
+
+    def create_interested_review_request(self, groups):
+        """
+        Creates a public review request of doc targeting ``groups`` groups,
+        each with its own members, starred by one more user and reviewed by
+        another one. Returns the review request and the ids of the users
+        interested in it.
+        """
+        review_request = self.create_review_request(submitter='doc',
+                                                    publish=True)
+        interested = set([review_request.submitter_id])
+        for i in range(groups):
+            group = self.create_review_group(
+                name='group%d-%d' % (review_request.pk, i))
+            member = User.objects.create(
+                username='member%d-%d' % (review_request.pk, i))
+            group.users.add(member)
+            review_request.target_groups.add(group)
+            interested.add(member.pk)
+
+        grumpy = User.objects.get(username='grumpy')
+        grumpy.get_profile().starred_review_requests.add(review_request)
+        interested.add(grumpy.pk)
+
+        review = self.create_review(review_request, user='dopey')
+        interested.add(review.user_id)
+        return review_request, interested
+
+    @contextmanager
+    def assertQueries(self, num):
+        """
+        Checks that ``num`` queries are run and recorded in the metrics.
+        """
+        count, total = RECIPIENT_QUERIES.values.get((), ([], 0))
+        with self.assertNumQueries(num):
+            yield
+        self.assertEqual(RECIPIENT_QUERIES.values[()][1], total + num)
+
+    def test_review_request_queries(self):
+        """Testing the recipients of a review request take one query"""
+        for groups in (1, 2, 5):
+            review_request, interested = \
+                self.create_interested_review_request(groups)
+
+            with self.assertQueries(1):
+                users = get_users_review_request(review_request)
+
+            self.assertEqual(set(user.id for user in users), interested)
+
+    def test_review_request_queries_target_only(self):
+        """Testing the target reviewers are resolved with a second query"""
+        for groups in (1, 2, 5):
+            review_request, interested = \
+                self.create_interested_review_request(groups)
+            member = review_request.target_groups.all()[0].users.get()
+            XmppPreferences.objects.create(user=member, target_only=True)
+            XmppPreferences.objects.get_or_create(
+                user=User.objects.get(username='grumpy'),
+                defaults={'target_only': True})
+
+            with self.assertQueries(2):
+                users = dict((user.id, user)
+                             for user in get_users_review_request(review_request))
+
+            self.assertEqual(set(users), interested)
+            self.assertTrue(users[member.pk].target)
+            self.assertFalse(users[User.objects.get(username='grumpy').pk].target)
+
+    def test_review_requests_queries(self):
+        """Testing the recipients of many review requests take six queries"""
+        for count in (1, 3):
+            review_requests = []
+            expected = {}
+            for groups in range(1, count + 1):
+                review_request, interested = \
+                    self.create_interested_review_request(groups)
+                review_requests.append(review_request)
+                expected[review_request.pk] = interested
+
+            with self.assertQueries(6):
+                users = get_users_review_requests(review_requests)
+
+            self.assertEqual(dict((pk, set(user.id for user in recipients))
+                                  for pk, recipients in users.items()),
+                             expected)
+
+
+class RecipientCacheTests(TestCase):
+    """
+    Checks that the cached recipients are reused until a change of the
+    interested users invalidates them.
+    """
+    fixtures = ['test_users']
+
+    def setUp(self):
+        super(RecipientCacheTests, self).setUp()
+        cache.clear()
+        recipient_cache.register_signals()
+        self.review_request = self.create_review_request(submitter='doc', publish=True)
+
+    def tearDown(self):
+        recipient_cache.unregister_signals()
+        super(RecipientCacheTests, self).tearDown()
+
+    def get_recipients(self, result):
+        """
+        Returns the ids of the recipients of the review request, checking
+        that they were cached or not according to ``result``.
+        """
+        lookups = RECIPIENT_CACHE.values.get((result,), 0)
+        users = recipient_cache.get_recipients(self.review_request)
+        self.assertEqual(RECIPIENT_CACHE.values[(result,)], lookups + 1)
+        return set(user.id for user in users)
+
+    def test_review_deleted(self):
+        """Testing the recipients are resolved again when a review is deleted"""
+        dopey = User.objects.get(username='dopey')
+        self.assertEqual(self.get_recipients("miss"), set([self.review_request.submitter_id]))
+        self.assertEqual(self.get_recipients("hit"), set([self.review_request.submitter_id]))
+
+        review = self.create_review(self.review_request, user=dopey)
+        self.assertEqual(self.get_recipients("miss"),
+                         set([self.review_request.submitter_id, dopey.pk]))
+        self.assertEqual(self.get_recipients("hit"),
+                         set([self.review_request.submitter_id, dopey.pk]))
+
+        review.delete()
+        self.assertEqual(self.get_recipients("miss"), set([self.review_request.submitter_id]))
+
+    def test_version_evicted(self):
+        """Testing an evicted version counter does not revive old entries"""
+        self.get_recipients("miss")
+        self.get_recipients("hit")
+
+        cache.delete(recipient_cache.get_version_key(self.review_request.pk))
+        self.get_recipients("miss")
+        self.get_recipients("hit")
+
+
+class SiteBaseURLTests(TestCase):
+    """
+    Checks that the site base URL is computed once and again only after the
+    site or the site configuration is saved.
+    """
+    def setUp(self):
+        super(SiteBaseURLTests, self).setUp()
+        self.site_base_url = SiteBaseURL()
+        self.site_base_url.register_signals()
+
+    def tearDown(self):
+        self.site_base_url.unregister_signals()
+        super(SiteBaseURLTests, self).tearDown()
+
+    def get_url(self):
+        url = self.site_base_url.get()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.site_base_url.get(), url)
+        return url
+
+    def test_site_saved(self):
+        """Testing the site base URL is computed again when the site is saved"""
+        self.get_url()
+        site = Site.objects.get_current()
+        site.domain = u"reviews.example.com"
+        site.save()
+
+        self.assertEqual(self.get_url(), u"http://reviews.example.com")
+
+    def test_siteconfig_saved(self):
+        """Testing the site base URL is computed again when the site configuration is saved"""
+        self.assertTrue(self.get_url().startswith(u"http://"))
+        siteconfig = Site.objects.get_current().config.get()
+        siteconfig.set("site_domain_method", "https")
+        siteconfig.save()
+
+        self.assertTrue(self.get_url().startswith(u"https://"))
+
+
+class PreferencesTests(TestCase):
+    """
+    Checks that the notifications follow the preferences of the users: the
+    event types, the target reviewers only, the quiet hours and the JID.
+    """
+    fixtures = ['test_users']
+
+    # 2013-06-01 21:30 UTC, 23:30 in Paris.
+    NOW = datetime.datetime(2013, 6, 1, 21, 30, tzinfo=utc)
+
+    def make_recipient(self, events=EVENTS_ALL, target_only=False, target=False,
+                       quiet_start=None, quiet_end=None, tz=None):
+        return Recipient(1, u"doc", events, target_only, target,
+                         quiet_start, quiet_end, tz)
+
+    def test_events(self):
+        """Testing only the chosen event types are notified"""
+        recipient = self.make_recipient(
+            events=EVENT_FLAGS[EVENT_REVIEW] | EVENT_FLAGS[EVENT_NEW_USERS])
+
+        self.assertTrue(recipient.wants(EVENT_REVIEW, self.NOW))
+        self.assertTrue(recipient.wants(EVENT_NEW_USERS, self.NOW))
+        self.assertFalse(recipient.wants(EVENT_REPLY, self.NOW))
+        self.assertFalse(recipient.wants(EVENT_CLOSED, self.NOW))
+        self.assertFalse(self.make_recipient(events=EVENT_FLAGS[EVENT_REVIEW])
+                             .wants(EVENT_NEW_USERS, self.NOW))
+
+    def test_target_only(self):
+        """Testing the target reviewers only preference"""
+        self.assertTrue(self.make_recipient(target_only=True, target=True)
+                            .wants(EVENT_REVIEW, self.NOW))
+        self.assertFalse(self.make_recipient(target_only=True)
+                             .wants(EVENT_REVIEW, self.NOW))
+        self.assertTrue(self.make_recipient(target_only=True)
+                            .wants(EVENT_NEW_USERS, self.NOW))
+
+    def test_quiet_hours(self):
+        """Testing no notification is sent during the quiet hours"""
+        quiet = self.make_recipient(quiet_start=datetime.time(21),
+                                    quiet_end=datetime.time(22))
+        self.assertFalse(quiet.wants(EVENT_REVIEW, self.NOW))
+        self.assertTrue(quiet._replace(timezone='Europe/Paris').wants(EVENT_REVIEW, self.NOW))
+        self.assertTrue(quiet._replace(quiet_end=datetime.time(21, 30))
+                             .wants(EVENT_REVIEW, self.NOW))
+
+    def test_quiet_hours_midnight(self):
+        """Testing the quiet hours spanning midnight"""
+        quiet = self.make_recipient(quiet_start=datetime.time(23),
+                                    quiet_end=datetime.time(7), tz='Europe/Paris')
+        self.assertFalse(quiet.wants(EVENT_REVIEW, self.NOW))
+        self.assertFalse(quiet.wants(EVENT_REVIEW, self.NOW + datetime.timedelta(hours=4)))
+        self.assertTrue(quiet.wants(EVENT_REVIEW, self.NOW + datetime.timedelta(hours=8)))
+        self.assertTrue(quiet.wants(EVENT_REVIEW, self.NOW - datetime.timedelta(hours=1)))
+
+    def test_jid(self):
+        """Testing the JID of the preferences replaces the username"""
+        review_request = self.create_review_request(submitter='doc', publish=True)
+        dopey = User.objects.get(username='dopey')
+        self.create_review(review_request, user=dopey)
+        XmppPreferences.objects.create(user=dopey, jid=u"dopey@jabber.example.com")
+
+        self.assertEqual(set(user.jid for user in get_users_review_request(review_request)),
+                         set([u"doc", u"dopey@jabber.example.com"]))
+
+
+@unittest.skipIf(hasattr(transaction, 'on_commit'), "Django has commit hooks")
+class RequestBatchTests(SimpleTestCase):
+    """
+    Checks that the events raised during a request are sent together at the
+    end of the request, and discarded when the request fails.
+    """
+    def setUp(self):
+        self.sent = []
+        self.batch = XmppEventBatch(self.sent.append)
+
+    def test_request(self):
+        """Testing the events of a request are sent once at its end"""
+        self.batch.request_started_cb(None)
+        self.batch.add(u"review")
+        self.batch.add(u"reply")
+        self.assertEqual(self.sent, [])
+
+        self.batch.request_finished_cb(None)
+        self.assertEqual(self.sent, [[u"review", u"reply"]])
+
+    def test_request_exception(self):
+        """Testing the events of a failed request are discarded"""
+        self.batch.request_started_cb(None)
+        self.batch.add(u"review")
+        self.batch.request_exception_cb(None)
+        self.batch.request_finished_cb(None)
+
+        self.assertEqual(self.sent, [])
+
+    def test_outside_request(self):
+        """Testing the events outside of a request are sent right away"""
+        self.batch.add(u"review")
+        self.assertEqual(self.sent, [[u"review"]])
+
+
+@unittest.skipUnless(hasattr(transaction, 'on_commit'), "Django has no commit hooks")
+class CommitBatchTests(TransactionTestCase):
+    """
+    Checks that the events raised in a transaction are sent together when it
+    commits, and discarded when it rolls back.
+    """
+    def setUp(self):
+        self.sent = []
+        self.batch = XmppEventBatch(self.sent.append)
+
+    def test_commit(self):
+        """Testing the events of a transaction are sent once on commit"""
+        with transaction.atomic():
+            self.batch.add(u"review")
+            self.batch.add(u"reply")
+            self.assertEqual(self.sent, [])
+
+        self.assertEqual(self.sent, [[u"review", u"reply"]])
+
+    def test_rollback(self):
+        """Testing the events of a rolled back transaction are discarded"""
+        try:
+            with transaction.atomic():
+                self.batch.add(u"review")
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(self.sent, [])
+
+        with transaction.atomic():
+            self.batch.add(u"reply")
+        self.assertEqual(self.sent, [[u"reply"]])
+
+    def test_savepoint_rollback(self):
+        """Testing the events of a rolled back savepoint are discarded"""
+        with transaction.atomic():
+            self.batch.add(u"review")
+            try:
+                with transaction.atomic():
+                    self.batch.add(u"reply")
+                    raise ValueError
+            except ValueError:
+                pass
+            self.batch.add(u"closed")
+
+        self.assertEqual(self.sent, [[u"review", u"closed"]])
+
+    def test_outside_transaction(self):
+        """Testing the events outside of a transaction are sent right away"""
+        self.batch.add(u"review")
+        self.assertEqual(self.sent, [[u"review"]])
+
+
+class CoalescerTests(SimpleTestCase):
+    """
+    Checks that the coalescing windows are closed by the single thread of
+    the scheduler.
+    """
+    def setUp(self):
+        self.sent = []
+        self.scheduler = XmppScheduler()
+        self.coalescer = XmppCoalescer(self.send, self.scheduler)
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def send(self, receivers, req_id, message, html, kind, created):
+        self.sent.append((req_id, tuple(sorted(receivers)), kind))
+
+    def make_event(self, kind, req_id):
+        return XmppEvent(kind, req_id, u"Summary", u"http://example.com/r/%d/" % req_id,
+                         u"Message", None, time.time())
+
+    def test_windows_share_one_thread(self):
+        """Testing the coalescing windows are closed by one thread"""
+        threads = threading.active_count()
+        for req_id in range(1, 51):
+            self.coalescer.add(self.make_event(EVENT_REVIEW, req_id), [u"doc"], 0.2)
+            self.coalescer.add(self.make_event(EVENT_REPLY, req_id), [u"doc", u"grumpy"], 0.2)
+        self.assertEqual(threading.active_count(), threads + 1)
+
+        time.sleep(0.1)
+        self.assertEqual(self.sent, [])
+        deadline = time.time() + 5
+        while len(self.sent) < 100 and time.time() < deadline:
+            time.sleep(0.05)
+
+        self.assertEqual(sorted(self.sent),
+                         sorted([(req_id, (u"doc",), EVENT_DIGEST)
+                                 for req_id in range(1, 51)] +
+                                [(req_id, (u"grumpy",), EVENT_REPLY)
+                                 for req_id in range(1, 51)]))
+
+    def test_flush_all(self):
+        """Testing the pending windows are flushed on shutdown"""
+        self.coalescer.add(self.make_event(EVENT_REVIEW, 1), [u"doc"], 60)
+        self.coalescer.add(self.make_event(EVENT_REVIEW, 2), [u"doc"], 30)
+        self.coalescer.flush_all()
+
+        self.assertEqual(sorted(self.sent),
+                         [(1, (u"doc",), EVENT_REVIEW),
+                          (2, (u"doc",), EVENT_REVIEW)])
+
+
+class DispatcherTests(SimpleTestCase):
+    """
+    Checks that the notifications are delivered on the worker thread, that a
+    full queue drops or blocks according to the policy, and that the queue
+    is flushed on shutdown.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='rbxmppnotification-tests-')
+        self.delivered = []
+        self.delivering = threading.Event()
+        self.gate = threading.Event()
+        self.dispatcher = None
+
+    def tearDown(self):
+        self.gate.set()
+        if self.dispatcher is not None:
+            self.dispatcher.stop(5)
+        shutil.rmtree(self.directory)
+
+    def deliver(self, notification):
+        self.delivering.set()
+        self.gate.wait(5)
+        self.delivered.append((notification.req_id, threading.current_thread().name))
+        return True
+
+    def create_dispatcher(self, **settings):
+        self.dispatcher = XmppDispatcher(
+            get_snapshot(**settings), self.deliver,
+            XmppOutbox(os.path.join(self.directory, 'outbox.db')))
+        return self.dispatcher
+
+    def test_enqueue(self):
+        """Testing the notifications are delivered on the worker thread"""
+        dispatcher = self.create_dispatcher()
+        self.assertTrue(dispatcher.enqueue(XmppNotification(1, [u"doc"], u"Review")))
+        self.assertTrue(self.delivering.wait(5))
+        self.assertEqual(self.delivered, [])
+
+        self.gate.set()
+        dispatcher.stop(5)
+        self.assertEqual(self.delivered, [(1, "rbxmppnotification-dispatch")])
+
+    def test_stop_flushes(self):
+        """Testing the queued notifications are delivered on shutdown"""
+        dispatcher = self.create_dispatcher()
+        self.gate.set()
+        for i in range(1, 21):
+            dispatcher.enqueue(XmppNotification(i, [u"doc"], u"Review"))
+        dispatcher.stop(5)
+
+        self.assertEqual([req_id for req_id, thread in self.delivered], list(range(1, 21)))
+        self.assertEqual(dispatcher.thread, None)
+
+    def test_queue_full_drop(self):
+        """Testing the notifications are dropped when the queue is full"""
+        dispatcher = self.create_dispatcher(xmpp_queue_size=1)
+        self.assertTrue(dispatcher.enqueue(XmppNotification(1, [u"doc"], u"Review")))
+        self.assertTrue(self.delivering.wait(5))
+
+        self.assertTrue(dispatcher.enqueue(XmppNotification(2, [u"doc"], u"Review")))
+        self.assertFalse(dispatcher.enqueue(XmppNotification(3, [u"doc"], u"Review")))
+        self.gate.set()
+        dispatcher.stop(5)
+        self.assertEqual([req_id for req_id, thread in self.delivered], [1, 2])
+
+    def test_queue_full_block(self):
+        """Testing the block policy waits for a free slot up to the timeout"""
+        dispatcher = self.create_dispatcher(xmpp_queue_size=1, xmpp_queue_full_policy='block',
+                                            xmpp_timeout=1)
+        dispatcher.enqueue(XmppNotification(1, [u"doc"], u"Review"))
+        self.assertTrue(self.delivering.wait(5))
+        dispatcher.enqueue(XmppNotification(2, [u"doc"], u"Review"))
+
+        start = time.time()
+        self.assertFalse(dispatcher.enqueue(XmppNotification(3, [u"doc"], u"Review")))
+        self.assertTrue(time.time() - start >= 0.9)
+
+        threading.Timer(0.2, self.gate.set).start()
+        self.assertTrue(dispatcher.enqueue(XmppNotification(4, [u"doc"], u"Review")))
+        dispatcher.stop(5)
+        self.assertEqual([req_id for req_id, thread in self.delivered], [1, 2, 4])
+
+
+class MessageTemplateTests(TestCase):
+    """
+    Checks that the messages are rendered from the templates compiled once,
+    as plain text and escaped XHTML-IM.
+    """
+    fixtures = ['test_users']
+
+    def setUp(self):
+        super(MessageTemplateTests, self).setUp()
+        self.templates = XmppMessageTemplates()
+        self.review_request = self.create_review_request(
+            submitter='doc', summary=u"Fix <b> & \"quotes\"", publish=True)
+        self.context = {
+            'user': User.objects.get(username='doc'),
+            'review_request': self.review_request,
+            'review_request_url': u"http://example.com/r/1/",
+        }
+
+    def test_render(self):
+        """Testing the plain text and XHTML-IM messages are rendered"""
+        message, html = self.templates.render(EVENT_REVIEW, self.context, True)
+
+        self.assertEqual(message,
+                         u"Doc Dwarf reviewed request #%s: \"Fix <b> & \"quotes\"\"\n"
+                         u"http://example.com/r/1/" % self.review_request.display_id)
+        self.assertIn(u"&quot;Fix &lt;b&gt; &amp; &quot;quotes&quot;&quot;", html)
+        self.assertIn(u'<a href="http://example.com/r/1/">', html)
+
+    def test_render_without_xhtml(self):
+        """Testing no XHTML-IM message is rendered unless enabled"""
+        message, html = self.templates.render(EVENT_REVIEW, self.context)
+        self.assertEqual(html, None)
+
+    def test_compiled_once(self):
+        """Testing the templates are compiled once and reused"""
+        self.templates.render(EVENT_REVIEW, self.context)
+        compiled = self.templates.templates
+        self.templates.render(EVENT_REPLY, self.context, True)
+
+        self.assertTrue(self.templates.templates is compiled)
+
+
+class NewUsersTests(TestCase):
+    """
+    Checks that the users registered within the window are notified to the
+    administrators in a single message, which the new users themselves and
+    the administrators not wanting it do not get.
+    """
+    fixtures = ['test_users']
+
+    def setUp(self):
+        super(NewUsersTests, self).setUp()
+        self.sent = []
+        self.scheduler = XmppScheduler()
+
+    def tearDown(self):
+        self.scheduler.stop()
+        super(NewUsersTests, self).tearDown()
+
+    def send(self, users, admins):
+        self.sent.append((users, admins))
+
+    def send_xmpp_message(self, receivers, req_id, message, html=None, kind=None):
+        self.sent.append((receivers, message, kind))
+
+    def make_admin(self, username, events=EVENTS_ALL):
+        return Recipient(User.objects.get(username=username).pk, username, events,
+                         False, False, None, None, None)
+
+    def test_window(self):
+        """Testing the users registered within the window are sent together"""
+        registrations = XmppRegistrations(self.send, self.scheduler)
+        registrations.add(u"grumpy", [u"admin"], 0.2)
+        registrations.add(u"dopey", [u"admin", u"doc"], 0.2)
+        self.assertEqual(self.sent, [])
+
+        deadline = time.time() + 5
+        while not self.sent and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.sent, [([u"grumpy", u"dopey"], [u"admin", u"doc"])])
+
+    def test_no_window(self):
+        """Testing the users are sent right away without a window"""
+        registrations = XmppRegistrations(self.send, self.scheduler)
+        registrations.add(u"grumpy", [u"admin"], 0)
+        self.assertEqual(self.sent, [([u"grumpy"], [u"admin"])])
+
+    def test_send_new_users(self):
+        """Testing the new users are sent to the administrators wanting them"""
+        sender = create_sender(None)
+        sender.send_xmpp_message = self.send_xmpp_message
+        sender.NEW_USERS_LISTED = 1
+        users = list(User.objects.filter(username__in=['grumpy', 'dopey'])
+                                 .order_by('username'))
+        sender.send_new_users(users, [self.make_admin('admin'),
+                                      self.make_admin('grumpy'),
+                                      self.make_admin('doc', EVENT_FLAGS[EVENT_REVIEW])])
+
+        (receivers, message, kind), = self.sent
+        self.assertEqual((receivers, kind), (set([u"admin"]), EVENT_NEW_USERS))
+        self.assertTrue(message.startswith(
+            u"2 new users registered on Review Board: dopey and 1 more\n"), message)
+
+    def test_send_new_users_none(self):
+        """Testing no message is sent when no administrator wants it"""
+        sender = create_sender(None)
+        sender.send_xmpp_message = self.send_xmpp_message
+        sender.send_new_users([User.objects.get(username='grumpy')],
+                              [self.make_admin('grumpy')])
+        self.assertEqual(self.sent, [])
+
+
+class OutboxTests(SimpleTestCase):
+    """
+    Checks that the outbox replays the notifications that were not
+    delivered, once their retry delay or in-flight timeout expires, and that
+    a due notification is claimed by a single process.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='rbxmppnotification-tests-')
+        self.outbox = self.open_outbox()
+
+    def tearDown(self):
+        self.outbox.close()
+        shutil.rmtree(self.directory)
+
+    def open_outbox(self):
+        outbox = XmppOutbox(os.path.join(self.directory, 'outbox.db'))
+        outbox.open()
+        return outbox
+
+    def test_replay(self):
+        """Testing the notifications are replayed as they were recorded"""
+        self.outbox.record([XmppNotification(12, [u"doc"], u"Review", u"<p>Review</p>",
+                                             EVENT_REVIEW, 1000),
+                            XmppNotification(None, [u"grumpy", u"dopey"], u"Users",
+                                             kind=EVENT_NEW_USERS, created=2000,
+                                             lane=LANE_HIGH)], 0)
+
+        review, users = self.outbox.get_due(10)
+        self.assertEqual((review.req_id, review.receivers, review.message, review.html,
+                          review.kind, review.lane, review.created),
+                         (u"12", [u"doc"], u"Review", u"<p>Review</p>",
+                          EVENT_REVIEW, LANE_HIGH, 1000))
+        self.assertEqual((users.req_id, users.receivers, users.kind, users.lane),
+                         (None, [u"grumpy", u"dopey"], EVENT_NEW_USERS, LANE_HIGH))
+
+    def test_in_flight(self):
+        """Testing the notifications in flight are replayed after a timeout"""
+        notification = XmppNotification(1, [u"doc"], u"Message")
+        self.outbox.record([notification])
+        self.assertEqual(self.outbox.get_due(10), [])
+
+        # The process delivering it died before marking it delivered.
+        self.outbox.IN_FLIGHT_TIMEOUT = 0
+        self.outbox.record([XmppNotification(2, [u"doc"], u"Message")])
+        self.outbox.mark_delivered([notification])
+        self.assertEqual([n.req_id for n in self.outbox.get_due(10)], [u"2"])
+
+    def test_retry(self):
+        """Testing the failed notifications are retried with a backoff"""
+        notification = XmppNotification(1, [u"doc", u"grumpy"], u"Message")
+        self.outbox.record([notification])
+        notification.receivers = [u"grumpy"]
+        self.outbox.mark_failed([notification])
+        self.assertEqual(self.outbox.get_due(10), [])
+
+        self.outbox.RETRY_MIN_DELAY = 0
+        self.outbox.mark_failed([notification])
+        retried, = self.outbox.get_due(10)
+        self.assertEqual((retried.id, retried.receivers, retried.attempts),
+                         (notification.id, [u"grumpy"], 2))
+
+        self.outbox.mark_delivered([retried])
+        self.outbox.IN_FLIGHT_TIMEOUT = 0
+        self.assertEqual(self.outbox.get_due(10), [])
+
+    def test_claim(self):
+        """Testing a due notification is claimed by a single outbox"""
+        other = self.open_outbox()
+        try:
+            self.outbox.record([XmppNotification(i, [u"doc"], u"Message")
+                                for i in range(5)], 0)
+
+            claimed = self.outbox.get_due(3)
+            self.assertEqual([n.req_id for n in claimed], [u"0", u"1", u"2"])
+            self.assertEqual([n.req_id for n in other.get_due(10)], [u"3", u"4"])
+            self.assertEqual(self.outbox.get_due(10), [])
+        finally:
+            other.close()
+
+
+class TestClock(object):
+    """
+    A clock only moved forward by the tests.
+    """
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class RateLimiterTests(SimpleTestCase):
+    """
+    Checks the per recipient and global limits against a test clock, and
+    that the dispatcher postpones the notifications over the global limit
+    instead of waiting for it.
+    """
+    def setUp(self):
+        self.clock = TestClock()
+        self.limiter = XmppRateLimiter(self.clock)
+
+    def test_per_jid(self):
+        """Testing the messages per recipient are limited after a burst"""
+        self.limiter.configure(60, 2, 0)
+        self.assertEqual(self.limiter.admit([u"doc", u"grumpy"]), ([u"doc", u"grumpy"], [], 0))
+        self.assertEqual(self.limiter.admit([u"doc"]), ([u"doc"], [], 0))
+        self.assertEqual(self.limiter.admit([u"doc", u"grumpy"]), ([u"grumpy"], [u"doc"], 1))
+
+        self.clock.now += 1
+        self.assertEqual(self.limiter.admit([u"doc"]), ([u"doc"], [], 0))
+
+    def test_summaries(self):
+        """Testing the suppressed messages are summarized once allowed again"""
+        self.limiter.configure(60, 1, 0)
+        self.limiter.admit([u"doc"])
+        allowed, limited, delay = self.limiter.admit([u"doc"])
+        self.limiter.suppress(limited)
+        self.limiter.suppress(limited)
+        self.assertEqual(self.limiter.pop_summaries(), [])
+
+        self.clock.now += delay
+        self.assertEqual(self.limiter.pop_summaries(), [(u"doc", 2)])
+        self.assertEqual(self.limiter.pop_summaries(), [])
+
+    def test_global(self):
+        """Testing the global limit returns the delay instead of waiting"""
+        self.limiter.configure(0, 0, 10)
+        self.assertEqual(self.limiter.reserve(5), 0)
+        self.assertEqual(self.limiter.reserve(5), 0)
+        self.assertAlmostEqual(self.limiter.reserve(1), 0.1)
+
+        self.clock.now += 0.1
+        self.assertEqual(self.limiter.reserve(1), 0)
+
+        # A message to more receivers than the burst waits for a full bucket.
+        self.clock.now += 0.1
+        self.assertAlmostEqual(self.limiter.reserve(25), 0.9)
+        self.clock.now += 0.9
+        self.assertEqual(self.limiter.reserve(25), 0)
+        self.assertAlmostEqual(self.limiter.reserve(1), 1.6)
+
+    def test_dispatcher_postpones(self):
+        """Testing the dispatcher postpones the notifications over the global limit"""
+        directory = tempfile.mkdtemp(prefix='rbxmppnotification-tests-')
+        outbox = XmppOutbox(os.path.join(directory, 'outbox.db'))
+        outbox.open()
+        delivered = []
+        dispatcher = XmppDispatcher(get_snapshot(
+            xmpp_rate_per_jid=0,
+            xmpp_rate_burst=1,
+            xmpp_rate_global=2,
+            xmpp_rate_overflow='delay',
+        ), lambda notification: delivered.append(notification.req_id) or True, outbox)
+        dispatcher.limiter = self.limiter
+        try:
+            notifications = [XmppNotification(i, [u"doc"], u"Message") for i in range(4)]
+            dispatcher.journal(notifications)
+            start = time.time()
+            dispatcher.deliver_batch(notifications)
+
+            self.assertTrue(time.time() - start < 0.5)
+            self.assertEqual(delivered, [0, 1])
+            self.assertEqual(outbox.get_due(10), [])
+            self.assertTrue(start < dispatcher.wakeup <= time.time() + 0.5)
+        finally:
+            outbox.close()
+            shutil.rmtree(directory)
+
+
+class TestSpool(XmppSpool):
+    def __init__(self, owner):
+        super(TestSpool, self).__init__()
+        self.owner = owner
+
+    def get_owner(self):
+        return self.owner
+
+
+class SpoolTests(TestCase):
+    """
+    Checks that a single process holds the dispatcher lease until it expires,
+    that the spooled notifications are taken once, and that the rest of a
+    batch is handed over when the lease is lost.
+    """
+    def setUp(self):
+        super(SpoolTests, self).setUp()
+        self.spool = TestSpool(u"host:1")
+        self.other = TestSpool(u"host:2")
+
+    def renew(self, spool):
+        spool.renewed = 0
+        return spool.is_leader()
+
+    def test_acquire(self):
+        """Testing the lease is held by a single process"""
+        self.assertTrue(self.renew(self.spool))
+        self.assertFalse(self.renew(self.other))
+        self.assertTrue(self.renew(self.spool))
+
+    def test_expire(self):
+        """Testing an expired lease is taken over"""
+        self.assertTrue(self.renew(self.spool))
+        XmppLease.objects.update(expires=time.time() - 1)
+
+        self.assertTrue(self.renew(self.other))
+        self.assertFalse(self.renew(self.spool))
+
+    def test_release(self):
+        """Testing a released lease is taken over right away"""
+        self.assertTrue(self.renew(self.spool))
+        self.spool.release()
+
+        self.assertTrue(self.renew(self.other))
+
+    def test_take(self):
+        """Testing the spooled notifications are taken once, by weight"""
+        self.spool.append([XmppNotification(i, [u"doc"], u"Closed", kind=EVENT_CLOSED)
+                           for i in range(3)] +
+                          [XmppNotification(i, [u"doc"], u"Review", kind=EVENT_REVIEW)
+                           for i in range(3, 5)])
+
+        self.assertEqual([(n.req_id, n.lane) for n in self.spool.take(3)],
+                         [(u"3", LANE_HIGH), (u"4", LANE_HIGH), (u"0", LANE_LOW)])
+        self.assertEqual([n.req_id for n in self.other.take(10)], [u"1", u"2"])
+        self.assertEqual(self.spool.take(10), [])
+
+    def test_lease_lost(self):
+        """Testing the rest of the batch is spooled when the lease is lost"""
+        directory = tempfile.mkdtemp(prefix='rbxmppnotification-tests-')
+        outbox = XmppOutbox(os.path.join(directory, 'outbox.db'))
+        outbox.open()
+        delivered = []
+
+        def deliver(notification):
+            delivered.append(notification.req_id)
+            XmppLease.objects.update(expires=time.time() - 1)
+            self.renew(self.other)
+            self.spool.renewed = 0
+            return True
+
+        self.assertTrue(self.renew(self.spool))
+        dispatcher = XmppDispatcher(get_snapshot(xmpp_cluster_spool=True), deliver,
+                                    outbox, self.spool)
+        try:
+            notifications = [XmppNotification(i, [u"doc"], u"Message") for i in range(3)]
+            dispatcher.journal(notifications)
+            dispatcher.deliver_batch(notifications)
+
+            self.assertEqual(delivered, [0])
+            self.assertEqual([n.req_id for n in self.other.take(10)], [u"1", u"2"])
+            self.assertEqual(outbox.db.execute(
+                "SELECT COUNT(*) FROM notification WHERE delivered = 0").fetchone()[0], 0)
+        finally:
+            outbox.close()
+            shutil.rmtree(directory)
+
+
+class LaneTests(SimpleTestCase):
+    """
+    Checks that the notifications are picked from the priority lanes by
+    weight, and that a high priority notification queued during the
+    delivery of a batch is sent before the rest of the batch.
+    """
+    def make_lanes(self, **counts):
+        return dict((lane, deque(u"%s%d" % (lane, i) for i in range(count)))
+                    for lane, count in counts.items())
+
+    def test_pick_weighted(self):
+        """Testing the lanes are picked by weight in priority order"""
+        lanes = self.make_lanes(high=20, normal=20, low=20)
+        self.assertEqual(pick_weighted(lanes, 12),
+                         [u"high%d" % i for i in range(8)] +
+                         [u"normal%d" % i for i in range(3)] + [u"low0"])
+        self.assertEqual(pick_weighted(lanes, 3), [u"high8", u"high9", u"high10"])
+        self.assertEqual([len(lanes[lane]) for lane in (LANE_HIGH, LANE_NORMAL, LANE_LOW)],
+                         [9, 17, 19])
+
+    def test_pick_weighted_empty_lanes(self):
+        """Testing the empty lanes leave their share to the others"""
+        lanes = self.make_lanes(normal=10, low=2)
+        self.assertEqual(pick_weighted(lanes, 9),
+                         [u"normal0", u"normal1", u"normal2", u"low0",
+                          u"normal3", u"normal4", u"normal5", u"low1", u"normal6"])
+        self.assertEqual(pick_weighted(lanes, 9), [u"normal7", u"normal8", u"normal9"])
+        self.assertEqual(pick_weighted(lanes, 9), [])
+
+    def test_lane_size(self):
+        """Testing a full lane does not take the place of the others"""
+        lanes = XmppLanes()
+        lanes.maxsize = 2
+        for i in range(2):
+            lanes.put(XmppNotification(i, [u"doc"], u"Closed", kind=EVENT_CLOSED), False)
+        self.assertRaises(queue.Full, lanes.put,
+                          XmppNotification(2, [u"doc"], u"Closed", kind=EVENT_CLOSED), False)
+        lanes.put(XmppNotification(3, [u"doc"], u"Review", kind=EVENT_REVIEW), False)
+
+        batch, running = lanes.get(10, 0)
+        self.assertEqual([n.req_id for n in batch], [3, 0, 1])
+        self.assertTrue(running)
+
+    def test_preemption(self):
+        """Testing a high priority notification is sent before the rest of the batch"""
+        delivered = []
+
+        def deliver(notification):
+            delivered.append(notification.req_id)
+            if notification.req_id == 0:
+                dispatcher.queue.put(XmppNotification(10, [u"doc"], u"Review",
+                                                      kind=EVENT_REVIEW))
+            return True
+
+        dispatcher = XmppDispatcher(get_snapshot(
+            xmpp_rate_per_jid=0,
+            xmpp_rate_burst=1,
+            xmpp_rate_global=0,
+        ), deliver, None)
+        dispatcher.deliver_batch([XmppNotification(i, [u"doc"], u"Closed", kind=EVENT_CLOSED)
+                                  for i in range(3)])
+
+        self.assertEqual(delivered, [0, 10, 1, 2])
+
+
+def create_client(backend, server, timeout):
+    """
+    Returns a client of the ``backend`` connecting to the fake ``server``.
+    """
+    if backend == BACKEND_ASYNCIO:
+        from rbxmppnotification.asyncxmpp import AsyncXmppClient as client_class
+    else:
+        from rbxmppnotification.pyxmpp2client import XmppClient as client_class
+    return client_class("127.0.0.1", server.port, timeout, u"rb@example.com/tests",
+                        server.password, False, False)
+
+
+class MulticastTests(SimpleTestCase):
+    """
+    Checks that both backends send the messages through the XEP-0033
+    multicast service of the fake XMPP server when it has one, as blind
+    copies in batches, and one stanza per receiver otherwise.
+    """
+    PASSWORD = "tests"
+    TIMEOUT = 10
+
+    def tearDown(self):
+        self.client.stop()
+        self.server.stop()
+
+    def start(self, backend, multicast):
+        """
+        Starts the fake server and a connected client of the ``backend``,
+        which discovered the multicast service when there is one.
+        """
+        self.server = FakeXmppServer(self.PASSWORD, multicast=multicast)
+        self.server.start()
+        self.client = create_client(backend, self.server, self.TIMEOUT)
+
+        self.assertTrue(self.client.send(1, [u"admin@example.com"], [], u"Warm up"))
+        self.assertTrue(self.server.wait_messages(1, self.TIMEOUT))
+        deadline = time.time() + self.TIMEOUT
+        while multicast and self.client.multicast_jid is None and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.client.multicast_jid is not None, multicast)
+
+    def send(self, count):
+        """
+        Sends a message to ``count`` receivers and returns the messages the
+        server received, as ``(to, addresses)`` tuples.
+        """
+        receivers = [u"user%d@example.com" % i for i in range(count)]
+        stanzas = self.server.stanzas
+        self.assertTrue(self.client.send(2, receivers, [], u"Message"))
+        self.assertTrue(self.server.wait_messages(1 + count, self.TIMEOUT))
+        self.assertEqual(self.server.messages, 1 + count)
+        return receivers, list(self.server.received)[stanzas:]
+
+    def check_multicast(self, backend):
+        self.start(backend, True)
+        receivers, received = self.send(120)
+
+        self.assertEqual([len(addresses) for to, addresses in received], [50, 50, 20])
+        self.assertEqual(set(to for to, addresses in received), set([u"example.com"]))
+        self.assertEqual([address for to, addresses in received for address in addresses],
+                         [(u"bcc", receiver) for receiver in receivers])
+
+    def check_unicast(self, backend, multicast):
+        self.start(backend, multicast)
+        receivers, received = self.send(multicast and 2 or 4)
+
+        self.assertEqual(received, [(receiver, []) for receiver in receivers])
+
+    def test_multicast_pyxmpp2(self):
+        """Testing the pyxmpp2 backend sends blind copies through multicast"""
+        self.check_multicast(BACKEND_PYXMPP2)
+
+    def test_multicast_asyncio(self):
+        """Testing the asyncio backend sends blind copies through multicast"""
+        self.check_multicast(BACKEND_ASYNCIO)
+
+    def test_no_multicast_pyxmpp2(self):
+        """Testing the pyxmpp2 backend sends a stanza per receiver without multicast"""
+        self.check_unicast(BACKEND_PYXMPP2, False)
+
+    def test_no_multicast_asyncio(self):
+        """Testing the asyncio backend sends a stanza per receiver without multicast"""
+        self.check_unicast(BACKEND_ASYNCIO, False)
+
+    def test_few_receivers_pyxmpp2(self):
+        """Testing the pyxmpp2 backend skips multicast for few receivers"""
+        self.check_unicast(BACKEND_PYXMPP2, True)
+
+    def test_few_receivers_asyncio(self):
+        """Testing the asyncio backend skips multicast for few receivers"""
+        self.check_unicast(BACKEND_ASYNCIO, True)
+
+
+class RoomTests(SimpleTestCase):
+    """
+    Checks that the sessions of both backends join the multi-user chat rooms
+    and leave them once they are not configured anymore.
+    """
+    PASSWORD = "tests"
+    TIMEOUT = 10
+    ROOM = u"room@conference.example.com"
+    OCCUPANT = u"room@conference.example.com/ReviewBoard"
+
+    def setUp(self):
+        self.server = FakeXmppServer(self.PASSWORD)
+        self.server.start()
+
+    def tearDown(self):
+        self.sender.pool.close()
+        self.server.stop()
+
+    def check_leave(self, backend, settings):
+        self.sender = create_sender(self.server, xmpp_backend=backend,
+                                    xmpp_partychat=self.ROOM, xmpp_partychat_muc=True)
+        self.assertTrue(self.sender.deliver(XmppNotification(1, [self.ROOM], u"Message")))
+        self.assertTrue(self.server.wait_messages(1, self.TIMEOUT))
+        self.assertEqual(list(self.server.received), [(self.ROOM, [])])
+        self.assertEqual(list(self.server.presences), [(self.OCCUPANT, None)])
+
+        self.sender.extension.settings.update(settings)
+        self.sender.reload_settings()
+        self.assertTrue(self.sender.deliver(XmppNotification(2, [u"doc"], u"Message")))
+        self.assertTrue(self.server.wait_for(lambda: len(self.server.presences) == 2,
+                                             self.TIMEOUT))
+        self.assertEqual(list(self.server.presences)[1], (self.OCCUPANT, u"unavailable"))
+
+    def test_room_removed_pyxmpp2(self):
+        """Testing the pyxmpp2 backend leaves a room removed from the settings"""
+        self.check_leave(BACKEND_PYXMPP2, {'xmpp_partychat': u""})
+
+    def test_room_removed_asyncio(self):
+        """Testing the asyncio backend leaves a room removed from the settings"""
+        self.check_leave(BACKEND_ASYNCIO, {'xmpp_partychat': u""})
+
+    def test_muc_disabled_pyxmpp2(self):
+        """Testing the pyxmpp2 backend leaves the rooms when they are not joined anymore"""
+        self.check_leave(BACKEND_PYXMPP2, {'xmpp_partychat_muc': False})
+
+    def test_muc_disabled_asyncio(self):
+        """Testing the asyncio backend leaves the rooms when they are not joined anymore"""
+        self.check_leave(BACKEND_ASYNCIO, {'xmpp_partychat_muc': False})
+
+
+class PresenceTests(SimpleTestCase):
+    """
+    Checks that the notifications to the offline recipients are dropped or
+    deferred, that the deferred ones are kept in the outbox, and that a
+    digest replaces them once the recipient is available again.
+    """
+    def setUp(self):
+        self.reset_presence()
+        self.directory = tempfile.mkdtemp(prefix='rbxmppnotification-tests-')
+        self.outbox = self.open_outbox()
+        self.delivered = []
+
+    def tearDown(self):
+        self.outbox.close()
+        shutil.rmtree(self.directory)
+        self.reset_presence()
+
+    def reset_presence(self):
+        presence.resources.clear()
+        presence.deferred.clear()
+        presence.returned.clear()
+
+    def open_outbox(self):
+        outbox = XmppOutbox(os.path.join(self.directory, 'outbox.db'))
+        outbox.open()
+        return outbox
+
+    def count_deferred(self):
+        return self.outbox.db.execute(
+            "SELECT COUNT(*) FROM notification WHERE delivered = 2").fetchone()[0]
+
+    def create_dispatcher(self, policy):
+        """
+        Returns a dispatcher delivering the notifications to the recipients
+        that are not offline, according to the ``policy``.
+        """
+        sender = create_sender(None, xmpp_offline_policy=policy)
+
+        def deliver(notification):
+            notification.receivers = sender.skip_offline(
+                notification, notification.receivers, {}, sender.get_settings())
+            self.delivered.append((notification.req_id, notification.receivers))
+            return True
+
+        return XmppDispatcher(sender.get_settings, deliver, self.outbox)
+
+    def go_offline(self, jid):
+        presence.update(jid, True)
+        presence.update(jid, False)
+
+    def deliver(self, dispatcher, *notifications):
+        dispatcher.journal(notifications)
+        dispatcher.deliver_batch(notifications)
+
+    def test_drop(self):
+        """Testing the notifications to offline recipients are dropped"""
+        self.go_offline(u"doc@example.com/home")
+        dispatcher = self.create_dispatcher('drop')
+        self.deliver(dispatcher, XmppNotification(1, [u"doc", u"grumpy"], u"Review"))
+
+        self.assertEqual(self.delivered, [(1, [u"grumpy"])])
+        self.assertEqual(self.count_deferred(), 0)
+        self.assertEqual(presence.deferred, {})
+
+    def test_defer(self):
+        """Testing the deferred notifications are sent as a digest on return"""
+        self.go_offline(u"doc@example.com/home")
+        dispatcher = self.create_dispatcher('defer')
+        self.deliver(dispatcher, XmppNotification(1, [u"doc", u"grumpy"], u"Review"),
+                     XmppNotification(2, [u"doc"], u"Reply"))
+
+        self.assertEqual(self.delivered, [(1, [u"grumpy"]), (2, [])])
+        self.assertEqual(self.count_deferred(), 2)
+        dispatcher.deliver_deferred()
+        self.assertEqual(len(self.delivered), 2)
+
+        presence.update(u"doc@example.com/work", True)
+        dispatcher.deliver_deferred()
+        self.assertEqual(self.delivered[2:],
+                         [(None, [u"doc@example.com"])])
+        self.assertEqual(self.count_deferred(), 0)
+        self.assertEqual(presence.deferred, {})
+
+    def test_takeover(self):
+        """Testing the deferred notifications are held again after a restart"""
+        self.go_offline(u"doc@example.com/home")
+        self.deliver(self.create_dispatcher('defer'),
+                     XmppNotification(1, [u"doc"], u"Review"))
+        self.reset_presence()
+        outbox = self.open_outbox()
+        try:
+            self.assertEqual(outbox.get_deferred(True), [])
+
+            # The process holding them died.
+            self.outbox.db.execute("UPDATE notification SET next_attempt = 0")
+            self.outbox.db.commit()
+            notification, = outbox.get_deferred(True)
+            self.assertEqual((notification.req_id, notification.receivers),
+                             (u"1", [u"doc@example.com"]))
+            self.assertEqual(self.outbox.get_deferred(True), [])
+        finally:
+            outbox.close()
+
+    def test_return_while_deferring(self):
+        """Testing a recipient available again while deferring gets the digest"""
+        self.go_offline(u"doc@example.com/home")
+        notification = XmppNotification(1, [u"doc"], u"Review")
+        presence.update(u"doc@example.com/home", True)
+        presence.defer(u"doc@example.com", notification)
+
+        self.assertEqual(presence.pop_returned(), [(u"doc@example.com", [notification])])
+
+    def test_max_deferred(self):
+        """Testing only the latest deferred notifications are kept"""
+        self.go_offline(u"doc@example.com/home")
+        presence.MAX_DEFERRED = 2
+        try:
+            dispatcher = self.create_dispatcher('defer')
+            self.deliver(dispatcher, *[XmppNotification(i, [u"doc"], u"Review %d" % i)
+                                       for i in range(3)])
+        finally:
+            del presence.MAX_DEFERRED
+
+        self.assertEqual(self.count_deferred(), 2)
+        self.assertEqual([n.message for n in presence.deferred[u"doc@example.com"]],
+                         [u"Review 1", u"Review 2"])
+
+
+class StreamManagementTests(SimpleTestCase):
+    """
+    Checks that both backends resume their stream after the connection
+    drops, or bind a new one when the server lost it, and send the stanzas
+    the server did not acknowledge again, so that none is lost.
+    """
+    PASSWORD = "tests"
+    TIMEOUT = 10
+
+    def setUp(self):
+        self.server = FakeXmppServer(self.PASSWORD, stream_management=True)
+        self.server.start()
+
+    def tearDown(self):
+        self.client.stop()
+        self.server.stop()
+
+    def check_reconnect(self, backend, resumed):
+        self.client = create_client(backend, self.server, self.TIMEOUT)
+        self.assertTrue(self.client.send(1, [u"admin@example.com"], [], u"Warm up"))
+        self.assertTrue(self.server.wait_messages(1, self.TIMEOUT))
+        deadline = time.time() + self.TIMEOUT
+        while self.client.sm_id is None and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertNotEqual(self.client.sm_id, None)
+
+        for i in range(3):
+            if not resumed:
+                self.server.sessions.clear()
+            self.server.drop_connections()
+            receivers = [u"user%d@example.com" % j for j in range(4)]
+            self.assertTrue(self.client.send(2, receivers, [], u"Message"))
+            self.assertTrue(self.server.wait_messages(5 + 4 * i, self.TIMEOUT))
+
+        time.sleep(0.5)
+        self.assertEqual(self.server.connections, 4)
+        self.assertEqual(self.server.resumptions, resumed and 3 or 0)
+        if resumed:
+            self.assertEqual(self.server.messages, 13)
+        else:
+            # Without resumption, the stanzas the server received but did
+            # not acknowledge yet are sent twice.
+            self.assertTrue(self.server.messages >= 13)
+
+    def test_resume_pyxmpp2(self):
+        """Testing the pyxmpp2 backend resumes the stream"""
+        self.check_reconnect(BACKEND_PYXMPP2, True)
+
+    def test_resume_asyncio(self):
+        """Testing the asyncio backend resumes the stream"""
+        self.check_reconnect(BACKEND_ASYNCIO, True)
+
+    def test_resume_failed_pyxmpp2(self):
+        """Testing the pyxmpp2 backend binds a new stream when resumption fails"""
+        self.check_reconnect(BACKEND_PYXMPP2, False)
+
+    def test_resume_failed_asyncio(self):
+        """Testing the asyncio backend binds a new stream when resumption fails"""
+        self.check_reconnect(BACKEND_ASYNCIO, False)
+
+
+
+class SenderAccountsTests(SimpleTestCase):
+    """
+    Checks that the passwords of the additional sender accounts are never
+    rendered and are kept when left out.
+    """
+    def setUp(self):
+        self.extension = TestExtension({
+            'xmpp_sender_accounts': u"rb1@example.com secret1\nrb2@example.com secret2",
+        })
+
+    def submit(self, accounts):
+        form = RBXmppNotificationSettingsForm(self.extension, {
+            'xmpp_backend': 'pyxmpp2',
+            'xmpp_host': 'example.com',
+            'xmpp_port': '5222',
+            'xmpp_sender_jid': 'rb@example.com',
+            'xmpp_sender_accounts': accounts,
+            'xmpp_queue_full_policy': 'drop',
+            'xmpp_rate_overflow': 'delay',
+            'xmpp_offline_policy': 'send',
+        })
+        self.assertTrue(form.is_valid(), form.errors)
+        return form.cleaned_data['xmpp_sender_accounts']
+
+    def test_render(self):
+        """Testing the sender account passwords are not rendered"""
+        form = RBXmppNotificationSettingsForm(self.extension)
+        html = form.as_p()
+
+        self.assertIn(u"rb1@example.com\nrb2@example.com", html)
+        self.assertNotIn(u"secret", html)
+
+    def test_keep_passwords(self):
+        """Testing the sender accounts without a password keep the saved one"""
+        self.assertEqual(self.submit(u"rb2@example.com\nrb3@example.com secret3\n"
+                                     u"rb1@example.com changed"),
+                         u"rb2@example.com secret2\nrb3@example.com secret3\n"
+                         u"rb1@example.com changed")
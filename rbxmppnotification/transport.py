@@ -0,0 +1,92 @@
+#
+# transport.py -- Common interface of the XMPP client backends.
+#
+# Copyright (c) 2013  Horatiu Eugen Vlad
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+BACKEND_PYXMPP2 = "pyxmpp2"
+BACKEND_ASYNCIO = "asyncio"
+
+PING_NS = "urn:xmpp:ping"
+DISCO_INFO_NS = "http://jabber.org/protocol/disco#info"
+ADDRESS_NS = "http://jabber.org/protocol/address"
+MUC_NS = "http://jabber.org/protocol/muc"
+SM_NS = "urn:xmpp:sm:3"
+XHTML_IM_BODY = (u'<html xmlns="http://jabber.org/protocol/xhtml-im">'
+                 u'<body xmlns="http://www.w3.org/1999/xhtml">%s</body></html>')
+
+
+def get_jid_domain(jid):
+    """
+    Returns the domain part of a JID string.
+    """
+    return jid.split("/", 1)[0].split("@")[-1]
+
+
+def get_full_jid(receiver, domain):
+    """
+    Returns the JID string of a receiver, which is a full JID or the local
+    part of a JID on ``domain``.
+    """
+    if "@" in receiver:
+        return receiver
+    return u"%s@%s" % (receiver, domain)
+
+
+class XmppTransport(object):
+    """
+    A long-lived XMPP session the notifications are sent over.
+
+    The sender only talks to the session through this interface, so the
+    backend handling the connection can be chosen in the settings. The JIDs
+    are passed as strings. The methods are called from the dispatcher thread.
+    """
+    def start(self):
+        """
+        Opens the session in the background. Does nothing if it is open.
+        """
+        raise NotImplementedError
+
+    def stop(self):
+        """
+        Closes the session gracefully.
+        """
+        raise NotImplementedError
+
+    def set_rooms(self, rooms, nickname):
+        """
+        Sets the multi-user chat (XEP-0045) rooms the session should be
+        present in, using ``nickname``. The rooms are joined once and joined
+        again after every reconnect.
+        """
+        raise NotImplementedError
+
+    def send(self, req_id, receivers, rooms, message, html=None):
+        """
+        Sends the message as a chat message to the ``receivers`` and as a
+        groupchat message to the ``rooms``, with the optional XHTML-IM body
+        ``html``. Waits up to the connection timeout for the session to be
+        authorized. Returns ``True`` when all the stanzas were written to the
+        stream.
+        """
+        raise NotImplementedError
@@ -23,7 +23,50 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 #
 
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponse
 from django.shortcuts import render_to_response
 from django.template.context import RequestContext
+from django.utils.crypto import constant_time_compare
+from reviewboard.extensions.base import get_extension_manager
+
+from rbxmppnotification import metrics as xmpp_metrics
+
 def configure(request, template_name="rbxmppnotification/configure.html"):
     return render_to_response(template_name, RequestContext(request, {}))
+
+@staff_member_required
+def metrics(request, template_name="rbxmppnotification/metrics.html"):
+    """
+    Shows the counters, gauges and histograms of the notification pipeline.
+    """
+    counters = []
+    histograms = []
+    for metric in xmpp_metrics.registry:
+        if metric.TYPE == "histogram":
+            histograms.append((metric, metric.get_rows()))
+        else:
+            counters.append((metric, metric.get_rows()))
+    return render_to_response(template_name, RequestContext(request, {
+        'counters': counters,
+        'histograms': histograms,
+    }))
+
+def metrics_text(request):
+    """
+    Returns the metrics in the Prometheus text format. Available to the staff
+    members and to the scrapers sending the ``xmpp_metrics_token`` as a
+    bearer token.
+    """
+    from rbxmppnotification.extension import RBXmppNotification
+
+    extension = get_extension_manager().get_enabled_extension(RBXmppNotification.id)
+    token = extension and extension.settings['xmpp_metrics_token']
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    if not (token and constant_time_compare(authorization, 'Bearer %s' % token)):
+        return staff_member_required(render_metrics_text)(request)
+    return render_metrics_text(request)
+
+def render_metrics_text(request):
+    return HttpResponse(xmpp_metrics.render_text(),
+                        content_type="text/plain; version=0.0.4; charset=utf-8")
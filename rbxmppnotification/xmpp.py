@@ -25,125 +25,34 @@
 
 import logging
 
-import sys
-
-from django.contrib.sites.models import Site
-
-from pyxmpp2.jid import JID
-from pyxmpp2.message import Message
-from pyxmpp2.client import Client
-from pyxmpp2.settings import XMPPSettings
-from pyxmpp2.interfaces import EventHandler, event_handler, QUIT
-from pyxmpp2.streamevents import AuthorizedEvent, DisconnectedEvent
+import time
+
+from django.utils import timezone
+
+from rbxmppnotification.batch import XmppEventBatch
+from rbxmppnotification.coalesce import XmppCoalescer, XmppEvent, XmppRegistrations, \
+                                        XmppScheduler, \
+                                        EVENT_PUBLISHED, EVENT_REOPENED, \
+                                        EVENT_CLOSED, EVENT_REVIEW, EVENT_REPLY, \
+                                        EVENT_NEW_USERS
+from rbxmppnotification.dispatch import XmppDispatcher, XmppNotification
+from rbxmppnotification.lanes import LANE_LOW
+from rbxmppnotification.messages import XmppMessageTemplates
+from rbxmppnotification.metrics import MESSAGES_FAILED, MESSAGES_OFFLINE, MESSAGES_SENT
+from rbxmppnotification.outbox import XmppOutbox, get_outbox_path
+from rbxmppnotification.pool import XmppSenderPool
+from rbxmppnotification.presence import presence, OFFLINE_DEFER, OFFLINE_SEND
+from rbxmppnotification.recipients import admin_cache, recipient_cache
+from rbxmppnotification.siteurl import site_base_url
+from rbxmppnotification.snapshot import XmppSettingsSnapshot
+from rbxmppnotification.spool import XmppSpool
+from rbxmppnotification.transport import BACKEND_ASYNCIO, get_full_jid
 
 def get_review_request_url(review_request):
     """
-    Returns site base URL
-    """
-    current_site = Site.objects.get_current()
-    siteconfig = current_site.config.get()
-    domain_method = siteconfig.get("site_domain_method")
-
-    base_url = u"%s://%s%s" % (domain_method, current_site.domain, review_request.get_absolute_url())
-    if sys.version_info[0] < 3:
-        base_url = base_url.decode("utf-8")
-    return base_url
-
-def get_users_review_request(review_request):
+    Returns the absolute URL of the review request
     """
-    Returns the set of active users that are interested in the review request
-    """
-    users = set()
-    for u in review_request.get_participants():
-        users.add(u)
-
-    if review_request.submitter.is_active:
-        users.add(review_request.submitter)
-
-    for u in review_request.target_people.filter(is_active=True):
-        users.add(u)
-
-    for group in review_request.target_groups.all():
-        for address in group.users.filter(is_active=True):
-            users.add(address)
-
-    for profile in review_request.starred_by.all():
-        if profile.user.is_active:
-            users.add(profile.user)
-
-    logging.debug("XMPP notification for review request #%s will be sent to: %s",review_request.get_display_id(), users)
-    return users
-
-class XmppClient(EventHandler):
-    """
-    A client to manage the XMPP connection and dispatch messages.
-    """
-    NAME = "Review Board XMPP Notification Client"
-    VERSION = 0.1
-
-    def __init__(self, host, port, timeout, from_jid, password, use_tls, tls_verify_peer):
-        self.host = host
-        self.port = port
-        self.timeout = timeout or 5
-        self.from_jid = from_jid
-        self.password = password
-        self.use_tls = use_tls
-        self.tls_verify_peer = tls_verify_peer
-
-        self.req_id = None
-        self.client = None
-        self.stanzas = None
-
-    @event_handler(AuthorizedEvent)
-    def handle_authorized(self, event):
-        logging.debug(u"XmppClient event handler for request #%s authorized: %s", self.req_id, event)
-        if self.client.stream != event.stream:
-            logging.debug(u"XmppClient event handler ignore event")
-            return
-        for stanza in self.stanzas:
-            logging.debug("XmppHandler for request #%s send message to %s", self.req_id, stanza.as_xml())
-            event.stream.send(stanza)
-        logging.debug(u"XmppHandler disconnecting stream for request #%s", self.req_id)
-        self.client.disconnect()
-
-    @event_handler(DisconnectedEvent)
-    def handle_disconnected(self, event):
-        logging.debug("XmppClient event handler for request #%s disconnected: %s", self.req_id, event)
-        if self.client.stream != event.stream:
-            logging.debug(u"XmppClient event handler ignore event")
-            return
-        logging.debug(u"XmppClient event handler closing stream for request #%s", self.req_id)
-        self.client.close_stream()
-        self.client = None
-        return QUIT
-
-    @event_handler()
-    def handle_all(self, event):
-        logging.debug(u"XmppClient event handler for request #%s: %s", self.req_id, event)
-
-    def send(self, req_id, stanzas):
-        self.req_id = req_id
-        self.stanzas = stanzas
-        logging.debug(u"XmppClient start sending messages for request #%s", self.req_id)
-        try:
-            settings = XMPPSettings({
-                            u"password": self.password,
-                            u"starttls": self.use_tls,
-                            u"tls_verify_peer": self.tls_verify_peer,
-                            u"server" : self.host,
-                            u"port": self.port,
-                            u"default_stanza_timeout": self.timeout,
-                        })
-
-            self.client = Client(self.from_jid, [self], settings)
-            self.client.connect()
-            self.client.run( timeout = self.timeout )
-        except Exception, e:
-            logging.error("Error sending XMPP notification for request #%s: %s",
-                      req_id,
-                      e,
-                      exc_info=1)
-
+    return site_base_url.get() + review_request.get_absolute_url()
 
 class XmppSender(object):
     """
@@ -151,9 +60,68 @@ class XmppSender(object):
     """
     NAME = "Review Board XMPP Notification Sender"
     VERSION = 0.1
+    NEW_USERS_LISTED = 20
 
     def __init__(self, extension):
         self.extension = extension
+        self.settings = None
+        self.pool = XmppSenderPool(self.create_client)
+        self.dispatcher = XmppDispatcher(self.get_settings, self.deliver,
+                                         XmppOutbox(get_outbox_path()),
+                                         XmppSpool(), self.pool.stop)
+        self.scheduler = XmppScheduler()
+        self.coalescer = XmppCoalescer(self.send_xmpp_message, self.scheduler)
+        self.registrations = XmppRegistrations(self.send_new_users, self.scheduler)
+        self.templates = XmppMessageTemplates()
+        self.batch = XmppEventBatch(self.send_events)
+        self.rooms_assigned = False
+
+    def create_client(self, from_jid, password, backend, host, port, timeout,
+                      use_tls, tls_verify_peer):
+        """
+        Returns a new session of a sender account, handled by ``backend``.
+        The client libraries are only imported when the first session is
+        created, so that the processes that never send notifications do not
+        load them.
+        """
+        if backend == BACKEND_ASYNCIO:
+            from rbxmppnotification.asyncxmpp import AsyncXmppClient
+            return AsyncXmppClient(host, port, timeout, from_jid, password,
+                                   use_tls, tls_verify_peer)
+        from rbxmppnotification.pyxmpp2client import XmppClient
+        return XmppClient(host, port, timeout, from_jid, password,
+                          use_tls, tls_verify_peer)
+
+    def get_settings(self):
+        """
+        Returns the snapshot of the settings, built on first use.
+        """
+        settings = self.settings
+        if settings is None:
+            settings = self.reload_settings()
+        return settings
+
+    def reload_settings(self):
+        """
+        Replaces the snapshot of the settings. Called when they are saved.
+        """
+        settings = XmppSettingsSnapshot.from_settings(self.extension.settings)
+        logging.debug(u"XmppSender settings loaded: %s sender accounts, %s rooms",
+                      len(settings.accounts), len(settings.rooms))
+        self.settings = settings
+        return settings
+
+    def shutdown(self):
+        """
+        Flushes the pending notifications and closes the XMPP session. Called
+        when the extension is disabled. The notifications the worker did not
+        deliver in time are left in the outbox.
+        """
+        self.coalescer.flush_all()
+        self.registrations.flush_all()
+        self.scheduler.stop()
+        self.dispatcher.stop(self.get_settings().timeout)
+        self.pool.close()
 
     def send_review_request_published(self, user, review_request, changedesc):
         # If the review request is not yet public or has been discarded, don't send
@@ -162,17 +130,7 @@ class XmppSender(object):
         if ( not review_request.public ):
             return
 
-        message = u"%s %s published review request #%d: \"%s\"\n%s" % (
-            user.first_name, user.last_name,
-            review_request.get_display_id(),
-            review_request.summary,
-            get_review_request_url(review_request))
-
-        users = get_users_review_request(review_request)
-        # Do not send notification to the user that triggered the update
-        users.discard(user)
-
-        self.send_xmpp_message(users, review_request.get_display_id(), message)
+        self.batch.add((EVENT_PUBLISHED, user, review_request, time.time()))
 
     def send_review_request_reopened(self, user, review_request):
         # If the review request is not yet public or has been discarded, don't send
@@ -181,17 +139,7 @@ class XmppSender(object):
         if ( not review_request.public ):
             return
 
-        message = u"%s %s reopened review request #%d: \"%s\"\n%s" % (
-            user.first_name, user.last_name,
-            review_request.get_display_id(),
-            review_request.summary,
-            get_review_request_url(review_request))
-
-        users = get_users_review_request(review_request)
-        # Do not send notification to the user that triggered the update
-        users.discard(user)
-
-        self.send_xmpp_message(users, review_request.get_display_id(), message)
+        self.batch.add((EVENT_REOPENED, user, review_request, time.time()))
 
     def send_review_request_closed(self, user, review_request):
         # If the review request is not yet public or has been discarded, don't send
@@ -200,17 +148,7 @@ class XmppSender(object):
         if ( review_request.status == 'D'):
             return
 
-        message = u"%s %s closed review request #%d: \"%s\"\n%s" % (
-            user.first_name, user.last_name,
-            review_request.get_display_id(),
-            review_request.summary,
-            get_review_request_url(review_request))
-
-        users = get_users_review_request(review_request)
-        # Do not send notification to the user that triggered the update
-        users.discard(user)
-
-        self.send_xmpp_message(users, review_request.get_display_id(), message)
+        self.batch.add((EVENT_CLOSED, user, review_request, time.time()))
 
     def send_review_published(self, user, review):
         review_request = review.review_request
@@ -218,17 +156,7 @@ class XmppSender(object):
         if not review_request.public:
             return
 
-        message = u"%s %s reviewed request #%d: \"%s\"\n%s" % (
-            user.first_name, user.last_name,
-            review_request.get_display_id(),
-            review_request.summary,
-            get_review_request_url(review_request))
-
-        users = get_users_review_request(review_request)
-        # Do not send notification to the user that triggered the update
-        users.discard(user)
-
-        self.send_xmpp_message(users, review_request.get_display_id(), message)
+        self.batch.add((EVENT_REVIEW, user, review_request, time.time()))
 
     def send_reply_published(self, user, reply):
         review = reply.base_reply_to
@@ -237,61 +165,198 @@ class XmppSender(object):
         if not review_request.public:
             return
 
-        message = u"%s %s replied review request #%d: \"%s\"\n%s" % (
-            user.first_name, user.last_name,
-            review_request.get_display_id(),
-            review_request.summary,
-            get_review_request_url(review_request))
+        self.batch.add((EVENT_REPLY, user, review_request, time.time()))
 
-        users = get_users_review_request(review_request)
-        # Do not send notification to the user that triggered the update
-        users.discard(user)
-
-        self.send_xmpp_message(users, review_request.get_display_id(), message)
-
-    def send_xmpp_message(self, receivers, req_id, message):
+    def send_new_user(self, user):
         """
-        Formats and sends a XMPP notification with the current domain and review request
-        being added to the template context. Returns the resulting message ID.
+        Notifies the administrators of a new user. The registrations within
+        the ``xmpp_new_user_window`` are sent as one message per
+        administrator.
         """
-        logging.info("XMPP notification send message for request #%s: %s", req_id, message)
-
-        host = self.extension.settings['xmpp_host']
-        port = self.extension.settings['xmpp_port']
-        timeout = self.extension.settings['xmpp_timeout']
-        from_jid = self.extension.settings["xmpp_sender_jid"]
-        password = self.extension.settings["xmpp_sender_password"]
-        use_tls = self.extension.settings["xmpp_use_tls"]
-        tls_verify_peer = self.extension.settings["xmpp_tls_verify_peer"]
+        self.registrations.add(user, admin_cache.get_admins(),
+                               self.get_settings().new_user_window)
 
-        if sys.version_info[0] < 3:
-            from_jid = from_jid.decode("utf-8")
-            password = password.decode("utf-8")
-            message = message.decode("utf-8")
+    def send_new_users(self, users, admins):
+        """
+        Sends the administrators the notification of the registered users,
+        listing at most ``NEW_USERS_LISTED`` of them.
+        """
+        settings = self.get_settings()
+        now = timezone.now()
+        registered = set(user.pk for user in users)
+        receivers = set(admin.jid for admin in admins
+                        if admin.id not in registered and admin.wants(EVENT_NEW_USERS, now))
+        if not receivers:
+            return
+        message, html = self.templates.render(EVENT_NEW_USERS, {
+            'users': users[:self.NEW_USERS_LISTED],
+            'count': len(users),
+            'more': max(len(users) - self.NEW_USERS_LISTED, 0),
+            'site_url': site_base_url.get(),
+        }, settings.use_xhtml_im)
+        self.send_xmpp_message(receivers, None, message, html, EVENT_NEW_USERS)
+
+    def send_events(self, events):
+        """
+        Sends the notifications of a batch of ``(kind, user, review_request,
+        created)`` events. The recipients of all the review requests are
+        resolved at once, then filtered by the preferences of the users.
+        """
+        recipients = recipient_cache.get_recipients_many(
+            [review_request for kind, user, review_request, created in events])
+        now = timezone.now()
+        for kind, user, review_request, created in events:
+            # Do not send notification to the user that triggered the update
+            users = set(recipient.jid for recipient in recipients[review_request.pk]
+                        if recipient.id != user.pk and recipient.wants(kind, now))
+            self.send_event(kind, user, review_request, users, created)
+
+    def send_event(self, kind, user, review_request, users, created):
+        """
+        Sends the notification of a review request event to the users and the
+        partychat rooms. Within the ``xmpp_coalesce_window``, the events on
+        the same review request are merged into one digest per recipient.
+        """
+        settings = self.get_settings()
+        receivers = self.get_receivers(users, settings)
+        req_id = review_request.get_display_id()
+        url = get_review_request_url(review_request)
+        message, html = self.templates.render(kind, {
+            'user': user,
+            'review_request': review_request,
+            'review_request_url': url,
+        }, settings.use_xhtml_im)
+        window = settings.coalesce_window
+        if not window:
+            self.send_xmpp_message(receivers, req_id, message, html, kind, created)
+            return
+        event = XmppEvent(kind, req_id, review_request.summary, url, message, html, created)
+        self.coalescer.add(event, receivers, window)
 
-        if self.extension.settings["xmpp_partychat_only"]:
+    def get_receivers(self, users, settings):
+        """
+        Returns the JIDs of the users and of the partychat rooms that should
+        receive a notification.
+        """
+        if settings.partychat_only:
             receivers = set()
+        else:
+            receivers = set(users)
 
-        rooms = self.extension.settings["xmpp_partychat"].split()
-        if sys.version_info[0] < 3:
-            rooms = [room.decode("utf-8") for room in rooms]
-        receivers.update(rooms)
+        receivers.update(room for room, jid in settings.rooms)
+        return receivers
+
+    def send_xmpp_message(self, receivers, req_id, message, html=None, kind=None, created=None):
+        """
+        Queues a XMPP notification for the receivers. The notification is
+        delivered on the dispatcher thread. The partychat rooms get their own
+        notification in the low priority lane, so the broadcasts do not delay
+        the notifications of the users.
+        """
+        logging.info("XMPP notification send message for request #%s: %s", req_id, message)
+        rooms = set(receivers) & set(room for room, jid in self.get_settings().rooms)
+        users = set(receivers) - rooms
+        if users:
+            self.dispatcher.enqueue(XmppNotification(req_id, users, message, html,
+                                                     kind, created))
+        if rooms:
+            self.dispatcher.enqueue(XmppNotification(req_id, rooms, message, html,
+                                                     kind, created, LANE_LOW))
+
+    def deliver(self, notification):
+        """
+        Formats and sends a queued XMPP notification over the sessions of the
+        sender accounts. The receivers of an account that fails are moved to
+        the next healthy account. Returns ``True`` when the notification was
+        written to the streams, otherwise the notification is left with the
+        receivers it was not sent to.
+        """
+        req_id = notification.req_id
+        receivers = notification.receivers
+        message = notification.message
+        event = notification.kind or "other"
+        settings = self.get_settings()
+        domain = settings.domain
 
         try:
-            from_jid = JID(from_jid)
-            stanzas = set()
-            for receiver in receivers:
-                if "@" in str(receiver):
-                    receiver_jid = JID(local_or_jid = receiver)
-                else:
-                    receiver_jid = JID(local_or_jid = receiver,
-                                       domain = from_jid.domain)
-                stanzas.add(Message(to_jid = receiver_jid, body = message,
-                                    stanza_type = "chat"))
-            client = XmppClient(host, port, timeout, from_jid, password, use_tls, tls_verify_peer)
-            client.send(req_id, stanzas)
+            self.pool.configure(settings.accounts, *settings.connection)
+
+            # Multi-user chat rooms get a single groupchat message, sent after
+            # the session has joined them.
+            rooms = {}
+            if settings.partychat_muc:
+                rooms = dict(settings.rooms)
+
+            pending = list(receivers)
+            if settings.offline_policy != OFFLINE_SEND:
+                pending = self.skip_offline(notification, pending, rooms, settings)
+            while pending:
+                # The rooms that are not configured anymore are left.
+                if rooms or self.rooms_assigned:
+                    self.assign_rooms(rooms.values(), settings.muc_nickname)
+                groups = {}
+                for receiver in pending:
+                    account = self.pool.get_account(get_full_jid(receiver, domain))
+                    if account is None:
+                        logging.error("No XMPP sender account available, notification "
+                                      "for request #%s deferred", req_id)
+                        MESSAGES_FAILED.inc(len(pending), event=event)
+                        notification.receivers = pending
+                        return False
+                    groups.setdefault(account, []).append(receiver)
+                pending = []
+                for account, group in groups.items():
+                    to_jids = [get_full_jid(receiver, domain) for receiver in group
+                               if receiver not in rooms]
+                    room_jids = [rooms[receiver] for receiver in group
+                                 if receiver in rooms]
+                    client = self.pool.get_client(account)
+                    if client.send(req_id, to_jids, room_jids, message, notification.html):
+                        MESSAGES_SENT.inc(len(group), event=event)
+                        account.succeeded()
+                    else:
+                        account.failed()
+                        pending.extend(group)
+            return True
         except Exception, e:
             logging.error("Error sending XMPP notification for request #%s: %s",
                       req_id,
                       e,
                       exc_info=1)
+            MESSAGES_FAILED.inc(len(receivers), event=event)
+            return False
+
+    def skip_offline(self, notification, receivers, rooms, settings):
+        """
+        Returns the receivers that are not offline. The notification is
+        dropped for the offline ones, or deferred until they are available
+        again, according to the ``xmpp_offline_policy``. The deferred JIDs
+        are left in ``notification.deferred`` for the dispatcher.
+        """
+        online = []
+        for receiver in receivers:
+            jid = get_full_jid(receiver, settings.domain)
+            if receiver in rooms or not presence.is_offline(jid):
+                online.append(receiver)
+                continue
+            logging.debug(u"XMPP notification for request #%s not sent to offline %s (%s)",
+                          notification.req_id, jid, settings.offline_policy)
+            if settings.offline_policy == OFFLINE_DEFER:
+                notification.deferred.append(jid)
+            MESSAGES_OFFLINE.inc(policy=settings.offline_policy)
+        return online
+
+    def assign_rooms(self, rooms, nickname):
+        """
+        Spreads the multi-user chat rooms across the healthy accounts, so
+        each room is joined by a single account. The sessions leave the rooms
+        they are not assigned anymore.
+        """
+        self.rooms_assigned = bool(rooms)
+        assigned = dict((account, []) for account, client in self.pool.get_clients())
+        for room in rooms:
+            account = self.pool.get_account(room)
+            if account is not None:
+                assigned.setdefault(account, []).append(room)
+        for account, account_rooms in assigned.items():
+            self.pool.get_client(account).set_rooms(account_rooms, nickname)
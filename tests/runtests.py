@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+#
+# runtests.py -- Runs the tests of the extension.
+#
+# Copyright (c) 2013  Horatiu Eugen Vlad
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+"""
+Runs the tests of the extension against an in-memory database.
+
+Run it from the source tree, in a Python environment where Review Board and
+the extension requirements are installed::
+
+    python tests/runtests.py [rbxmppnotification.tests.SomeTests]
+"""
+
+import os
+import sys
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.dirname(TESTS_DIR)
+
+# reviewboard.settings imports the settings_local module of the tests, and
+# the benchmarks directory provides the fake XMPP server.
+sys.path.insert(0, TESTS_DIR)
+sys.path.insert(1, SOURCE_DIR)
+sys.path.insert(2, os.path.join(SOURCE_DIR, "benchmarks"))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "reviewboard.settings")
+
+
+def main():
+    from django.conf import settings
+    from django.test.runner import DiscoverRunner
+
+    # The extension is not enabled through the extension manager, so its
+    # models are added to the installed apps here and its templates are
+    # found through the template directories.
+    settings.INSTALLED_APPS = list(settings.INSTALLED_APPS) + ["rbxmppnotification"]
+    settings.TEMPLATE_DIRS = tuple(settings.TEMPLATE_DIRS) + (
+        os.path.join(SOURCE_DIR, "rbxmppnotification", "templates"),)
+
+    runner = DiscoverRunner(verbosity=1)
+    failures = runner.run_tests(sys.argv[1:] or ["rbxmppnotification.tests"])
+    sys.exit(bool(failures))
+
+
+if __name__ == "__main__":
+    main()